@@ -1,13 +1,21 @@
-import logging, math, os, config, datetime, requests, txtparsing 
-from workers import MapWorker
+import logging, math, os, config, datetime, txtparsing, compositing, reflectivity, framecache, framestore, datasources, stationindex, radartiles, flightpath, animation
+import numpy as np
+from workers import mapworker as MapWorker
 from txtparsing import DataWorker
-from workers import MapWorker 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
+from metrics import METRICS
 
 
 LOC_FOLS = config.LOC_FOLS
 TAG = 'RadarWorker - '
 
+# Frames downloaded by any RadarWorker in this process, shared so counters and LRU order are global
+FRAME_CACHE = framecache.FrameCache(LOC_FOLS['frame-cache'], config.FRAME_CACHE_BYTES)
+
+# Decoded frames, memory-mapped so every worker on the host shares the same pages
+FRAME_STORE = framestore.FrameStore(LOC_FOLS['frames'], config.FRAME_STORE_BYTES)
+
 # Only works for years after 2011
 # Makes use of data from IEM
 
@@ -16,245 +24,326 @@ TAG = 'RadarWorker - '
 #       - Pulls radar data 
 #       - Contains methods to create overlays for the MapWorker
 class RadarWorker:
-    IEM_URL = 'https://mesonet.agron.iastate.edu/archive/data/'
+    IEM_URL = config.IEM_URL
+    PRODUCT = 'n0q'
 
     # Constructor
-    def __init__(self, sim_time):
+    # Frames are read from source, a datasources.DataSource, by default the one of config.DATA_SOURCE
+    # A session is only used by the default HTTP source
+    def __init__(self, sim_time, frame_cache=None, session=None, frame_store=None, source=None):
         self.sim_time = sim_time
-        self.__radar_stations = []
-        self.__http_errors = 0
+        self.__frame_cache = frame_cache if frame_cache is not None else FRAME_CACHE
+        self.__frame_store = frame_store if frame_store is not None else FRAME_STORE
+        self.__radar_stations = None
+        self.__source = source if source is not None else datasources.open_source(config.DATA_SOURCE or self.IEM_URL, session)
         self.__img_path = None
         self.__wld_path = None
+        self.__frame = None
+        self.__transform = None
+        self.__iem_range = None
 
-        worker = DataWorker(LOC_FOLS['meta']+'nexrad-stations-template.txt')
-        worker.quicksort_lg(LOC_FOLS['meta']+'nexrad-stations.txt',
-                            LOC_FOLS['meta']+'nexrad-stations-sorted.txt',
-                            'longitude')
-        worker.replace(LOC_FOLS['meta']+'nexrad-stations.txt',
-                       LOC_FOLS['meta']+'nexrad-stations-sorted.txt')
-        meta_data = worker.get_vals(LOC_FOLS['meta']+'nexrad-stations.txt', 
-                                    ['icao', 'state', 'elevation', 'latitude', 'longitude'])
-        for station_list in meta_data:
-            self.__radar_stations.append(RadarStation(station_list[0], station_list[1],
-                                                      station_list[2], station_list[3],
-                                                      station_list[4]))
+        # Station metadata is parsed once and then served from a binary cache
+        self.__station_index = stationindex.load_station_index(LOC_FOLS['meta']+'nexrad-stations.txt',
+                                                               LOC_FOLS['meta']+'nexrad-stations-template.txt')
 
     @property 
     def sim_time(self):
         return self.__sim_time
 
+    @property
+    def frame_cache(self):
+        return self.__frame_cache
+
     # Ensures that time falls in 5 minute increments
     @sim_time.setter
     def sim_time(self, time):
-        mod5 = time.minute % 5
-        if mod5 is 0 and time.second is 0:
-            self.__sim_time = time
-        else:
-            minute = time.minute
-            second = time.second
-            if second is not 0 and second >= 30:
-                minute += 1
-                mod5 = minute % 5
-
-            if mod5 < 3:
-                while minute % 5 is not 0:
-                    minute -= 1
-            else:
-                while minute % 5 is not 0:
-                    minute += 1
-        self.__sim_time = time.replace(minute=minute, second=0)
-
-    # Generates urls for data pulls
-    def _generate_url_data(self):
-        gen_url  = self.IEM_URL + str(self.__sim_time.year) + '/'
-        gen_url += self.s_ext(str(self.__sim_time.month), 2) + '/'
-        gen_url += self.s_ext(str(self.__sim_time.day), 2) + '/GIS/uscomp/'
-
-        filename  = 'n0q_' + str(self.__sim_time.year) + self.s_ext(str(self.__sim_time.month), 2)
-        filename += self.s_ext(str(self.__sim_time.day), 2) + self.s_ext(str(self.__sim_time.hour), 2)
-        filename += self.s_ext(str(self.__sim_time.second), 2) 
-        gen_url += filename
-        
-        png_url = gen_url + '.png'
-        logging.info(TAG+'generated png url: ' + png_url)
-
-        wld_url = gen_url + '.wld'
-        logging.info(TAG+'generated wld url: ' + wld_url)
-
-        return [png_url, wld_url, filename]
-
-    def _check_request_completion(self, request):
-        if request.status_code is not 200:
-            self.__http_errors += 1
-            logging.error(TAG+'*****FAILED TO DOWNLOAD FILE*****')
-            if self.__http_errors >= 25:
-                raise Exception('Too many failed downloads: {} downloads failed'.format(self.__http_errors))
+        self.__sim_time = self.snap_time(time)
+
+    # RadarStation objects are only built when asked for, queries should use station_index
+    @property
+    def radar_stations(self):
+        if self.__radar_stations is None:
+            index = self.__station_index
+            self.__radar_stations = [RadarStation(index.icao[i], index.state[i], index.elevation[i],
+                                                  index.latitude[i], index.longitude[i])
+                                     for i in range(len(index))]
+        return self.__radar_stations
+
+    # Spatial index over the radar stations, see stationindex.StationIndex
+    @property
+    def station_index(self):
+        return self.__station_index
+
+    @property
+    def frame_store(self):
+        return self.__frame_store
+
+    # The DecodedFrame for the data pulled last, None before the first pull
+    @property
+    def frame(self):
+        return self.__frame
+
+    # Where frames are read from, see datasources
+    @property
+    def source(self):
+        return self.__source
+
+    # Number of failed downloads of this worker, see METRICS for the process wide count
+    # Sources that do not download never fail that way
+    @property
+    def http_errors(self):
+        return getattr(self.__source, 'http_errors', 0)
+
+    # Reads the png and wld files for a time from the source, returns their local paths
+    # Frames a source keeps on disk are used in place, others are written to the frame cache
+    def _fetch_frame(self, time):
+        paths = self.__source.local_paths(self.PRODUCT, time)
+        if paths is not None:
+            return paths
+        data = self.__source.fetch(self.PRODUCT, time)
+        if data is None:
+            return None
+        return self.__frame_cache.put(self.PRODUCT, time, *data)
 
     # Method to pull wld file as well as png file from IEM
+    # Frames already present in the frame cache are not downloaded again
     def pull_data(self):
-        self.cl_wd()
-        url_data = self._generate_url_data()
-
-        logging.info(TAG+'Downloading the png file')
-        try:
-            request = requests.get(url_data[0])
-        except:
-            logging.error(TAG+'IEM not furnishing nexrad data... try again later.')
-        with open(LOC_FOLS['nexrad']+url_data[2]+'.png', 'wb') as file:
-            file.write(request.content)
-            self._check_request_completion(request)
-            self.__img_path = LOC_FOLS['nexrad']+url_data[2]+'.png'
-
-        logging.info(TAG+'Downloading the wld file')
-        try:
-            request = requests.get(url_data[1])
-        except:
-            logging.error(TAG+'IEM not furnishing wld data... try again later.')
-        with open(LOC_FOLS['nexrad']+url_data[2]+'.txt', 'wb') as file:
-            file.write(request.content)
-            self._check_request_completion(request)
-            self.__wld_path = LOC_FOLS['nexrad']+url_data[2]+'.txt'
+        paths = self.frame_paths(self.__sim_time)
+        if paths is None:
+            raise Exception('Could not get IEM data for {}'.format(self.__sim_time))
+
+        self.__img_path, self.__wld_path = paths
         self._process_wld() 
-    
+
+    # Returns the local (png, wld) paths of the frame for a time, fetching it if it is not cached
+    # Returns None if the frame could not be fetched
+    def frame_paths(self, time):
+        time = self.snap_time(time)
+        paths = self.__frame_cache.get(self.PRODUCT, time)
+        if paths is None:
+            return self._fetch_frame(time)
+        logging.info(TAG+'Using cached IEM data for {}'.format(time))
+        return paths
+
+    # Returns the DecodedFrame for any time without touching sim_time, fetching it if needed
+    # Returns None if the frame could not be fetched
+    def get_frame(self, time):
+        paths = self.frame_paths(time)
+        if paths is None:
+            return None
+        return self.__frame_store.load(*paths)
+
+    # Makes an already loaded frame the current one, as pull_data would for time but without any I/O
+    # Used by simclock.SimClock, which loads frames ahead of time in the background
+    def use_frame(self, time, paths, frame):
+        self.sim_time = time
+        self.__img_path, self.__wld_path = paths
+        self._set_frame(frame)
+
+    # Fetches every frame in [start, end] into the frame cache
+    # Returns a dictionary of time -> (png, wld) paths for the frames that are available
+    def prefetch(self, start, end, step=datetime.timedelta(minutes=5), workers=None):
+        times = []
+        time = self.snap_time(start)
+        while time <= end:
+            times.append(time)
+            time += step
+        return self.prefetch_times(times, workers)
+
+    # Fetches the frames for a list of times into the frame cache, same return value as prefetch
+    # The source reads the missing frames its own way, concurrently over HTTP, in one pass over an archive
+    def prefetch_times(self, times, workers=None):
+        times = sorted(set(self.snap_time(time) for time in times))
+        cached = {}
+        missing = []
+        for time in times:
+            key = framecache.FrameCache.key(self.PRODUCT, time)
+            paths = self.__source.local_paths(self.PRODUCT, time)
+            if paths is not None:
+                cached[time] = paths
+            elif key in self.__frame_cache:
+                cached[time] = self.__frame_cache.paths(key)
+            else:
+                missing.append(time)
+        logging.info(TAG+'prefetching {} frames, {} already available'.format(len(missing), len(cached)))
+
+        for time, data in self.__source.fetch_many(self.PRODUCT, missing, workers):
+            cached[time] = self.__frame_cache.put(self.PRODUCT, time, *data)
+        for time in missing:
+            if time not in cached:
+                logging.error(TAG+'could not prefetch frame for {}'.format(time))
+        return dict(sorted(cached.items()))
+
     # Method to process the data stored in the wld file for the downloaded IEM data
     def _process_wld(self):
-        logging.info(TAG+'Processing the wld file pulled correlating to IEM data')
-        wld_file = self.__wld_path
-        
-        # Fill a local array with wld data
-        wld_data = []
-        with open(wld_file, 'r') as reader:
-            line = reader.readline()
-            while line:
-                wld_data.append(line.rstrip())
-                line = reader.readline()
-
-        # Convert all wld data in dictionary to float values
-        for i, data in enumerate(wld_data):
-            if data[0] == '-' or data[0] == '+':
-                wld_data[i] = txtparsing.DataWorker.str_to_flt(wld_data[i])
-            else:
-                wld_data[i] = float(wld_data[i])
-        
-        # Make sure map skew is zero, not handled in this program
-        if wld_data[1] != 0 or wld_data[2] != 0:
-            raise Exception('wld data is skewed')
-
-        # Make sure the pixels are square
-        if wld_data[0] != -wld_data[3]:
-            raise Exception('rectangular pixels in IEM data, add code to handle')
-
-        # Load data into the object, for other functions to make use of
-        self.__pixel_width = wld_data[0]
-
-        im  = Image.open(self.__img_path)
-        width, height = im.size
-        self.__iem_range = ((wld_data[5] - height*self.__pixel_width, wld_data[5]),
-                            (wld_data[4], wld_data[4] + width*self.__pixel_width))
-        logging.info(TAG+'GPS range of IEM data: {}'.format(self.__iem_range))
+        logging.debug(TAG+'Processing the wld file pulled correlating to IEM data')
+        self._set_frame(self.__frame_store.load(self.__img_path, self.__wld_path))
+
+    # The composite is decoded once by the frame store, lookups are served from its grid
+    # The world file may be skewed or have rectangular pixels, the GeoTransform handles both
+    def _set_frame(self, frame):
+        self.__frame = frame
+        self.__transform = frame.transform
+        self.__iem_range = self.__transform.bounds(frame.shape)
+        logging.debug(TAG+'GPS range of IEM data: {}'.format(self.__iem_range))
             
+    # GeoTransform of the IEM data pulled last, None before the first pull
+    @property
+    def transform(self):
+        return self.__transform
+
+    # GPS range ((lat_min, lat_max), (lon_min, lon_max)) of the IEM data pulled last
+    @property
+    def iem_range(self):
+        return self.__iem_range
+
     # Method to convert gps coordinates to pixel coordinates for IEM image pulled
-    # Assumes that the pixel requested is in the data range
+    # Assumes that the pixel requested is in the data range, outside of it see GeoTransform.gps_to_pixel
     def gps_to_pixel(self, gps_coor):
-        range = self.__iem_range
-        lon_dif = gps_coor[1] - self.__iem_range[1][0]
-        lat_dif = self.__iem_range[0][1] - gps_coor[0]
-        im  = Image.open(self.__img_path)
-        im_width, im_height = im.size
-
-        x = int(lon_dif / self.__pixel_width)
-        y = int(lat_dif / self.__pixel_width)
-        logging.info('Converted gps coordinate to: x:{} y:{}'.format(x, y))
+        x, y = self.__transform.gps_to_pixel(gps_coor)
+        # Arguments are only formatted when debug logging is on, this is called in hot loops
+        logging.debug(TAG+'Converted gps coordinate to: x:%s y:%s', x, y)
         return (x, y)
 
+    # Vectorized version of gps_to_pixel for an Nx2 array of (lat, lon) coordinates
+    # Returns an Nx2 int array of (x, y), points outside the IEM range get out of bounds pixels
+    # Pixels are floored, they only differ from gps_to_pixel just west or north of the IEM range
+    def gps_to_pixels(self, gps_coors):
+        return self.__transform.gps_to_pixels(gps_coors)
+
     # Overlays nexrad data over weather tiles created by a MapWorker
     # Areas with no data available are overlayed with a red tint
-    def create_overlay_image(self, map_worker):
-        logging.info(TAG+'creating a map overlayed with nexrad data')
-        mp_lat_r = map_worker.gps_range[0]
-        mp_lon_r = map_worker.gps_range[1]
-
-        map_img = Image.open(map_worker.tilepath)
-        mp_width, mp_height = map_img.size
-
-        iem = Image.open(self.__img_path).convert("RGBA")
-        iem_width, iem_height = iem.size
-
-        # Top right pixel point in iem image (left_top if gps)
-        iem_min_x, iem_min_y = self.gps_to_pixel((mp_lat_r[1], mp_lon_r[0])) 
-        iem_max_x, iem_max_y = self.gps_to_pixel((mp_lat_r[0], mp_lon_r[1]))
-
-        part_in_range = True
-        if (iem_max_x > iem_width and iem_min_x > iem_width) or iem_max_x < 0:
-            part_in_range = False
-        elif (iem_max_y > iem_height and iem_min_y > iem_height) or iem_max_y < 0:
-            part_in_range = False
-
-        # Figure out how many pixels are needed for the red no-data zone
-        add_x, add_y = ([], [])
-        if part_in_range:
-            # Handle the values for 'x'
-            if iem_min_x < 0:
-                add_x.append(iem_min_x * -1)
-                iem_min_x = 0
-            else:
-                add_x.append(0)
-            if iem_max_x > iem_width:
-                add_x.append(iem_max_x - iem_width)
-                iem_max_x = iem_width
-            else:
-                add_x.append(0)
-
-            # Handle the values for 'y'
-            if iem_min_y < 0:
-                add_y.append(iem_min_y * -1)
-                iem_min_y = 0
-            else:
-                add_y.append(0)
-            if iem_max_y > iem_height:
-                add_y.append(iem_max_y - iem_height)
-                iem_max_y = iem_height
-            else:
-                add_y.append(0)
-            
-            # Create a blank, transparent canvas to create ovelay on
-            canv_width = (iem_max_x - iem_min_x) + sum(add_x)
-            canv_height = (iem_max_y - iem_min_y) + sum(add_y)
-            canvas = Image.new('RGBA', (canv_width, canv_height), color = (0,0,0,0)) 
-
-            # Create a crop of data needed from IEM's png
-            crop = iem.crop((iem_min_x, iem_min_y, iem_max_x, iem_max_y))
-            crop = self.apply_transparency_filter(crop)
-
-            # Add all red overlays
-            canvas.paste(crop, (add_x[0], add_y[0]), crop)
-            red = Image.new('RGBA', (crop.size[0], add_y[0]), color=(230, 14, 14, 90))
-            canvas.paste(red, (add_x[0], 0), red)
-            red = Image.new('RGBA', (add_x[0], canv_height), color=(230, 14, 14, 90))
-            canvas.paste(red, (0, 0), red)
-            red = Image.new('RGBA', (add_x[1], canv_height), color=(230, 14, 14, 90))
-            canvas.paste(red, ((iem_max_x - iem_min_x) + add_x[0], 0), red)
-            red = Image.new('RGBA', (crop.size[0], add_y[1]), color=(230, 14, 14, 90))
-            canvas.paste(red, (add_x[0], (iem_max_y - iem_min_y) + add_y[0]), red)
-
-            # Paste data and filter onto map
-            canvas = canvas.resize(map_img.size, Image.ANTIALIAS)
-            map_img.paste(canvas, (0,0), canvas)
-        else:
-            canvas = Image.new('RGBA', (200, 100), color = (230, 14, 14, 90))
-            canvas = canvas.resize(map_img.size, Image.ANTIALIAS)
-            map_img.paste(canvas, (0,0), canvas)
-
-        map_img.save(LOC_FOLS['map']+'overlay+stitched.png', 'PNG')
-        logging.info(TAG+'completed map w/overlay')
-
+    # The overlay is saved to path, pass path=None to only get the image back
+    # With an incremental.IncrementalRenderer, only what changed since its last render is redrawn
+    # With a remap.RemapRenderer, frames are reprojected through a table cached per viewport geometry
+    def create_overlay_image(self, map_worker, path=LOC_FOLS['map']+'overlay+stitched.png', renderer=None):
+        logging.debug(TAG+'creating a map overlayed with nexrad data')
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before creating overlays')
+        if renderer is not None:
+            map_img = renderer.render(self.__frame, self._viewport_image(map_worker), map_worker.gps_range)
+            if path is not None:
+                renderer.save(path)
+            logging.debug(TAG+'completed map w/overlay')
+            return map_img
+        map_img = compositing.render_overlay(self.__frame, self._viewport_image(map_worker), map_worker.gps_range)
+        if path is not None:
+            with METRICS.timer('save'):
+                map_img.save(path, 'PNG')
+        logging.debug(TAG+'completed map w/overlay')
+        return map_img
+
+    # Renders overlays for many viewports (MapWorkers, or objects with gps_range and image/tilepath)
+    # from the one decoded frame of this worker, in a thread pool or with processes=True a process pool
+    # Returns the overlay images, or when paths are given writes one file per viewport and returns paths
+    def create_overlay_images(self, viewports, paths=None, workers=None, processes=False):
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before creating overlays')
+        jobs = [(self._viewport_image(viewport), viewport.gps_range) for viewport in viewports]
+        paths = list(paths) if paths is not None else [None] * len(jobs)
+        workers = workers or config.RENDER_WORKERS
+        logging.info(TAG+'rendering {} overlays'.format(len(jobs)))
+
+        if processes:
+            # Worker processes map the same stored grid, so the frame is not copied per process
+            jobs = [(np.asarray(image), image.mode, gps_range, path)
+                    for (image, gps_range), path in zip(jobs, paths)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=compositing.init_render_process,
+                                     initargs=(self.__frame_store.directory, self.__img_path,
+                                               self.__wld_path)) as executor:
+                return list(executor.map(compositing.render_overlay_job, jobs))
+
+        def render(job):
+            (image, gps_range), path = job
+            overlay = compositing.render_overlay(self.__frame, image, gps_range)
+            if path is None:
+                return overlay
+            with METRICS.timer('save'):
+                overlay.save(path, 'PNG')
+            return path
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(render, zip(jobs, paths)))
+
+    # Animates the IEM frames of [start, end] over the map of a viewport, see animation
+    # path is an .png/.apng or .gif file, or a directory for numbered frames
+    # Frames are rendered by a process pool and written as they finish, returns the times written
+    def export_animation(self, viewport, start, end, path, format=None, step=datetime.timedelta(minutes=5),
+                         delay_ms=None, workers=None):
+        frames = self.prefetch(start, end, step)
+        return animation.export_animation(self.__frame_store, frames, self._viewport_image(viewport),
+                                          viewport.gps_range, path, format, delay_ms, workers)
+
+    # Map image of a viewport, in memory when the viewport keeps one
+    @staticmethod
+    def _viewport_image(viewport):
+        image = getattr(viewport, 'image', None)
+        if image is None:
+            image = Image.open(viewport.tilepath)
+        return image
+
+
+    # Pre-renders the loaded frame into a z/x/y tile pyramid, see radartiles
+    # An already completed pyramid with the same zooms and tile size is reused
+    def create_tile_pyramid(self, directory=LOC_FOLS['radar-tiles'], min_zoom=config.RADAR_TILE_MIN_ZOOM,
+                            max_zoom=config.RADAR_TILE_MAX_ZOOM, size=config.RADAR_TILE_SIZE, workers=None):
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before creating tiles')
+        manifest = radartiles.read_manifest(directory, self.__frame.key)
+        if manifest is not None and (manifest['min_zoom'], manifest['max_zoom'], manifest['tile_size']) == \
+                (min_zoom, max_zoom, size):
+            return manifest
+        return radartiles.build_pyramid(self.__frame_store, self.__img_path, self.__wld_path, directory,
+                                        min_zoom, max_zoom, size, workers)
+
+    # Path of one radar tile of the loaded frame, None if the tile is empty
+    def get_radar_tile(self, z, x, y, directory=LOC_FOLS['radar-tiles']):
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before reading tiles')
+        return radartiles.get_tile(directory, self.__frame.key, z, x, y)
+
+    # Returns the reflectivity (dBZ) for a (lat, lon) tuple, or an array of dBZ for an Nx2 array
+    # Locations outside of the IEM range are returned as NaN
     def get_reflectivity(self, gps_location):
-        # Code to get the reflectivity for a given location at the sim_time
-        return None
+        pixels = self.gps_to_pixels(gps_location)
+        if np.ndim(gps_location) == 1:
+            pixels = pixels[0]
+        return self._get_reflectivity_of_pixel(pixels)
 
+    # Returns the reflectivity represented by an (x, y) pixel, or by each row of an Nx2 array
     def _get_reflectivity_of_pixel(self, pixel_location):
-        # Code to get the reflectivity represented by a certain pixel
-        return None
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before requesting reflectivity')
+        pixels = np.asarray(pixel_location, dtype=np.int64).reshape(-1, 2)
+        dbz = reflectivity.sample(self.__frame.grid, pixels[:, 0], pixels[:, 1])
+        if np.ndim(pixel_location) == 1:
+            return float(dbz[0])
+        return dbz
+
+    # Max dBZ, mean dBZ and fraction at or above each threshold within radius_nm of each (lat, lon)
+    # of an Nx2 array, on the loaded frame, see areaindex.AreaIndex.disk_stats
+    def get_disk_stats(self, gps_locations, radius_nm, thresholds=config.AREA_DBZ_THRESHOLDS):
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before requesting reflectivity')
+        return self.__frame.area_index(thresholds).disk_stats(gps_locations, radius_nm)
+
+    # Same as get_disk_stats within gps ranges ((lat_min, lat_max), (lon_min, lon_max))
+    def get_box_stats(self, gps_ranges, thresholds=config.AREA_DBZ_THRESHOLDS):
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before requesting reflectivity')
+        return self.__frame.area_index(thresholds).box_stats(gps_ranges)
+
+    # dBZ profile along a polyline of (lat, lon) waypoints on the loaded frame, see flightpath
+    def get_route_profile(self, waypoints, times=None, timeline=None):
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before requesting reflectivity')
+        return flightpath.route_profile(self.__frame, waypoints, times, timeline)
+
+    # Max dBZ and nm flown above each threshold for many routes on the loaded frame
+    def score_routes(self, routes, thresholds=config.ROUTE_DBZ_THRESHOLDS):
+        if self.__frame is None:
+            raise Exception('No IEM frame loaded, pull data before requesting reflectivity')
+        return flightpath.score_routes(self.__frame, routes, thresholds)
 
     # A to-string method 
     def __str__(self):
@@ -267,6 +356,18 @@ class RadarWorker:
 
         return printout
 
+    # Rounds a time to the nearest 5 minute increment, seconds are rounded to the nearest minute
+    @staticmethod
+    def snap_time(time):
+        minute = time.minute
+        if time.second >= 30:
+            minute += 1
+        if minute % 5 < 3:
+            minute -= minute % 5
+        else:
+            minute += 5 - minute % 5
+        return time.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(minutes=minute)
+
     # Simple sign-extension method
     @staticmethod
     def s_ext(str, length):
@@ -278,27 +379,20 @@ class RadarWorker:
     @staticmethod
     def cl_wd():
         logging.info(TAG+'clearing downloaded files')
-        for file in os.listdir(LOC_FOLS['nexrad']):
-            os.unlink(LOC_FOLS['nexrad']+file)
+        for file in os.listdir(LOC_FOLS['frame-cache']):
+            os.unlink(LOC_FOLS['frame-cache']+file)
 
     @staticmethod
     def apply_transparency_filter(img):
-        logging.info(TAG+'making all black pixels transparent')
-        img = img.convert('RGBA')
-        data = img.getdata()
-
-        new_data = list()
-        for item in data:
-            if item[0] == 0 and item[1] == 0 and item[2] == 0:
-                new_data.append((0, 0, 0, 0))
-            else:
-                new_data.append(item)
-
-        img.putdata(new_data)
-        return img
+        logging.debug(TAG+'making all black pixels transparent')
+        with METRICS.timer('filter'):
+            rgba = np.asarray(img.convert('RGBA'))
+            return Image.fromarray(compositing.apply_transparency_mask(rgba), 'RGBA')
 
 # Class to represent a radar station, originally in NEXRADWorker
 class RadarStation():
+    __slots__ = ('icao', 'state', '_elevation', '_latitude', '_longitude')
+
     def __init__(self, icao, state, elevation, latitude, longitude):
         self.icao = icao
         self.state = state
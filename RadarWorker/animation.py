@@ -0,0 +1,116 @@
+import logging, os, collections, config, compositing, framestore, pngwriter
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, GifImagePlugin
+from metrics import METRICS
+
+TAG = 'animation - '
+
+# Name of the numbered frames written in 'frames' format, e.g. for ffmpeg -i frame_%04d.png
+FRAME_NAME = 'frame_{:04d}.png'
+
+# Animations of IEM overlays over one map image, one frame per IEM frame
+#       - Frames are rendered by a process pool, each process gets the map mosaic once and maps
+#         the decoded grids from the frame store, frames never pass through the parent undecoded
+#       - Frames are encoded in the workers (PNG deflate, GIF quantization and LZW), the parent
+#         only writes them, in time order, as they finish
+#       - At most two frames per worker are in flight, the sequence is never held in memory
+# Formats are 'apng' (.png/.apng), 'gif' (.gif) or 'frames', a directory of numbered PNGs
+
+# State of a worker process, set by _init_process
+_process = {}
+
+# Format of an output path, by extension, paths without an extension are frame directories
+def format_of(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.png', '.apng'):
+        return 'apng'
+    if ext == '.gif':
+        return 'gif'
+    if ext == '':
+        return 'frames'
+    raise Exception('No animation format for {}'.format(path))
+
+# Pool initializer, keeps the map and the options for every frame of the process
+def _init_process(store_directory, map_array, mode, gps_range, format, delay_ms):
+    _process['store'] = framestore.FrameStore(store_directory)
+    _process['map'] = Image.fromarray(map_array, mode)
+    _process['gps_range'] = gps_range
+    _process['format'] = format
+    _process['delay_ms'] = delay_ms
+
+# Renders and encodes one (img path, wld path, output path) job in a worker process
+def _render_frame(job):
+    img_path, wld_path, path = job
+    frame = _process['store'].load(img_path, wld_path)
+    image = compositing.render_overlay(frame, _process['map'], _process['gps_range'])
+    with METRICS.timer('save'):
+        if _process['format'] == 'frames':
+            image.save(path, 'PNG')
+            return path
+        if _process['format'] == 'apng':
+            return pngwriter.compress(_frame_array(image))
+
+        # GIF frames carry their own color table, the header is the one of the first frame
+        image = image.convert('RGB').quantize(256)
+        header = b''.join(GifImagePlugin.getheader(image, info={'loop': 0})[0])
+        data = b''.join(GifImagePlugin.getdata(image, duration=_process['delay_ms'], include_color_table=True))
+        return header, data
+
+# RGB or RGBA array of an image, as written to an APNG
+def _frame_array(image):
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    return np.asarray(image)
+
+# Runs jobs in the pool, yields results in job order while keeping at most window jobs in flight
+def _ordered(executor, jobs, window):
+    pending = collections.deque()
+    for job in jobs:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(_render_frame, job))
+    while pending:
+        yield pending.popleft().result()
+
+# Writes an animation of frames, a dictionary of time -> (png, wld) paths, over map_img covering gps_range
+# Returns the times written, in order
+def export_animation(store, frames, map_img, gps_range, path, format=None, delay_ms=None, workers=None):
+    format = format or format_of(path)
+    if format not in ('apng', 'gif', 'frames'):
+        raise Exception('Unknown animation format {}'.format(format))
+    delay_ms = config.ANIMATION_FRAME_MS if delay_ms is None else delay_ms
+    workers = workers or config.RENDER_WORKERS
+    times = sorted(frames)
+    if not times:
+        raise Exception('No IEM frames to animate')
+    logging.info(TAG+'writing {} frames to {} as {}'.format(len(times), path, format))
+
+    if format == 'frames':
+        os.makedirs(path, exist_ok=True)
+        outputs = [os.path.join(path, FRAME_NAME.format(i)) for i in range(len(times))]
+    else:
+        outputs = [None] * len(times)
+    jobs = [tuple(frames[time]) + (output,) for time, output in zip(times, outputs)]
+
+    map_array = np.asarray(map_img)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_process,
+                             initargs=(store.directory, map_array, map_img.mode, gps_range,
+                                       format, delay_ms)) as executor:
+        results = _ordered(executor, jobs, 2 * workers)
+        if format == 'apng':
+            shape = _frame_array(map_img).shape
+            with pngwriter.APNGWriter(path, shape, len(jobs), delay_ms) as writer:
+                for data in results:
+                    writer.add(data)
+        elif format == 'gif':
+            with open(path, 'wb') as writer:
+                for i, (header, data) in enumerate(results):
+                    if i == 0:
+                        writer.write(header)
+                    writer.write(data)
+                writer.write(b';')
+        else:
+            for result in results:
+                logging.debug(TAG+'wrote '+result)
+    return times
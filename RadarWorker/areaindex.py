@@ -0,0 +1,281 @@
+import math
+import numpy as np
+import config, reflectivity
+from stationindex import EARTH_RADIUS_NM
+
+TAG = 'AreaIndex - '
+
+# Nautical miles per degree of latitude, on the sphere used by stationindex
+NM_PER_DEGREE = EARTH_RADIUS_NM * math.pi / 180
+
+# Number of partial cells scanned at once, bounds the memory of a batch of queries
+SCAN_CHUNK = 4096
+
+# Tables over one frame for area queries: max dBZ, mean dBZ and coverage at or above thresholds
+#       - The grid is cut in square cells, each cell keeps its max palette index, a max pyramid
+#         halves the cells up to a single one, summed-area tables hold index sums and the counts
+#         of pixels at or above each threshold
+#       - Row sparse tables give the max of any run of cells within a row with two lookups
+#       - A shape is split in runs of cells fully inside of it, answered from the tables, and the
+#         partial cells along its edge, which are scanned pixel by pixel, so results are exact
+#       - The pyramid bounds the max around every shape first, shapes with no echo around them
+#         (the bulk of a CONUS composite) are answered from that bound alone
+#       - Queries are vectorized over any number of shapes
+# Boxes cover the pixel window of GeoTransform.window, disks the pixels whose center is within
+# the radius, with distances on a local flat earth around the center of the disk
+class AreaIndex:
+    def __init__(self, grid, transform, cell=None, thresholds=None):
+        self.__grid = grid
+        self.__transform = transform
+        self.__cell = cell or config.AREA_CELL
+        self.__thresholds = tuple(config.AREA_DBZ_THRESHOLDS if thresholds is None else thresholds)
+        self.__levels = reflectivity.dbz_to_index(self.__thresholds).reshape(-1)
+        if len(self.__levels) and self.__levels.min() == 0:
+            raise Exception('Coverage thresholds must be above {} dBZ'.format(reflectivity.N0Q_MIN_DBZ))
+        self._build()
+
+    # AreaIndex of a DecodedFrame
+    @classmethod
+    def from_frame(cls, frame, cell=None, thresholds=None):
+        return cls(frame.grid, frame.transform, cell, thresholds)
+
+    @property
+    def cell(self):
+        return self.__cell
+
+    @property
+    def thresholds(self):
+        return self.__thresholds
+
+    # Bytes held by the tables, the grid itself is not counted
+    @property
+    def nbytes(self):
+        tables = [self.__sums, self.__counts] + self.__pyramid + self.__runs[1:]
+        return sum(table.nbytes for table in tables)
+
+    # Cell maxima, sums and counts one row of cells at a time, then the pyramid and the sparse tables
+    def _build(self):
+        cell = self.__cell
+        height, width = self.__grid.shape
+        rows, columns = -(-height // cell), -(-width // cell)
+        maxima = np.empty((rows, columns), dtype=np.uint8)
+        sums = np.zeros((rows + 1, columns + 1), dtype=np.int64)
+        counts = np.zeros((len(self.__levels), rows + 1, columns + 1), dtype=np.int32)
+
+        strip = np.empty((cell, columns * cell), dtype=np.uint8)
+        for row in range(rows):
+            lines = self.__grid[row * cell:(row + 1) * cell, 0:width]
+            strip[:] = 0
+            strip[:len(lines), :width] = lines
+            tiles = strip.reshape(cell, columns, cell)
+            maxima[row] = tiles.max(axis=(0, 2))
+            # Cells without echo add nothing to the sums and counts
+            echo = np.flatnonzero(maxima[row])
+            if len(echo) == 0:
+                continue
+            sums[row + 1, echo + 1] = tiles[:, echo].sum(axis=(0, 2), dtype=np.int64)
+            for i, level in enumerate(self.__levels):
+                hit = echo[maxima[row, echo] >= level]
+                counts[i, row + 1, hit + 1] = (tiles[:, hit] >= level).sum(axis=(0, 2))
+        np.cumsum(sums, axis=0, out=sums)
+        np.cumsum(sums, axis=1, out=sums)
+        np.cumsum(counts, axis=1, out=counts)
+        np.cumsum(counts, axis=2, out=counts)
+
+        pyramid = [maxima]
+        while max(pyramid[-1].shape) > 1:
+            level = pyramid[-1]
+            padded = np.zeros((-(-level.shape[0] // 2) * 2, -(-level.shape[1] // 2) * 2), dtype=np.uint8)
+            padded[:level.shape[0], :level.shape[1]] = level
+            pyramid.append(padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3)))
+
+        # runs[k][row, column] is the max of the 2**k cells starting at column
+        runs = [maxima]
+        while 2 ** len(runs) <= columns:
+            half = 2 ** (len(runs) - 1)
+            runs.append(np.maximum(runs[-1][:, :-half], runs[-1][:, half:]))
+
+        self.__maxima, self.__sums, self.__counts = maxima, sums, counts
+        self.__pyramid, self.__runs = pyramid, runs
+
+    # Max dBZ, mean dBZ and coverage within boxes ((lat_min, lat_max), (lon_min, lon_max))
+    # Returns (max_dbz, mean_dbz, coverage) with shapes (boxes,), (boxes,) and (boxes, thresholds),
+    # coverage is the fraction of the pixels of each box at or above each threshold
+    # All are NaN for boxes entirely outside of the frame
+    def box_stats(self, bboxes):
+        cell = self.__cell
+        left, upper, right, lower = self.__transform.windows(bboxes, self.__grid.shape).T
+        queries = np.arange(len(left))
+        pixels = (right - left) * (lower - upper)
+        window = (upper // cell, -(-lower // cell), left // cell, -(-right // cell))
+
+        # Cells fully inside, with no inner cell every cell of the window is partial
+        r0, r1, c0, c1 = window
+        i0, i1 = -(-upper // cell), lower // cell
+        j0, j1 = -(-left // cell), right // cell
+        empty = (i1 <= i0) | (j1 <= j0)
+        i0, i1 = np.where(empty, r1, i0), np.where(empty, r1, i1)
+        runs = (queries, i0, i1, j0, j1)
+        partial = _concatenate(_expand(queries, r0, i0, c0, c1), _expand(queries, i1, r1, c0, c1),
+                               _expand(queries, i0, i1, c0, j0), _expand(queries, i0, i1, j1, c1))
+
+        def inside(query, y, x):
+            return (y >= upper[query]) & (y < lower[query]) & (x >= left[query]) & (x < right[query])
+        return self._stats(pixels, window, runs, partial, inside)
+
+    # Max dBZ, mean dBZ and coverage within radius_nm of each (lat, lon) of an Nx2 array
+    # radius_nm is one radius or one per center, results are as for box_stats
+    def disk_stats(self, centers, radius_nm):
+        cell = self.__cell
+        height, width = self.__grid.shape
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        radius = np.broadcast_to(np.asarray(radius_nm, dtype=np.float64), len(centers))
+        fx, fy = self.__transform.gps_to_fractional(centers).T
+
+        # Squared distance of a pixel offset (dx, dy) is A dx^2 + 2B dx dy + C dy^2
+        t = self.__transform
+        cos_lat = np.cos(np.radians(centers[:, 0]))
+        scale = NM_PER_DEGREE ** 2
+        a = scale * (t.d ** 2 + (cos_lat * t.a) ** 2)
+        b = scale * (t.d * t.e + cos_lat ** 2 * t.a * t.b)
+        c = scale * (t.e ** 2 + (cos_lat * t.b) ** 2)
+        det = a * c - b * b
+        extent = radius * np.sqrt(a / det)
+
+        # Pixel rows crossed by each disk, and the columns of their centers inside of it
+        top = np.clip(np.ceil(fy - 0.5 - extent), 0, height).astype(np.int64)
+        bottom = np.clip(np.floor(fy - 0.5 + extent) + 1, 0, height).astype(np.int64)
+        nrows = np.maximum(bottom - top, 0)
+        starts = np.cumsum(nrows) - nrows
+        query = np.repeat(np.arange(len(centers)), nrows)
+        y = top[query] + np.arange(len(query)) - starts[query]
+        dy = y + 0.5 - fy[query]
+        root = np.sqrt(np.maximum(radius[query] ** 2 * a[query] - det[query] * dy ** 2, 0))
+        offset = fx[query] - 0.5
+        first = np.maximum(np.ceil((-b[query] * dy - root) / a[query] + offset), 0).astype(np.int64)
+        last = np.minimum(np.floor((-b[query] * dy + root) / a[query] + offset), width - 1).astype(np.int64)
+        pixels = np.bincount(query, weights=np.maximum(last - first + 1, 0), minlength=len(centers)).astype(np.int64)
+
+        # Group the rows by row of cells: cells where every row is inside are inner cells,
+        # the cells holding any other pixel of the disk are partial
+        band = y // cell
+        group = np.flatnonzero(np.diff(np.concatenate(([-1], query * (height + 1) + band))))
+        size = np.diff(np.append(group, len(query)))
+        filled = last >= first
+        g_query, g_row = query[group], band[group]
+        outer_first = np.minimum.reduceat(np.where(filled, first, width), group) // cell
+        outer_last = np.maximum.reduceat(np.where(filled, last, -1), group) // cell + 1
+        inner_first = -(-np.maximum.reduceat(first, group) // cell)
+        inner_last = (np.minimum.reduceat(last, group) + 1) // cell
+        inner = (size == cell) & (inner_last > inner_first)
+        inner_first = np.where(inner, inner_first, outer_last)
+        inner_last = np.where(inner, inner_last, outer_last)
+
+        runs = (g_query, g_row, g_row + 1, inner_first, inner_last)
+        partial = _concatenate(_expand(g_query, g_row, g_row + 1, outer_first, inner_first),
+                               _expand(g_query, g_row, g_row + 1, inner_last, outer_last))
+        c0, c1 = np.full(len(centers), width, dtype=np.int64), np.zeros(len(centers), dtype=np.int64)
+        np.minimum.at(c0, g_query, outer_first)
+        np.maximum.at(c1, g_query, outer_last)
+
+        def inside(q, y, x):
+            row = y - top[q]
+            index = np.clip(starts[q] + row, 0, max(len(query) - 1, 0))
+            return (row >= 0) & (row < nrows[q]) & (x >= first[index]) & (x <= last[index])
+        return self._stats(pixels, (top // cell, -(-bottom // cell), c0, c1), runs, partial, inside)
+
+    # Max of the cells of windows [r0, r1) x [c0, c1), an upper bound of the max of any shape
+    # inside of them, from at most 2 x 2 cells of the pyramid level the windows fit in
+    def _upper_bound(self, r0, r1, c0, c1):
+        bound = np.zeros(len(r0), dtype=np.uint8)
+        span = np.maximum(r1 - r0, c1 - c0)
+        valid = (r1 > r0) & (c1 > c0)
+        level = np.zeros(len(r0), dtype=np.int64)
+        level[valid] = np.ceil(np.log2(span[valid])).astype(np.int64)
+        for k in np.unique(level[valid]):
+            select = valid & (level == k)
+            pyramid = self.__pyramid[min(k, len(self.__pyramid) - 1)]
+            top, bottom = r0[select] >> k, (r1[select] - 1) >> k
+            left, right = c0[select] >> k, (c1[select] - 1) >> k
+            bottom, right = np.minimum(bottom, pyramid.shape[0] - 1), np.minimum(right, pyramid.shape[1] - 1)
+            bound[select] = np.maximum(np.maximum(pyramid[top, left], pyramid[top, right]),
+                                       np.maximum(pyramid[bottom, left], pyramid[bottom, right]))
+        return bound
+
+    # Max of runs of cells [c0, c1) within single rows, all runs non empty
+    def _run_max(self, rows, c0, c1):
+        best = np.empty(len(rows), dtype=np.uint8)
+        level = np.floor(np.log2(c1 - c0)).astype(np.int64)
+        for k in np.unique(level):
+            select = level == k
+            table = self.__runs[k]
+            best[select] = np.maximum(table[rows[select], c0[select]], table[rows[select], c1[select] - 2 ** k])
+        return best
+
+    # Sums the tables over inner runs and scans the partial cells
+    # runs are (query, r0, r1, c0, c1) rectangles of cells, partial (query, row, column) cells
+    def _stats(self, pixels, window, runs, partial, inside):
+        count = len(pixels)
+        cell = self.__cell
+        height, width = self.__grid.shape
+        best = np.zeros(count, dtype=np.uint8)
+        sums = np.zeros(count, dtype=np.float64)
+        counts = np.zeros((len(self.__levels), count), dtype=np.float64)
+
+        # Shapes without echo around them are done: max and mean are the bottom of the scale
+        active = (self._upper_bound(*window) > 0) & (pixels > 0)
+
+        query, r0, r1, c0, c1 = runs
+        keep = active[query] & (r1 > r0) & (c1 > c0)
+        query, r0, r1, c0, c1 = query[keep], r0[keep], r1[keep], c0[keep], c1[keep]
+        sums += np.bincount(query, weights=_area_sum(self.__sums, r0, r1, c0, c1), minlength=count)
+        for i in range(len(self.__levels)):
+            counts[i] += np.bincount(query, weights=_area_sum(self.__counts[i], r0, r1, c0, c1), minlength=count)
+        heights = r1 - r0
+        owner = np.repeat(np.arange(len(query)), heights)
+        rows = r0[owner] + np.arange(len(owner)) - np.repeat(np.cumsum(heights) - heights, heights)
+        np.maximum.at(best, query[owner], self._run_max(rows, c0[owner], c1[owner]))
+
+        # Partial cells without echo add nothing, the others are scanned pixel by pixel
+        query, rows, columns = partial
+        keep = active[query]
+        keep[keep] = self.__maxima[rows[keep], columns[keep]] > 0
+        query, rows, columns = query[keep], rows[keep], columns[keep]
+        offsets = np.arange(cell)
+        for start in range(0, len(query), SCAN_CHUNK):
+            q = query[start:start + SCAN_CHUNK, np.newaxis, np.newaxis]
+            y = rows[start:start + SCAN_CHUNK, np.newaxis, np.newaxis] * cell + offsets[:, np.newaxis]
+            x = columns[start:start + SCAN_CHUNK, np.newaxis, np.newaxis] * cell + offsets
+            values = self.__grid[np.minimum(y, height - 1), np.minimum(x, width - 1)]
+            values = np.where((y < height) & (x < width) & inside(q, y, x), values, 0)
+            q = q.ravel()
+            sums += np.bincount(q, weights=values.sum(axis=(1, 2), dtype=np.int64), minlength=count)
+            for i, level in enumerate(self.__levels):
+                counts[i] += np.bincount(q, weights=(values >= level).sum(axis=(1, 2)), minlength=count)
+            np.maximum.at(best, q, values.max(axis=(1, 2)))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            max_dbz = reflectivity.index_to_dbz(best)
+            mean_dbz = (reflectivity.N0Q_MIN_DBZ + reflectivity.N0Q_STEP_DBZ * sums / pixels).astype(np.float32)
+            coverage = (counts / pixels).T
+        outside = pixels == 0
+        max_dbz[outside] = np.nan
+        mean_dbz[outside] = np.nan
+        coverage[outside] = np.nan
+        return max_dbz, mean_dbz, coverage
+
+# Sums of summed-area tables over rectangles [r0, r1) x [c0, c1)
+def _area_sum(table, r0, r1, c0, c1):
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+# (query, row, column) of every cell of rectangles [r0, r1) x [c0, c1) of cells, one per query id
+def _expand(query, r0, r1, c0, c1):
+    heights, widths = np.maximum(r1 - r0, 0), np.maximum(c1 - c0, 0)
+    sizes = heights * widths
+    owner = np.repeat(np.arange(len(query)), sizes)
+    offset = np.arange(len(owner)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    widths = widths[owner]
+    return query[owner], r0[owner] + offset // widths, c0[owner] + offset % widths
+
+def _concatenate(*cells):
+    return tuple(np.concatenate(parts) for parts in zip(*cells))
@@ -0,0 +1,50 @@
+import logging
+
+TAG = 'baseline_sort - '
+
+# DataWorker.quicksort_lg as it was before the sort subsystem, kept so benchmarks time the
+# original algorithm against the current one. Reading (get_vals), parsing and formatting go
+# through the DataWorker, those methods are unchanged since, only the sort is frozen here
+#       - Every line is parsed into memory, then sorted by a recursive quicksort (not stable,
+#         the pivot is the last element of each range)
+# Sorted input recurses once per line, only use it on shuffled files
+def quicksort_lg(worker, input_file, output_file, label, str_flt_conv=True):
+    logging.info(TAG+'starting quicksort of ' + input_file)
+    # Convert sorted element from a string to float
+    def convert_elements(datalist, index):
+        for elem in datalist:
+            elem[index] = worker.str_to_flt(elem[index])
+        return datalist
+
+    # Partitioning, all values before trail are less than pivot value at lst[end]
+    def partition(lst, strt, end, int_indx):
+        trail = leader = strt
+        while leader < end:
+            if lst[leader][int_indx] <= lst[end][int_indx]:
+                lst[trail], lst[leader] = lst[leader], lst[trail]
+                trail += 1
+            leader += 1
+        lst[trail], lst[end] = lst[end], lst[trail]
+        return trail
+
+    # Actual recursive quicksort
+    def quicksort(lst, strt, end, int_index):
+        if strt >= end:
+            return
+        pivot = partition(lst, strt, end, int_index)
+        quicksort(lst, strt, pivot-1, int_index)
+        quicksort(lst, pivot+1, end, int_index)
+
+    # List of lists, each for substation
+    datalist = worker.get_vals(input_file, worker.labels)
+    index = worker.labels.index(label)
+    if str_flt_conv:
+        datalist = convert_elements(datalist, index)
+
+    # Performing the sort
+    quicksort(datalist, 0, len(datalist)-1, index)
+
+    with open(output_file, 'w') as writer:
+        for term in datalist:
+            writer.write(worker.lst_to_line(term, 10) + '\n')
+    logging.info(TAG+'quicksort complete')
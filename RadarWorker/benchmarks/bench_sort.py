@@ -0,0 +1,67 @@
+import argparse, json, logging, os, sys, tempfile, time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from txtparsing import DataWorker
+
+TAG = 'bench_sort - '
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'data', 'meta-data', 'nexrad-stations-template.txt')
+
+# Benchmarks DataWorker.sort_file on synthetic fixed width station files
+# Run from anywhere: python benchmarks/bench_sort.py --rows 10000000 --output sort.json
+
+# Writes rows random station lines following the station template
+def write_synthetic(path, rows, seed=0, batch=100000):
+    rng = np.random.default_rng(seed)
+    states = np.array(['AK', 'AZ', 'CA', 'CO', 'FL', 'HI', 'KS', 'NY', 'OK', 'TX'])
+    with open(path, 'w') as writer:
+        for start in range(0, rows, batch):
+            count = min(batch, rows - start)
+            ids = np.arange(start, start + count) + 30000000
+            lats = rng.uniform(18, 65, count).round(5)
+            lons = rng.uniform(-166, -65, count).round(5)
+            elevs = rng.integers(0, 3500, count)
+            state = rng.choice(states, count)
+            lines = ['{:<8d} K{:03d} {:<5d} {:<30s} {:<20s} {} {:<30s} {:<9.5f} {:<10.5f} {:<6d} {:<5d} {:<6s}'.format(
+                         ids[i], i % 1000, i % 100000, 'SYNTHETIC', 'UNITED STATES', state[i], 'COUNTY',
+                         lats[i], lons[i], elevs[i], -6, 'NEXRAD') for i in range(count)]
+            writer.write('\n'.join(lines) + '\n')
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DataWorker sort subsystem')
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--budget', type=int, default=64 * 1024**2, help='memory budget in bytes')
+    parser.add_argument('--output', help='json file for the results, stdout by default')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    worker = DataWorker(TEMPLATE)
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'stations.txt')
+        target = os.path.join(directory, 'sorted.txt')
+
+        results = {'rows': args.rows, 'budget': args.budget}
+        results['generate_s'] = timed(write_synthetic, source, args.rows)
+        results['input_bytes'] = os.path.getsize(source)
+        results['sort_longitude_s'] = timed(worker.sort_file, source, target, 'longitude',
+                                            memory_budget=args.budget)
+        results['sort_sorted_input_s'] = timed(worker.sort_file, target, source, 'longitude',
+                                               memory_budget=args.budget)
+        results['sort_state_latitude_s'] = timed(worker.sort_file, source, target, ['state', 'latitude'],
+                                                 memory_budget=args.budget)
+        results['rows_per_s'] = args.rows / results['sort_longitude_s']
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as writer:
+            writer.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
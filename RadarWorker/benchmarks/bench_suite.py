@@ -0,0 +1,294 @@
+import argparse, datetime, hashlib, io, json, logging, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_sort import write_synthetic
+import baseline_sort
+
+TAG = 'bench_suite - '
+
+# Offline benchmarks of the RadarWorker hot paths, over the committed fixtures
+#       - Runs in a scratch copy of the data folders, nothing in the repository is written
+#       - The IEM frame comes from data/nexrad-data, map tiles are seeded from data/map-data
+#       - Any network access raises, so a run never depends on IEM or GBIF
+#       - Synthetic station files and larger synthetic frames are generated per run
+# Run from anywhere: python benchmarks/bench_suite.py --output results.json
+# Compare two runs with: python benchmarks/bench_suite.py --compare old.json new.json
+
+FIXTURE_TIME = datetime.datetime(2020, 1, 3, 2, 0)
+SYNTHETIC_TIME = datetime.datetime(2020, 1, 3, 2, 5)
+FIXTURE_KEY = 'n0q_202001030200'
+
+# Coordinate used by tester.py, its rectangular zoom 0 tile is the committed 0+0.png and 1+0.png
+MAP_COORDINATE = [44.971666, -70.919625]
+MAP_TILES = {(0, 0, 0): '0+0.png', (0, 1, 0): '1+0.png'}
+
+# Overlay viewport over the central US, a zoom 0 mosaic would need a 72000x36000 canvas
+VIEWPORT_RANGE = ((30.0, 40.0), (-100.0, -80.0))
+VIEWPORT_SIZE = (1024, 512)
+
+# Map viewport for overlays: a gps range and the map image covering it
+class Viewport:
+    def __init__(self, gps_range, image):
+        self.gps_range = gps_range
+        self.image = image
+
+# Crops the part of a mosaic covering gps_range and scales it to size
+def crop_viewport(image, mosaic_range, gps_range, size):
+    (m_lat_min, m_lat_max), (m_lon_min, m_lon_max) = mosaic_range
+    (lat_min, lat_max), (lon_min, lon_max) = gps_range
+    width, height = image.size
+    box = (round((lon_min - m_lon_min) / (m_lon_max - m_lon_min) * width),
+           round((m_lat_max - lat_max) / (m_lat_max - m_lat_min) * height),
+           round((lon_max - m_lon_min) / (m_lon_max - m_lon_min) * width),
+           round((m_lat_max - lat_min) / (m_lat_max - m_lat_min) * height))
+    return Viewport(gps_range, image.crop(box).resize(size, Image.LANCZOS))
+
+# Session used in place of requests, the suite must not touch the network
+class OfflineSession:
+    def get(self, url, **kwargs):
+        raise Exception('benchmarks run offline, refused to fetch '+url)
+
+def offline_fetch(style, z, x, y):
+    raise Exception('benchmarks run offline, map tile {}/{}/{}/{} is not seeded'.format(style, z, x, y))
+
+# Copies the fixtures into a scratch working directory laid out like LOC_FOLS
+def prepare_workspace(directory):
+    data = os.path.join(ROOT, 'data')
+    for folder in ['nexrad-data', 'frame-cache', 'map-data', 'meta-data', 'frame-data', 'radar-tiles']:
+        os.makedirs(os.path.join(directory, 'data', folder), exist_ok=True)
+    # The fixture frame is also seeded in the frame cache, so pulling it does not download it
+    for folder in ['nexrad-data', 'frame-cache']:
+        for ext in ['.png', '.txt']:
+            shutil.copy(os.path.join(data, 'nexrad-data', FIXTURE_KEY + ext),
+                        os.path.join(directory, 'data', folder))
+    for file in os.listdir(os.path.join(data, 'meta-data')):
+        if file.endswith('.txt'):
+            shutil.copy(os.path.join(data, 'meta-data', file), os.path.join(directory, 'data', 'meta-data'))
+    for (z, x, y), file in MAP_TILES.items():
+        target = os.path.join(directory, 'data', 'map-data', 'tiles', 'osm-bright', str(z), str(x))
+        os.makedirs(target, exist_ok=True)
+        shutil.copy(os.path.join(data, 'map-data', file), os.path.join(target, '{}.png'.format(y)))
+
+# Adds a frame scale times wider and taller than the fixture to the frame cache, same pixel size
+def write_synthetic_frame(frame_cache, directory, scale):
+    source = os.path.join(directory, 'data', 'nexrad-data', FIXTURE_KEY)
+    im = Image.open(source + '.png')
+    grid = np.tile(np.asarray(im), (scale, scale))
+    big = Image.fromarray(grid, 'P')
+    big.putpalette(im.getpalette())
+    png = io.BytesIO()
+    big.save(png, 'PNG')
+    with open(source + '.txt', 'rb') as reader:
+        frame_cache.put('n0q', SYNTHETIC_TIME, png.getvalue(), reader.read())
+    return grid.shape
+
+# Times function repeat times, setup runs before each call and is not timed
+def measure(function, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'repeat': repeat, 'best_s': min(times), 'median_s': statistics.median(times),
+            'mean_s': statistics.mean(times)}
+
+def digest(image):
+    return hashlib.sha1(np.ascontiguousarray(np.asarray(image)).tobytes()).hexdigest()
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Runs every benchmark, returns the results dictionary
+def run(args, directory):
+    prepare_workspace(directory)
+    os.chdir(directory)
+
+    # Imported once the working directory holds the fixtures, LOC_FOLS paths are relative
+    import config, areaindex, compositing, framecache, framestore, remap, sparsegrid
+    from txtparsing import DataWorker
+    # The module file is workers/mapworker.py, name it in lowercase so case-sensitive file systems find it
+    from workers import mapworker as MapWorker, tilecache
+    from RadarWorker import RadarWorker
+
+    LOC_FOLS = config.LOC_FOLS
+    MapWorker.TILE_CACHE = tilecache.TileCache(LOC_FOLS['tiles'], offline_fetch, config.TILE_CACHE_IMAGES)
+    frame_cache = framecache.FrameCache(LOC_FOLS['frame-cache'], config.FRAME_CACHE_BYTES)
+    session = OfflineSession()
+    results = {}
+
+    def radar_worker(sim_time, store_directory):
+        return RadarWorker(sim_time, frame_cache=frame_cache, session=session,
+                           frame_store=framestore.FrameStore(store_directory))
+
+    # Station file parsing and sorting, on a synthetic file following the station template
+    # quicksort_lg_baseline is the recursive quicksort quicksort_lg used to be, see baseline_sort
+    template = os.path.join(LOC_FOLS['meta'], 'nexrad-stations-template.txt')
+    worker = DataWorker(template)
+    stations = os.path.join(directory, 'stations.txt')
+    write_synthetic(stations, args.stations)
+    results['quicksort_lg_baseline'] = measure(
+        lambda: baseline_sort.quicksort_lg(worker, stations, stations + '.baseline', 'longitude'), args.repeat)
+    results['quicksort_lg_baseline']['rows'] = args.stations
+    results['quicksort_lg'] = measure(lambda: worker.quicksort_lg(stations, stations + '.sorted', 'longitude'),
+                                      args.repeat)
+    results['quicksort_lg']['rows'] = args.stations
+    results['get_vals'] = measure(lambda: worker.get_vals(stations, ['icao', 'latitude', 'longitude']),
+                                  args.repeat)
+    results['get_vals']['rows'] = args.stations
+
+    # World file processing, first with a png decode then with the stored grid mapped
+    store_root = os.path.join(directory, 'stores')
+    counter = [0]
+    def fresh_store():
+        counter[0] += 1
+        shutil.rmtree(store_root, ignore_errors=True)
+    results['process_wld_decode'] = measure(
+        lambda: radar_worker(FIXTURE_TIME, os.path.join(store_root, str(counter[0]))).pull_data(),
+        args.repeat, fresh_store)
+    warm_store = os.path.join(directory, 'data', 'frame-data')
+    radar = radar_worker(FIXTURE_TIME, warm_store)
+    radar.pull_data()
+    results['process_wld_mapped'] = measure(radar._process_wld, args.repeat)
+
+    # Pixel lookups, one call per point and one batch call
+    rng = np.random.default_rng(0)
+    points = np.column_stack((rng.uniform(23, 50, args.points), rng.uniform(-126, -65, args.points)))
+    single = points[:10000].tolist()
+    results['gps_to_pixel'] = measure(lambda: [radar.gps_to_pixel(point) for point in single], args.repeat)
+    results['gps_to_pixel']['points'] = len(single)
+    results['gps_to_pixels'] = measure(lambda: radar.gps_to_pixels(points), args.repeat)
+    results['gps_to_pixels']['points'] = args.points
+    results['get_reflectivity'] = measure(lambda: radar.get_reflectivity(points), args.repeat)
+    results['get_reflectivity']['points'] = args.points
+
+    # Transparency filter over the whole fixture frame
+    iem = Image.open(os.path.join(LOC_FOLS['nexrad'], FIXTURE_KEY + '.png'))
+    iem.load()
+    filtered = []
+    results['apply_transparency_filter'] = measure(
+        lambda: filtered.append(RadarWorker.apply_transparency_filter(iem)), args.repeat, filtered.clear)
+    results['apply_transparency_filter']['sha1'] = digest(filtered[-1])
+
+    # Map mosaics from the seeded tile cache, with the decoded tiles dropped and kept
+    map_worker = MapWorker.MapWorker(MAP_COORDINATE)
+    results['get_rect_tile_cold'] = measure(map_worker.get_rect_tile, args.repeat,
+                                            MapWorker.TILE_CACHE.clear_memory)
+    results['get_rect_tile_warm'] = measure(map_worker.get_rect_tile, args.repeat)
+
+    # Overlays, the output digest catches rendering changes between commits
+    viewport = crop_viewport(map_worker.image, map_worker.gps_range, VIEWPORT_RANGE, VIEWPORT_SIZE)
+    overlays = []
+    results['create_overlay_image'] = measure(
+        lambda: overlays.append(radar.create_overlay_image(viewport)), args.repeat, overlays.clear)
+    results['create_overlay_image']['sha1'] = digest(overlays[-1])
+    results['create_overlay_image_no_save'] = measure(lambda: radar.create_overlay_image(viewport, None),
+                                                      args.repeat)
+
+    # Block-sparse frame, memory against the dense forms, then lookups and overlays on the compact grid
+    sparse = sparsegrid.compact(radar.frame)
+    results['sparse_compact'] = measure(lambda: sparsegrid.compact(radar.frame), args.repeat)
+    results['sparse_compact'].update(sparse.grid.memory())
+    results['sparse_get_reflectivity'] = measure(lambda: sparse.get_reflectivity(points), args.repeat)
+    results['sparse_get_reflectivity']['points'] = args.points
+    results['sparse_render_overlay'] = measure(
+        lambda: compositing.render_overlay(sparse, viewport.image, viewport.gps_range), args.repeat)
+    results['sparse_render_overlay']['sha1'] = digest(
+        compositing.render_overlay(sparse, viewport.image, viewport.gps_range))
+
+    # Overlay through a remap table, built on the cold run and reused after, against the resize path
+    reference = np.asarray(compositing.render_overlay(radar.frame, viewport.image, viewport.gps_range))
+    results['remap_overlay_cold'] = measure(
+        lambda: remap.RemapRenderer(cache=remap.RemapCache()).render(radar.frame, viewport.image, viewport.gps_range),
+        args.repeat)
+    renderer = remap.RemapRenderer(cache=remap.RemapCache())
+    remapped = renderer.render(radar.frame, viewport.image, viewport.gps_range)
+    results['remap_overlay_warm'] = measure(
+        lambda: renderer.render(radar.frame, viewport.image, viewport.gps_range), args.repeat)
+    results['remap_overlay_warm']['mean_abs_diff'] = float(
+        np.abs(np.asarray(remapped).astype(np.int16) - reference).mean())
+
+    # Area tables of the fixture frame, then max/mean/coverage for alerting disks and sector boxes
+    results['area_index'] = measure(lambda: areaindex.AreaIndex.from_frame(radar.frame), args.repeat)
+    results['area_index']['bytes'] = areaindex.AreaIndex.from_frame(radar.frame).nbytes
+    centers = points[:10000]
+    boxes = [((lat, lat + 2.0), (lon, lon + 3.0)) for lat, lon in points[:1000]]
+    results['get_disk_stats'] = measure(lambda: radar.get_disk_stats(centers, 20.0), args.repeat)
+    results['get_disk_stats']['disks'] = len(centers)
+    results['get_box_stats'] = measure(lambda: radar.get_box_stats(boxes), args.repeat)
+    results['get_box_stats']['boxes'] = len(boxes)
+
+    # Larger synthetic frame, scale times the fixture in both directions
+    if args.frame_scale > 1:
+        # Scaled frames pass PIL's decompression bomb limit, they are generated here so trusted
+        Image.MAX_IMAGE_PIXELS = None
+        shape = write_synthetic_frame(frame_cache, directory, args.frame_scale)
+        results['process_wld_decode_synthetic'] = measure(
+            lambda: radar_worker(SYNTHETIC_TIME, os.path.join(store_root, str(counter[0]))).pull_data(),
+            args.repeat, fresh_store)
+        results['process_wld_decode_synthetic']['shape'] = list(shape)
+        big = radar_worker(SYNTHETIC_TIME, warm_store)
+        big.pull_data()
+        results['create_overlay_image_synthetic'] = measure(lambda: big.create_overlay_image(viewport, None),
+                                                            args.repeat)
+        shutil.rmtree(store_root, ignore_errors=True)
+    return results
+
+# Prints the change of every benchmark between two result files, using the best times
+def compare(old_path, new_path):
+    with open(old_path, 'r') as reader:
+        old = json.load(reader)['results']
+    with open(new_path, 'r') as reader:
+        new = json.load(reader)['results']
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]['best_s'], new[name]['best_s']
+        line = '{:<34s} {:>10.4f}s {:>10.4f}s {:>8.2f}x'.format(name, before, after, before / after if after else 0)
+        if old[name].get('sha1') != new[name].get('sha1'):
+            line += '  output changed'
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the RadarWorker hot paths')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--stations', type=int, default=100000, help='rows of the synthetic station file')
+    parser.add_argument('--points', type=int, default=1000000, help='points of the batch lookups')
+    parser.add_argument('--frame-scale', type=int, default=2, help='synthetic frame size, 1 to skip it')
+    parser.add_argument('--output', help='json file for the results, stdout by default')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    logging.disable(logging.INFO)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            results = run(args, directory)
+        finally:
+            os.chdir(cwd)
+
+    import PIL
+    output = json.dumps({'commit': git_commit(), 'date': datetime.datetime.now().isoformat(),
+                         'python': platform.python_version(), 'numpy': np.__version__,
+                         'pillow': PIL.__version__, 'machine': platform.machine(),
+                         'arguments': {name: value for name, value in vars(args).items()
+                                       if name not in ('output', 'compare')},
+                         'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as writer:
+            writer.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
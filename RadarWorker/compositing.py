@@ -0,0 +1,271 @@
+import logging, math
+import numpy as np
+from PIL import Image
+import framestore
+from metrics import METRICS
+
+TAG = 'compositing - '
+
+# Color used to tint areas where IEM furnishes no data
+NO_DATA_COLOR = (230, 14, 14, 90)
+
+# Array based compositing engine used by the RadarWorker to build overlays
+#       - All images are handled as (height, width, bands) uint8 arrays
+#       - Blending reproduces the integer arithmetic of PIL's Image.paste with a mask,
+#         so results are pixel for pixel identical to the PIL based path
+
+# Pixels blended at once by paste, bounds its uint32 temporaries whatever the size of the images
+BLEND_PIXELS = 1 << 18
+
+# Integer division by 255 with rounding, same approximation PIL uses internally
+def div255(values):
+    tmp = values + 128
+    return ((tmp >> 8) + tmp) >> 8
+
+# Builds a (256, 4) RGBA lookup table from the palette of a 'P' mode image
+# Palette entries that are pure black are made fully transparent when transparent_black is set
+def palette_rgba(img, transparent_black=True):
+    palette = img.getpalette() or []
+    palette = palette + [0] * (768 - len(palette))
+    table = np.zeros((256, 4), dtype=np.uint8)
+    table[:, :3] = np.asarray(palette[:768], dtype=np.uint8).reshape(256, 3)
+    table[:, 3] = 255
+
+    transparency = img.info.get('transparency')
+    if isinstance(transparency, int):
+        table[transparency, 3] = 0
+    elif isinstance(transparency, bytes):
+        table[:len(transparency), 3] = np.frombuffer(transparency, dtype=np.uint8)
+
+    if transparent_black:
+        table = apply_transparency_mask(table)
+    return table
+
+# Makes all black pixels of an RGBA array fully transparent, returns a new array
+def apply_transparency_mask(rgba):
+    rgba = np.array(rgba, dtype=np.uint8, copy=True)
+    black = (rgba[..., 0] == 0) & (rgba[..., 1] == 0) & (rgba[..., 2] == 0)
+    rgba[black] = 0
+    return rgba
+
+# Converts palette indices to RGBA using a lookup table from palette_rgba
+def indices_to_rgba(indices, table):
+    return table[indices]
+
+# Crops a (height, width, ...) array using a PIL style box, (left, upper, right, lower)
+# Areas of the box that fall outside of the array are filled with zeros, as PIL does
+def crop(array, box):
+    left, upper, right, lower = box
+    height, width = array.shape[:2]
+    out = np.zeros((max(lower - upper, 0), max(right - left, 0)) + array.shape[2:], dtype=array.dtype)
+
+    src_l, src_u = max(left, 0), max(upper, 0)
+    src_r, src_d = min(right, width), min(lower, height)
+    if src_r > src_l and src_d > src_u:
+        out[src_u - upper:src_d - upper, src_l - left:src_r - left] = array[src_u:src_d, src_l:src_r]
+    return out
+
+# Blends src onto dst in place at position (x, y) using mask (values 0-255) as the weights
+# The mask defaults to the alpha band of src, mirroring dst.paste(src, (x, y), src)
+# Rows are blended in strips of about BLEND_PIXELS, and only where the mask is not 0
+def paste(dst, src, position=(0, 0), mask=None):
+    if mask is None:
+        mask = src[..., 3]
+    x, y = position
+    height, width = src.shape[:2]
+
+    # Clip the pasted area to the destination
+    dst_l, dst_u = max(x, 0), max(y, 0)
+    dst_r, dst_d = min(x + width, dst.shape[1]), min(y + height, dst.shape[0])
+    if dst_r <= dst_l or dst_d <= dst_u:
+        return dst
+
+    bands = dst.shape[2]
+    src = src[dst_u - y:dst_d - y, dst_l - x:dst_r - x, :bands]
+    mask = mask[dst_u - y:dst_d - y, dst_l - x:dst_r - x]
+    out = dst[dst_u:dst_d, dst_l:dst_r]
+
+    step = max(BLEND_PIXELS // out.shape[1], 1)
+    for top in range(0, out.shape[0], step):
+        weights = mask[top:top + step]
+        # A weight of 0 leaves the destination as it is
+        blend = weights != 0
+        if not blend.any():
+            continue
+        weights = weights[blend].astype(np.uint32)[:, np.newaxis]
+        rows = out[top:top + step]
+        rows[blend] = div255(rows[blend].astype(np.uint32) * (255 - weights) +
+                             src[top:top + step][blend].astype(np.uint32) * weights)
+    return dst
+
+# Blends a solid RGBA color over the box (left, upper, right, lower) of dst in place
+# Equivalent to pasting Image.new('RGBA', size, color) with itself as the mask
+def fill(dst, box, color):
+    left, upper, right, lower = box
+    if right <= left or lower <= upper:
+        return dst
+    left, upper = max(left, 0), max(upper, 0)
+    right, lower = min(right, dst.shape[1]), min(lower, dst.shape[0])
+    if right <= left or lower <= upper:
+        return dst
+
+    # With one color and one weight the blend of each band is a lookup table over its 256 values
+    alpha = np.uint32(color[3])
+    values = np.arange(256, dtype=np.uint32)
+    for band in range(dst.shape[2]):
+        table = div255(values * (255 - alpha) + np.uint32(color[band]) * alpha).astype(np.uint8)
+        dst[upper:lower, left:right, band] = table[dst[upper:lower, left:right, band]]
+    return dst
+
+# Returns the boxes of the four no-data bands surrounding the data area of a canvas
+# pad is ([left, right], [top, bottom]) in pixels, data_size is (width, height) of the data area
+def no_data_boxes(pad, data_size):
+    add_x, add_y = pad
+    data_width, data_height = data_size
+    canv_height = data_height + sum(add_y)
+    return [(add_x[0], 0, add_x[0] + data_width, add_y[0]),
+            (0, 0, add_x[0], canv_height),
+            (add_x[0] + data_width, 0, add_x[0] + data_width + add_x[1], canv_height),
+            (add_x[0], add_y[0] + data_height, add_x[0] + data_width, canv_height)]
+
+# Builds the overlay canvas: a data crop surrounded by tinted no-data bands
+def build_canvas(crop_rgba, pad, color=NO_DATA_COLOR):
+    add_x, add_y = pad
+    data_height, data_width = crop_rgba.shape[:2]
+    canvas = np.zeros((data_height + sum(add_y), data_width + sum(add_x), 4), dtype=np.uint8)
+
+    paste(canvas, crop_rgba, (add_x[0], add_y[0]))
+    for box in no_data_boxes(pad, (data_width, data_height)):
+        fill(canvas, box, color)
+    return canvas
+
+# Resizes an RGBA canvas to size and blends it over the map array in place
+def overlay(map_array, canvas, size=None):
+    if size is None:
+        size = (map_array.shape[1], map_array.shape[0])
+    if (canvas.shape[1], canvas.shape[0]) != size:
+        with METRICS.timer('resize'):
+            canvas = np.asarray(Image.fromarray(canvas, 'RGBA').resize(size, Image.LANCZOS))
+    logging.debug(TAG+'blending a {} canvas over the map'.format(size))
+    with METRICS.timer('paste'):
+        return paste(map_array, canvas)
+
+# Returns the IEM pixel window (min_x, min_y, max_x, max_y) of a map covering gps_range
+# ((lat_min, lat_max), (lon_min, lon_max)), parts of the window may lie outside of the IEM image
+# Returns None when the map is entirely outside of the IEM data
+def canvas_window(iem, gps_range):
+    mp_lat_r = gps_range[0]
+    mp_lon_r = gps_range[1]
+    iem_height, iem_width = iem.shape
+    if not iem.transform.is_north_up:
+        raise Exception('Overlays need north-up IEM data, got {}'.format(iem.transform))
+
+    # Top right pixel point in iem image (left_top if gps)
+    iem_min_x, iem_min_y = iem.gps_to_pixel((mp_lat_r[1], mp_lon_r[0]))
+    iem_max_x, iem_max_y = iem.gps_to_pixel((mp_lat_r[0], mp_lon_r[1]))
+
+    if (iem_max_x > iem_width and iem_min_x > iem_width) or iem_max_x < 0:
+        return None
+    elif (iem_max_y > iem_height and iem_min_y > iem_height) or iem_max_y < 0:
+        return None
+    return (iem_min_x, iem_min_y, iem_max_x, iem_max_y)
+
+# Returns the overlay canvas of an IEM pixel window from canvas_window
+# The canvas is in IEM pixel space: the data crop surrounded by the red no-data bands
+def window_canvas(iem, window):
+    iem_min_x, iem_min_y, iem_max_x, iem_max_y = window
+    iem_height, iem_width = iem.shape
+
+    # Figure out how many pixels are needed for the red no-data zone
+    add_x = [max(-iem_min_x, 0), max(iem_max_x - iem_width, 0)]
+    add_y = [max(-iem_min_y, 0), max(iem_max_y - iem_height, 0)]
+    box = (max(iem_min_x, 0), max(iem_min_y, 0), min(iem_max_x, iem_width), min(iem_max_y, iem_height))
+
+    # Create a crop of data needed from IEM's png, black pixels become transparent
+    with METRICS.timer('crop'):
+        data = crop(iem.grid, box)
+    with METRICS.timer('filter'):
+        data = indices_to_rgba(data, iem.palette_rgba())
+    with METRICS.timer('canvas'):
+        return build_canvas(data, (add_x, add_y))
+
+# Returns the box (left, upper, right, lower) of the canvas of a window, without building the rest
+# Pixel for pixel the same as cropping window_canvas(iem, window)
+def canvas_region(iem, window, box):
+    iem_height, iem_width = iem.shape
+    left, upper = window[0] + box[0], window[1] + box[1]
+    width, height = box[2] - box[0], box[3] - box[1]
+
+    # Part of the box inside of the IEM image, the rest is tinted
+    data_l, data_r = min(max(-left, 0), width), min(max(iem_width - left, 0), width)
+    data_u, data_d = min(max(-upper, 0), height), min(max(iem_height - upper, 0), height)
+    data_r, data_d = max(data_r, data_l), max(data_d, data_u)
+    data = crop(iem.grid, (left + data_l, upper + data_u, left + data_r, upper + data_d))
+
+    region = np.zeros((height, width, 4), dtype=np.uint8)
+    paste(region, indices_to_rgba(data, iem.palette_rgba()), (data_l, data_u))
+    for no_data in no_data_boxes(([data_l, width - data_r], [data_u, height - data_d]),
+                                 (data_r - data_l, data_d - data_u)):
+        fill(region, no_data, NO_DATA_COLOR)
+    return region
+
+# Returns the overlay canvas for a map covering gps_range ((lat_min, lat_max), (lon_min, lon_max))
+# Returns None when the map is entirely outside of the IEM data
+def overlay_canvas(iem, gps_range):
+    window = canvas_window(iem, gps_range)
+    if window is None:
+        return None
+    return window_canvas(iem, window)
+
+# Canvas used when a map is entirely outside of the IEM data, a plain no-data tint
+def no_data_canvas():
+    return np.full((100, 200, 4), NO_DATA_COLOR, dtype=np.uint8)
+
+# Returns the box (left, upper, right, lower) of canvas resized to size, as overlay would resize it
+# Only the input pixels under the filter support of the box are resampled
+# Matches the full resize exactly when width and height scale by dyadic ratios (see incremental)
+def resize_region(canvas, size, box):
+    in_height, in_width = canvas.shape[:2]
+    scale_x, scale_y = in_width / size[0], in_height / size[1]
+    left, upper, right, lower = box
+    # Lanczos reads 3 input pixels each side, more when downscaling, plus a margin for rounding
+    margin_x = math.ceil(3 * max(scale_x, 1)) + 2
+    margin_y = math.ceil(3 * max(scale_y, 1)) + 2
+    crop_l = max(int(math.floor(left * scale_x)) - margin_x, 0)
+    crop_u = max(int(math.floor(upper * scale_y)) - margin_y, 0)
+    crop_r = min(int(math.ceil(right * scale_x)) + margin_x, in_width)
+    crop_d = min(int(math.ceil(lower * scale_y)) + margin_y, in_height)
+    image = Image.fromarray(canvas[crop_u:crop_d, crop_l:crop_r], 'RGBA')
+    with METRICS.timer('resize'):
+        return np.asarray(image.resize((right - left, lower - upper), Image.LANCZOS,
+                                       box=(left * scale_x - crop_l, upper * scale_y - crop_u,
+                                            right * scale_x - crop_l, lower * scale_y - crop_u)))
+
+# Overlays a decoded IEM frame on a map image covering gps_range, returns a new image
+# Areas with no data available are overlayed with a red tint
+def render_overlay(iem, map_img, gps_range):
+    with METRICS.timer('overlay'):
+        map_array = np.array(map_img)
+        canvas = overlay_canvas(iem, gps_range)
+        if canvas is None:
+            canvas = no_data_canvas()
+        overlay(map_array, canvas, map_img.size)
+        return Image.fromarray(map_array, map_img.mode)
+
+# Frame used by render_overlay_job in worker processes
+_process_frame = None
+
+# Pool initializer, maps the stored frame once per worker process
+def init_render_process(store_directory, img_path, wld_path):
+    global _process_frame
+    _process_frame = framestore.FrameStore(store_directory).load(img_path, wld_path)
+
+# Renders one (map array, mode, gps_range, path) job in a worker process
+def render_overlay_job(job):
+    map_array, mode, gps_range, path = job
+    overlay_img = render_overlay(_process_frame, Image.fromarray(map_array, mode), gps_range)
+    if path is None:
+        return overlay_img
+    with METRICS.timer('save'):
+        overlay_img.save(path, 'PNG')
+    return path
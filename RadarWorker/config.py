@@ -9,11 +9,76 @@ LOC_FOLS = {
     'data'        : 'data/',
     'nexrad'      : 'data/nexrad-data/',
     'meta'        : 'data/meta-data/',
-    'map'         : 'data/map-data/'
+    'map'         : 'data/map-data/',
+    'frames'      : 'data/frame-data/',
+    'frame-cache' : 'data/frame-cache/',
+    'tiles'       : 'data/map-data/tiles/',
+    'radar-tiles' : 'data/radar-tiles/'
 }
 
-# Configuration for program logging
-logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%m-%d-%Y %H:%M:%S', level=logging.NOTSET)
+# Disk budget for downloaded IEM frames kept in LOC_FOLS['frame-cache'], in bytes
+# The cache evicts any frame in its folder, the sample frames of LOC_FOLS['nexrad'] are kept apart
+FRAME_CACHE_BYTES = 2 * 1024**3
+
+# Disk budget for decoded frames kept in LOC_FOLS['frames'], in bytes (about 66MB per CONUS frame)
+FRAME_STORE_BYTES = 4 * 1024**3
+
+# HTTP settings, timeout is (connect, read) in seconds, backoff is the retry backoff factor
+HTTP_TIMEOUT = (5, 30)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_POOL_SIZE = 8
+
+# Number of concurrent downloads used when prefetching a time window
+PREFETCH_WORKERS = 8
+
+# Root of the IEM archive, and where frames are read from, see datasources.open_source
+#       - None for IEM_URL, or the url of a server mirroring the IEM archive layout
+#       - A local directory in the IEM YYYY/MM/DD/GIS/uscomp/ layout
+#       - A .tar (any compression) or .zip archive of IEM frames, for offline replay
+IEM_URL = 'https://mesonet.agron.iastate.edu/archive/data/'
+DATA_SOURCE = None
+
+# Number of decoded map tiles kept in memory
+TILE_CACHE_IMAGES = 64
+
+# Number of threads or processes used to render overlays for many viewports
+RENDER_WORKERS = 4
+
+# Side in pixels of the blocks of sparse frames, see sparsegrid
+SPARSE_BLOCK = 64
+
+# Area queries, see areaindex: side in pixels of the cells of the tables, and the thresholds (dBZ)
+# whose coverage is reported
+AREA_CELL = 16
+AREA_DBZ_THRESHOLDS = (20, 30, 40, 50)
+
+# Overlays through cached remap tables, see remap: sample points per map pixel along each axis,
+# and number of tables (one per viewport geometry) kept in memory
+REMAP_SUPERSAMPLE = 2
+REMAP_CACHE_TABLES = 32
+
+# Time each frame of an exported animation is shown, in milliseconds
+ANIMATION_FRAME_MS = 500
+
+# Sim clock, number of 5 minute frames loaded ahead of sim time and number of loader threads
+SIM_LOOKAHEAD = 2
+SIM_LOADER_WORKERS = 2
+
+# Tile pyramids of IEM frames, zoom range and tile size in pixels (zoom 6 is close to the IEM resolution)
+RADAR_TILE_MIN_ZOOM = 0
+RADAR_TILE_MAX_ZOOM = 7
+RADAR_TILE_SIZE = 512
+
+# Reflectivity thresholds (dBZ) used to score flight paths, nm flown at or above each is reported
+ROUTE_DBZ_THRESHOLDS = (20, 30, 40, 50)
+
+# Stage timings and counters, see metrics.py, they cost next to nothing while disabled
+METRICS_ENABLED = False
+
+# Configuration for program logging, per call details are logged at debug level
+LOG_LEVEL = logging.INFO
+logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%m-%d-%Y %H:%M:%S', level=LOG_LEVEL)
 TAG = 'config - '
 
 # Method for initializing the local file environment
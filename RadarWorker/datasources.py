@@ -0,0 +1,246 @@
+import logging, os, tarfile, threading, zipfile, requests, config, downloader
+from concurrent.futures import ThreadPoolExecutor
+from metrics import METRICS
+
+TAG = 'DataSource - '
+
+# Where IEM frames come from, every source furnishes (png bytes, wld bytes) for a product and time
+#       - HttpSource downloads from the IEM archive, or any server mirroring its layout
+#       - DirectorySource reads a local tree in the IEM YYYY/MM/DD/GIS/uscomp/ layout
+#       - ArchiveSource reads tar (any compression) or zip archives of frames without extracting them
+# fetch_many is what prefetching uses, each source reads many frames in the way that suits it:
+# concurrent downloads over HTTP, one sequential pass over an archive
+
+# Name of a frame file, e.g. n0q_202001030200
+def frame_name(product, time):
+    return '{}_{}'.format(product, time.strftime('%Y%m%d%H%M'))
+
+# Path of a frame file relative to the root of the IEM archive layout
+def relative_path(product, time, ext):
+    return '{:04d}/{:02d}/{:02d}/GIS/uscomp/{}{}'.format(time.year, time.month, time.day,
+                                                         frame_name(product, time), ext)
+
+# Base of all data sources
+class DataSource:
+    # Returns (png bytes, wld bytes) for a frame, None if the source does not have it
+    def fetch(self, product, time):
+        raise NotImplementedError
+
+    # Yields (time, (png bytes, wld bytes)) for the frames of times the source has, in any order
+    def fetch_many(self, product, times, workers=None):
+        for time in times:
+            data = self.fetch(product, time)
+            if data is not None:
+                yield time, data
+
+    # Local (png, wld) paths the frame can be read from in place, None if it has to be fetched
+    def local_paths(self, product, time):
+        return None
+
+# Downloads frames over HTTP with a pooled session
+# Too many failed downloads raise, as a sim would otherwise run on without weather
+class HttpSource(DataSource):
+    MAX_ERRORS = 25
+
+    def __init__(self, base_url=None, session=None, timeout=None):
+        self.base_url = base_url or config.IEM_URL
+        self.__session = session if session is not None else downloader.shared_session()
+        self.__timeout = timeout or config.HTTP_TIMEOUT
+        self.__http_errors = 0
+        self.__lock = threading.Lock()
+
+    # Number of failed downloads of this source
+    @property
+    def http_errors(self):
+        return self.__http_errors
+
+    def url(self, product, time, ext):
+        return self.base_url + relative_path(product, time, ext)
+
+    def fetch(self, product, time):
+        logging.info(TAG+'Downloading the png file for {}'.format(time))
+        img_data = self._download(self.url(product, time, '.png'), 'nexrad')
+        # Without the png there is no frame, the wld is not requested so a missing frame is one error
+        if img_data is None:
+            return None
+        logging.info(TAG+'Downloading the wld file for {}'.format(time))
+        wld_data = self._download(self.url(product, time, '.wld'), 'wld')
+        if wld_data is None:
+            return None
+        return img_data, wld_data
+
+    # Downloads concurrently, frames are yielded in the order of times
+    def fetch_many(self, product, times, workers=None):
+        with ThreadPoolExecutor(max_workers=workers or config.PREFETCH_WORKERS) as executor:
+            for time, data in zip(times, executor.map(lambda time: self.fetch(product, time), times)):
+                if data is not None:
+                    yield time, data
+
+    def _check_request_completion(self, request):
+        if request.status_code != 200:
+            self._failed()
+            return False
+        return True
+
+    def _failed(self):
+        with self.__lock:
+            self.__http_errors += 1
+            errors = self.__http_errors
+        METRICS.count('http_errors')
+        logging.error(TAG+'*****FAILED TO DOWNLOAD FILE*****')
+        if errors >= self.MAX_ERRORS:
+            raise Exception('Too many failed downloads: {} downloads failed'.format(errors))
+
+    # Downloads a single file, returns its content or None if the download failed
+    # Transient failures are retried with backoff by the pooled session
+    def _download(self, url, description):
+        logging.debug(TAG+'downloading '+url)
+        try:
+            with METRICS.timer('download'):
+                request = self.__session.get(url, timeout=self.__timeout)
+        except requests.RequestException:
+            METRICS.count('http_errors')
+            logging.error(TAG+'IEM not furnishing {} data... try again later.'.format(description))
+            return None
+        if not self._check_request_completion(request):
+            return None
+        METRICS.count('download_bytes', len(request.content))
+        return request.content
+
+# Reads frames from a local tree in the IEM layout, frames are used in place and never copied
+class DirectorySource(DataSource):
+    def __init__(self, root):
+        if not os.path.isdir(root):
+            raise Exception('No IEM archive directory at {}'.format(root))
+        self.root = root
+
+    def local_paths(self, product, time):
+        paths = tuple(os.path.join(self.root, relative_path(product, time, ext)) for ext in ('.png', '.wld'))
+        if all(os.path.exists(path) for path in paths):
+            return paths
+        return None
+
+    def fetch(self, product, time):
+        paths = self.local_paths(product, time)
+        if paths is None:
+            return None
+        data = []
+        for path in paths:
+            with open(path, 'rb') as reader:
+                data.append(reader.read())
+        METRICS.count('archive_bytes', sum(len(part) for part in data))
+        return tuple(data)
+
+# Reads frames from a tar or zip archive of IEM files, in the IEM layout or flat
+#       - Members are matched by file name, n0q_YYYYMMDDHHMM.png and .wld (or .txt)
+#       - fetch_many reads the archive in one sequential pass, compressed tars are never seeked
+#       - Single fetches on a zip or an uncompressed tar use the member index, on a compressed
+#         tar they cost a pass over the archive, prefetch windows instead
+class ArchiveSource(DataSource):
+    WLD_EXTS = ('.wld', '.txt')
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise Exception('No IEM archive at {}'.format(path))
+        self.path = path
+        self.is_zip = zipfile.is_zipfile(path)
+        if not self.is_zip and not tarfile.is_tarfile(path):
+            raise Exception('{} is neither a tar nor a zip archive'.format(path))
+        self.__index = None
+        self.__lock = threading.Lock()
+
+    # Splits a member name into (frame name, 'png' or 'wld'), None for other members
+    @classmethod
+    def _member_kind(cls, name):
+        base, ext = os.path.splitext(os.path.basename(name))
+        if ext == '.png':
+            return base, 'png'
+        if ext in cls.WLD_EXTS:
+            return base, 'wld'
+        return None
+
+    # Frame name -> {'png': member, 'wld': member}, only built for random access
+    def _load_index(self):
+        with self.__lock:
+            if self.__index is None:
+                index = {}
+                if self.is_zip:
+                    with zipfile.ZipFile(self.path) as archive:
+                        members = archive.infolist()
+                    names = [member.filename for member in members]
+                else:
+                    with tarfile.open(self.path, 'r:*') as archive:
+                        members = archive.getmembers()
+                    names = [member.name for member in members]
+                for name, member in zip(names, members):
+                    kind = self._member_kind(name)
+                    if kind is not None:
+                        index.setdefault(kind[0], {})[kind[1]] = member
+                self.__index = index
+            return self.__index
+
+    def fetch(self, product, time):
+        entry = self._load_index().get(frame_name(product, time))
+        if entry is None or len(entry) != 2:
+            return None
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as archive:
+                data = (archive.read(entry['png']), archive.read(entry['wld']))
+        else:
+            with tarfile.open(self.path, 'r:*') as archive:
+                data = (archive.extractfile(entry['png']).read(), archive.extractfile(entry['wld']).read())
+        METRICS.count('archive_bytes', len(data[0]) + len(data[1]))
+        return data
+
+    # One pass over the archive, frames are yielded as soon as both of their files were read
+    def fetch_many(self, product, times, workers=None):
+        wanted = {frame_name(product, time): time for time in times}
+        if not wanted:
+            return
+        logging.info(TAG+'reading {} frames from {}'.format(len(wanted), self.path))
+        for name, data in self._scan(wanted):
+            METRICS.count('archive_bytes', len(data[0]) + len(data[1]))
+            yield wanted[name], data
+
+    def _scan(self, wanted):
+        partial = {}
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as archive:
+                # Members are read in the order they are stored
+                members = sorted(archive.infolist(), key=lambda member: member.header_offset)
+                for member in members:
+                    kind = self._member_kind(member.filename)
+                    if kind is None or kind[0] not in wanted:
+                        continue
+                    done = self._collect(partial, kind, archive.read(member))
+                    if done is not None:
+                        yield done
+        else:
+            # Stream mode, the archive is read front to back exactly once
+            with tarfile.open(self.path, 'r|*') as archive:
+                for member in archive:
+                    kind = self._member_kind(member.name)
+                    if kind is None or kind[0] not in wanted or not member.isfile():
+                        continue
+                    done = self._collect(partial, kind, archive.extractfile(member).read())
+                    if done is not None:
+                        yield done
+
+    # Keeps the first half of a frame until the other one is read
+    @staticmethod
+    def _collect(partial, kind, data):
+        name, part = kind
+        parts = partial.setdefault(name, {})
+        parts[part] = data
+        if len(parts) == 2:
+            del partial[name]
+            return name, (parts['png'], parts['wld'])
+        return None
+
+# Builds the data source for a spec: None or an http(s) url for HTTP, a directory or an archive file
+def open_source(spec=None, session=None):
+    if spec is None or spec.startswith('http://') or spec.startswith('https://'):
+        return HttpSource(spec, session)
+    if os.path.isdir(spec):
+        return DirectorySource(spec)
+    return ArchiveSource(spec)
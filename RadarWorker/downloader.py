@@ -0,0 +1,34 @@
+import logging, threading, requests, config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TAG = 'downloader - '
+
+# Status codes that are worth retrying, everything else fails right away
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+# Creates a keep-alive session with a bounded connection pool and retries with backoff
+def create_session(pool_size=None, retries=None, backoff=None):
+    pool_size = pool_size or config.HTTP_POOL_SIZE
+    retry = Retry(total=config.HTTP_RETRIES if retries is None else retries,
+                  backoff_factor=config.HTTP_BACKOFF if backoff is None else backoff,
+                  status_forcelist=RETRY_STATUS, allowed_methods=['GET'],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    logging.debug(TAG+'created a session with a pool of {} connections'.format(pool_size))
+    return session
+
+# Session shared by every worker in the process, so connections are reused across pulls
+def shared_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
@@ -0,0 +1,22 @@
+import os, tempfile
+
+TAG = 'fileio - '
+
+# Writes a file atomically, readers see the old file or the new one but never a partial file
+#       - data is the content as bytes, or a function writing it to the binary file it is given
+#       - The content goes to a temp file in the same directory, which is then renamed over path
+#       - The temp file is removed when writing fails, and the error is raised
+def atomic_write(path, data):
+    directory, name = os.path.split(path)
+    handle, tmp_path = tempfile.mkstemp(prefix='.'+name, suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            if callable(data):
+                data(file)
+            else:
+                file.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
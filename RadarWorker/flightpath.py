@@ -0,0 +1,148 @@
+import datetime, logging, config, reflectivity
+import numpy as np
+from stationindex import to_unit_vectors, cos_to_nm
+
+TAG = 'FlightPath - '
+
+# Reflectivity along flight paths given as polylines of (lat, lon) waypoints
+#       - Segments are traversed DDA style (Amanatides-Woo): the route is cut where it crosses
+#         pixel boundaries and sampled once per pixel, so every pixel crossed is sampled once
+#       - Samples of all segments (and of all routes when scoring) are generated in one pass
+#       - Distances are great circle distances in nautical miles, each sample stands for the
+#         stretch of route inside its pixel
+# Positions are interpolated linearly in lat/lon, which is the geometry of the IEM grid
+
+# Samples of a batch of routes on a frame grid, in route order
+# Returns (route ids, latitudes, longitudes, weights in nm, segment fractions, segment ids)
+# The last waypoint of every route is a sample of weight 0, so every route has at least one sample
+def _traverse(frame, routes):
+    starts, ends, segment_route, last_points, last_route = [], [], [], [], []
+    for route_id, waypoints in enumerate(routes):
+        waypoints = np.asarray(waypoints, dtype=np.float64).reshape(-1, 2)
+        if len(waypoints) == 0:
+            raise Exception('Route {} has no waypoints'.format(route_id))
+        starts.append(waypoints[:-1])
+        ends.append(waypoints[1:])
+        segment_route.append(np.full(len(waypoints) - 1, route_id, dtype=np.int64))
+        last_points.append(waypoints[-1:])
+        last_route.append(route_id)
+    starts, ends = np.concatenate(starts), np.concatenate(ends)
+    segment_route = np.concatenate(segment_route)
+    lengths = cos_to_nm(np.einsum('ij,ij->i', to_unit_vectors(starts[:, 0], starts[:, 1]),
+                                  to_unit_vectors(ends[:, 0], ends[:, 1])))
+
+    # Segment fractions where each segment crosses a pixel boundary, columns then rows
+    # Pixel coordinates are affine in lat/lon, so they vary linearly along each segment
+    pixel_starts = frame.transform.gps_to_fractional(starts)
+    pixel_ends = frame.transform.gps_to_fractional(ends)
+    crossings = [np.zeros(len(starts))]
+    crossing_segment = [np.arange(len(starts))]
+    for axis in (0, 1):
+        u0, u1 = pixel_starts[:, axis], pixel_ends[:, axis]
+        low = np.floor(np.minimum(u0, u1))
+        counts = np.maximum(np.ceil(np.maximum(u0, u1)) - low - 1, 0).astype(np.int64)
+        segment = np.repeat(np.arange(len(starts)), counts)
+        boundary = low[segment] + 1 + np.arange(len(segment)) - (np.cumsum(counts) - counts)[segment]
+        crossings.append((boundary - u0[segment]) / (u1 - u0)[segment])
+        crossing_segment.append(segment)
+    crossings, segment = np.concatenate(crossings), np.concatenate(crossing_segment)
+    # Fractions are in [0, 1), so one float key orders by segment then fraction (faster than lexsort)
+    order = np.argsort(segment + crossings / 2)
+    crossings, segment = crossings[order], segment[order]
+
+    # One sample in the middle of every stretch between two crossings, which lies in one pixel
+    following = np.append(crossings[1:], 1.0)
+    following[np.append(segment[1:] != segment[:-1], True)] = 1.0
+    keep = following > crossings
+    crossings, following, segment = crossings[keep], following[keep], segment[keep]
+    fraction = (crossings + following) / 2
+    points = starts[segment] + fraction[:, np.newaxis] * (ends - starts)[segment]
+    weights = (following - crossings) * lengths[segment]
+
+    # Append the last waypoints, then order samples by route (segments are already in order)
+    route_ids = np.concatenate((segment_route[segment], last_route))
+    order = np.argsort(route_ids, kind='stable')
+    points = np.concatenate((points, np.concatenate(last_points)))[order]
+    weights = np.concatenate((weights, np.zeros(len(routes))))[order]
+    fraction = np.concatenate((fraction, np.ones(len(routes))))[order]
+    segment = np.concatenate((segment, np.full(len(routes), -1)))[order]
+    return route_ids[order], points[:, 0], points[:, 1], weights, fraction, segment
+
+# Distance in nm spent at or above each threshold, for samples grouped by route
+def _distance_above(dbz, weights, route_ids, count, thresholds):
+    above = np.empty((count, len(thresholds)), dtype=np.float64)
+    for i, threshold in enumerate(thresholds):
+        # NaN (outside of the frame) compares as False, it is never counted
+        above[:, i] = np.bincount(route_ids, weights=weights * (dbz >= threshold), minlength=count)
+    return above
+
+# dBZ profile along one route, see route_profile
+class RouteProfile:
+    def __init__(self, latitude, longitude, distance, dbz, times=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.distance = distance
+        self.dbz = dbz
+        self.times = times
+        self.__weights = np.diff(distance, append=distance[-1] if len(distance) else 0)
+
+    def __len__(self):
+        return len(self.dbz)
+
+    # Max dBZ along the route, NaN when the route is entirely outside of the data
+    @property
+    def max_dbz(self):
+        if np.isnan(self.dbz).all():
+            return float('nan')
+        return float(np.nanmax(self.dbz))
+
+    # Summary of the profile, max dBZ and nm flown at or above each threshold
+    def summary(self, thresholds=config.ROUTE_DBZ_THRESHOLDS):
+        above = _distance_above(self.dbz, self.__weights, np.zeros(len(self), dtype=np.int64), 1, thresholds)
+        return {'max_dbz': self.max_dbz, 'distance_nm': float(self.distance[-1]),
+                'distance_above': dict(zip(thresholds, above[0].tolist()))}
+
+# Returns the RouteProfile of a polyline of (lat, lon) waypoints on a DecodedFrame
+# With times, one datetime per waypoint, every sample gets an interpolated time
+# With times and a Timeline, each sample is read from the frame of its own time instead of frame
+def route_profile(frame, waypoints, times=None, timeline=None):
+    if times is not None and len(times) != len(waypoints):
+        raise Exception('Got {} times for {} waypoints'.format(len(times), len(waypoints)))
+
+    route_ids, latitude, longitude, weights, fraction, segment = _traverse(frame, [waypoints])
+    distance = np.concatenate(([0.0], np.cumsum(weights)[:-1]))
+    points = np.stack((latitude, longitude), axis=1)
+
+    sample_times = None
+    if times is not None:
+        seconds = np.array([(time - times[0]).total_seconds() for time in times], dtype=np.float64)
+        if len(seconds) > 1:
+            # The last waypoint is the end of the last segment
+            segment[segment < 0] = len(seconds) - 2
+            offsets = seconds[segment] + fraction * (seconds[segment + 1] - seconds[segment])
+        else:
+            offsets = np.zeros(len(points))
+        sample_times = [times[0] + datetime.timedelta(seconds=float(offset)) for offset in offsets]
+
+    if sample_times is not None and timeline is not None:
+        dbz = timeline.sample_at(points, sample_times)
+    else:
+        dbz = frame.get_reflectivity(points)
+    logging.debug(TAG+'sampled {} points along a route of {:.1f} nm'.format(len(points), distance[-1]))
+    return RouteProfile(latitude, longitude, distance, dbz, sample_times)
+
+# Scores many routes on one DecodedFrame at once
+# Returns (max_dbz, distance_above) with shapes (routes,) and (routes, thresholds), distances in nm
+# max_dbz is NaN for routes entirely outside of the data
+def score_routes(frame, routes, thresholds=config.ROUTE_DBZ_THRESHOLDS):
+    routes = list(routes)
+    if not routes:
+        return np.empty(0, dtype=np.float32), np.empty((0, len(thresholds)), dtype=np.float64)
+    route_ids, latitude, longitude, weights, fraction, segment = _traverse(frame, routes)
+    pixels = frame.gps_to_pixels(np.stack((latitude, longitude), axis=1))
+    dbz = reflectivity.sample(frame.grid, pixels[:, 0], pixels[:, 1])
+
+    # Samples are grouped by route, every route has at least one sample
+    starts = np.searchsorted(route_ids, np.arange(len(routes)))
+    max_dbz = np.fmax.reduceat(dbz, starts)
+    return max_dbz, _distance_above(dbz, weights, route_ids, len(routes), thresholds)
@@ -0,0 +1,178 @@
+import logging, os, threading, fileio
+from collections import OrderedDict
+from metrics import METRICS
+
+TAG = 'FrameCache - '
+
+# Persistent on-disk cache for IEM frames (png + world file)
+#       - Frames are keyed by product and timestamp, e.g. n0q_202001030200.png/.txt
+#       - Total size is bounded by max_bytes, least recently used frames are evicted first
+#       - Writes go to a temp file that is renamed into place, so readers never see partial files
+#       - Recency is kept in the file mtimes, so the LRU order survives restarts
+class FrameCache:
+    IMG_EXT = '.png'
+    WLD_EXT = '.txt'
+
+    def __init__(self, directory, max_bytes):
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries = None
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    @property
+    def max_bytes(self):
+        return self.__max_bytes
+
+    @property
+    def size(self):
+        with self.__lock:
+            self._load_index()
+            return self.__size
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    @property
+    def evictions(self):
+        return self.__evictions
+
+    # Fraction of lookups that were served from disk
+    @property
+    def hit_rate(self):
+        total = self.__hits + self.__misses
+        return self.__hits / total if total else 0.0
+
+    # Name of a frame in the cache, matches the IEM file naming
+    @staticmethod
+    def key(product, time):
+        return '{}_{:04d}{:02d}{:02d}{:02d}{:02d}'.format(product, time.year, time.month, time.day,
+                                                          time.hour, time.minute)
+
+    def paths(self, key):
+        return (os.path.join(self.__directory, key + self.IMG_EXT),
+                os.path.join(self.__directory, key + self.WLD_EXT))
+
+    def __contains__(self, key):
+        with self.__lock:
+            self._load_index()
+            return key in self.__entries
+
+    # Returns the (png, wld) paths of a cached frame, or None on a miss
+    def get(self, product, time):
+        key = self.key(product, time)
+        with self.__lock:
+            self._load_index()
+            paths = self.paths(key)
+            if key in self.__entries and all(os.path.exists(path) for path in paths):
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                METRICS.count('frame_cache_hits')
+                for path in paths:
+                    self._touch(path)
+                logging.debug(TAG+'cache hit for '+key)
+                return paths
+
+            # Files might have been removed behind our back (cl_wd)
+            if key in self.__entries:
+                self.__size -= self.__entries.pop(key)
+            self.__misses += 1
+            METRICS.count('frame_cache_misses')
+            logging.debug(TAG+'cache miss for '+key)
+            return None
+
+    # Atomically stores a frame in the cache and returns its (png, wld) paths
+    def put(self, product, time, img_bytes, wld_bytes):
+        key = self.key(product, time)
+        paths = self.paths(key)
+        os.makedirs(self.__directory, exist_ok=True)
+
+        # The world file goes in first, a frame counts as present once its png exists
+        fileio.atomic_write(paths[1], wld_bytes)
+        fileio.atomic_write(paths[0], img_bytes)
+
+        with self.__lock:
+            self._load_index()
+            if key in self.__entries:
+                self.__size -= self.__entries.pop(key)
+            self.__entries[key] = len(img_bytes) + len(wld_bytes)
+            self.__size += self.__entries[key]
+            self._evict(keep=key)
+        return paths
+
+    # Drops every cached frame
+    def clear(self):
+        with self.__lock:
+            self._load_index()
+            for key in list(self.__entries):
+                self._remove(key)
+
+    def stats(self):
+        return {'hits': self.__hits, 'misses': self.__misses, 'evictions': self.__evictions,
+                'hit_rate': self.hit_rate, 'size': self.size, 'max_bytes': self.__max_bytes}
+
+    # Builds the in-memory LRU index from the directory, oldest mtime first
+    def _load_index(self):
+        if self.__entries is not None:
+            return
+        self.__entries = OrderedDict()
+        self.__size = 0
+        if not os.path.isdir(self.__directory):
+            return
+
+        frames = []
+        for file in os.listdir(self.__directory):
+            key, ext = os.path.splitext(file)
+            if ext != self.IMG_EXT:
+                continue
+            paths = self.paths(key)
+            if not os.path.exists(paths[1]):
+                continue
+            try:
+                stats = [os.stat(path) for path in paths]
+            except FileNotFoundError:
+                continue
+            frames.append((stats[0].st_mtime, key, stats[0].st_size + stats[1].st_size))
+
+        for mtime, key, size in sorted(frames):
+            self.__entries[key] = size
+            self.__size += size
+        logging.info(TAG+'indexed {} cached frames ({} bytes)'.format(len(self.__entries), self.__size))
+
+    # Removes least recently used frames until the cache fits in its budget
+    def _evict(self, keep=None):
+        for key in list(self.__entries):
+            if self.__size <= self.__max_bytes:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            self.__evictions += 1
+            logging.info(TAG+'evicted '+key)
+
+    def _remove(self, key):
+        self.__size -= self.__entries.pop(key)
+        for path in self.paths(key):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
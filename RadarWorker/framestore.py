@@ -0,0 +1,251 @@
+import json, logging, os, threading, areaindex, fileio, config, reflectivity, txtparsing
+from geotransform import GeoTransform
+from metrics import METRICS
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+
+TAG = 'FrameStore - '
+
+# Reads the six values of a world file, in file order (A, D, B, E, C, F)
+def read_wld(wld_path):
+    with METRICS.timer('wld_parse'):
+        wld_data = []
+        with open(wld_path, 'r') as reader:
+            line = reader.readline()
+            while line:
+                if line.strip():
+                    wld_data.append(line.strip())
+                line = reader.readline()
+
+        # Convert all wld data to float values
+        for i, data in enumerate(wld_data):
+            if data[0] == '-' or data[0] == '+':
+                wld_data[i] = txtparsing.DataWorker.str_to_flt(wld_data[i])
+            else:
+                wld_data[i] = float(wld_data[i])
+        return tuple(wld_data)
+
+# A decoded IEM frame: palette indices as a (height, width) uint8 grid plus its metadata
+# The grid is normally a read-only memory map, so crops and lookups are zero-copy slices
+class DecodedFrame:
+    def __init__(self, key, grid, wld, palette, transparency=None, source=None):
+        self.key = key
+        self.source = source
+        self.grid = grid
+        self.wld = tuple(wld)
+        self.transform = GeoTransform.from_wld(self.wld)
+        self.palette = np.asarray(palette, dtype=np.uint8).reshape(256, 3)
+        self.transparency = transparency
+        self.__rgba = {}
+        self.__areas = {}
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    @property
+    def width(self):
+        return self.grid.shape[1]
+
+    @property
+    def height(self):
+        return self.grid.shape[0]
+
+    # Converts one (lat, lon) to the (x, y) pixel holding it, truncating like RadarWorker.gps_to_pixel
+    def gps_to_pixel(self, gps_coor):
+        return self.transform.gps_to_pixel(gps_coor)
+
+    # Converts an Nx2 array of (lat, lon) to an Nx2 int array of (x, y) pixels, using the world file
+    def gps_to_pixels(self, gps_coors):
+        return self.transform.gps_to_pixels(gps_coors)
+
+    # Reflectivity (dBZ) at each (lat, lon) of an Nx2 array, NaN outside of the frame
+    def get_reflectivity(self, gps_coors):
+        pixels = self.gps_to_pixels(gps_coors)
+        return reflectivity.sample(self.grid, pixels[:, 0], pixels[:, 1])
+
+    # AreaIndex of the frame for box and disk queries, built on first use for each set of thresholds
+    def area_index(self, thresholds=None):
+        thresholds = tuple(config.AREA_DBZ_THRESHOLDS if thresholds is None else thresholds)
+        if thresholds not in self.__areas:
+            with METRICS.timer('area_index'):
+                self.__areas[thresholds] = areaindex.AreaIndex.from_frame(self, thresholds=thresholds)
+        return self.__areas[thresholds]
+
+    # (256, 4) RGBA lookup table for the palette, black is transparent unless told otherwise
+    def palette_rgba(self, transparent_black=True):
+        if transparent_black not in self.__rgba:
+            table = np.zeros((256, 4), dtype=np.uint8)
+            table[:, :3] = self.palette
+            table[:, 3] = 255
+            if isinstance(self.transparency, int):
+                table[self.transparency, 3] = 0
+            elif isinstance(self.transparency, list):
+                table[:len(self.transparency), 3] = self.transparency
+            if transparent_black:
+                black = ~table[:, :3].any(axis=1)
+                table[black] = 0
+            table.flags.writeable = False
+            self.__rgba[transparent_black] = table
+        return self.__rgba[transparent_black]
+
+    # Palette based PIL image of the frame, or of a crop box (left, upper, right, lower)
+    def to_image(self, box=None):
+        grid = self.grid
+        if box is not None:
+            grid = grid[box[1]:box[3], box[0]:box[2]]
+        img = Image.fromarray(np.ascontiguousarray(grid), 'P')
+        img.putpalette(self.palette.ravel().tolist())
+        return img
+
+# Store of decoded frames kept as memory-mapped .npy grids next to a small json header
+#       - Each png is decoded once, later loads (from any process) map the .npy file
+#       - The header holds the world file values, the palette and the identity of the source png
+#       - Recently used frames are also kept open in process, up to max_open
+#       - Grids are evicted least recently used first once they take more than max_bytes
+class FrameStore:
+    GRID_EXT = '.npy'
+    HEADER_EXT = '.json'
+
+    def __init__(self, directory, max_bytes=None, max_open=32):
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__max_open = max_open
+        self.__open = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__decodes = 0
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    # Number of png decodes done by this store
+    @property
+    def decodes(self):
+        return self.__decodes
+
+    def paths(self, key):
+        return (os.path.join(self.__directory, key + self.GRID_EXT),
+                os.path.join(self.__directory, key + self.HEADER_EXT))
+
+    # Returns the DecodedFrame for a png/wld pair, decoding the png only if it is not stored yet
+    def load(self, img_path, wld_path):
+        key = os.path.splitext(os.path.basename(img_path))[0]
+        source = self._source_id(img_path)
+
+        with self.__lock:
+            frame = self.__open.get(key)
+            if frame is not None and frame.source == source:
+                self.__open.move_to_end(key)
+                return frame
+
+        frame = self._map(key, source)
+        if frame is None:
+            frame = self._decode(key, source, img_path, wld_path)
+
+        with self.__lock:
+            self.__open[key] = frame
+            self.__open.move_to_end(key)
+            while len(self.__open) > self.__max_open:
+                self.__open.popitem(last=False)
+        return frame
+
+    # Removes a stored frame from disk and from the open frames
+    def remove(self, key):
+        with self.__lock:
+            self.__open.pop(key, None)
+        for path in self.paths(key):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    # Identity of a source png, a re-downloaded file gets a new inode
+    @staticmethod
+    def _source_id(img_path):
+        stat = os.stat(img_path)
+        return [stat.st_size, stat.st_ino]
+
+    # Maps a stored grid, returns None if it is missing or stale
+    def _map(self, key, source):
+        grid_path, header_path = self.paths(key)
+        try:
+            with open(header_path, 'r') as reader:
+                header = json.load(reader)
+            if header['source'] != source:
+                return None
+            grid = np.load(grid_path, mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            return None
+
+        self._touch(header_path)
+        frame = DecodedFrame(key, grid, header['wld'], header['palette'], header.get('transparency'), source)
+        logging.debug(TAG+'mapped stored frame '+key)
+        return frame
+
+    # Decodes a png into the store, the header is written last so it marks a complete entry
+    def _decode(self, key, source, img_path, wld_path):
+        logging.info(TAG+'decoding '+img_path)
+        im = Image.open(img_path)
+        if im.mode != 'P':
+            raise Exception('IEM image {} is not palette based'.format(img_path))
+
+        palette = im.getpalette() or []
+        palette = palette + [0] * (768 - len(palette))
+        transparency = im.info.get('transparency')
+        if isinstance(transparency, bytes):
+            transparency = list(transparency)
+        header = {'wld': read_wld(wld_path), 'palette': palette[:768], 'transparency': transparency,
+                  'source': source}
+
+        with METRICS.timer('decode'):
+            grid = np.asarray(im)
+        METRICS.count('frames_decoded')
+        self.__decodes += 1
+        os.makedirs(self.__directory, exist_ok=True)
+        grid_path, header_path = self.paths(key)
+        fileio.atomic_write(grid_path, lambda file: np.save(file, grid))
+        fileio.atomic_write(header_path, lambda file: file.write(json.dumps(header).encode()))
+
+        frame = self._map(key, source)
+        if frame is None:
+            frame = DecodedFrame(key, grid, header['wld'], header['palette'], transparency, source)
+        self._evict(keep=key)
+        return frame
+
+    # Removes least recently used grids until the store fits in its budget
+    def _evict(self, keep=None):
+        if self.__max_bytes is None:
+            return
+        entries = []
+        for file in os.listdir(self.__directory):
+            key, ext = os.path.splitext(file)
+            if ext != self.GRID_EXT or key == keep:
+                continue
+            try:
+                size = os.stat(os.path.join(self.__directory, file)).st_size
+                mtime = os.stat(self.paths(key)[1]).st_mtime
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, key, size))
+
+        total = sum(entry[2] for entry in entries)
+        if keep is not None and os.path.exists(self.paths(keep)[0]):
+            total += os.stat(self.paths(keep)[0]).st_size
+        for mtime, key, size in sorted(entries):
+            if total <= self.__max_bytes:
+                break
+            try:
+                self.remove(key)
+            except OSError:
+                continue
+            total -= size
+            logging.info(TAG+'evicted '+key)
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
@@ -0,0 +1,126 @@
+import math
+import numpy as np
+
+TAG = 'GeoTransform - '
+
+# Affine mapping between pixel (x, y) and geographic (lat, lon) coordinates, as in a world file
+#       - lon = A*x + B*y + C and lat = D*x + E*y + F, with (C, F) the outer corner of pixel (0, 0)
+#       - Skewed and rectangular pixels are supported, north-up transforms use a division only path
+#         so results match the original per-axis arithmetic bit for bit
+#       - Every conversion takes Nx2 arrays, (lat, lon) on the geographic side, (x, y) on the pixel side
+class GeoTransform:
+    def __init__(self, a, d, b, e, c, f):
+        self.a, self.d, self.b, self.e, self.c, self.f = float(a), float(d), float(b), float(e), float(c), float(f)
+        self.__det = self.a * self.e - self.b * self.d
+        if self.__det == 0:
+            raise Exception('World file values {} do not form an invertible transform'.format(self.values))
+
+    # Builds a transform from the six values of a world file, in file order (A, D, B, E, C, F)
+    @classmethod
+    def from_wld(cls, wld_data):
+        if len(wld_data) != 6:
+            raise Exception('A world file holds 6 values, got {}'.format(len(wld_data)))
+        return cls(*wld_data)
+
+    # Builds a north-up transform for an image of size (width, height) covering
+    # gps_range ((lat_min, lat_max), (lon_min, lon_max)), as the map images of a MapWorker
+    @classmethod
+    def from_bounds(cls, gps_range, size):
+        (lat_min, lat_max), (lon_min, lon_max) = gps_range
+        width, height = size
+        return cls((lon_max - lon_min) / width, 0, 0, -(lat_max - lat_min) / height, lon_min, lat_max)
+
+    # World file values, in file order
+    @property
+    def values(self):
+        return (self.a, self.d, self.b, self.e, self.c, self.f)
+
+    # True when rows follow latitude and columns follow longitude
+    @property
+    def is_north_up(self):
+        return self.b == 0 and self.d == 0
+
+    # True when pixels are as wide as they are tall
+    @property
+    def is_square(self):
+        return self.is_north_up and self.a == -self.e
+
+    # (width, height) of a pixel in degrees
+    @property
+    def pixel_size(self):
+        return (math.hypot(self.a, self.d), math.hypot(self.b, self.e))
+
+    # Continuous pixel coordinates, an Nx2 float array of (x, y), for an Nx2 array of (lat, lon)
+    def gps_to_fractional(self, gps_coors):
+        gps_coors = np.asarray(gps_coors, dtype=np.float64).reshape(-1, 2)
+        lon = gps_coors[:, 1] - self.c
+        lat = gps_coors[:, 0] - self.f
+        out = np.empty(gps_coors.shape, dtype=np.float64)
+        if self.is_north_up:
+            out[:, 0] = lon / self.a
+            out[:, 1] = lat / self.e
+        else:
+            out[:, 0] = (self.e * lon - self.b * lat) / self.__det
+            out[:, 1] = (self.a * lat - self.d * lon) / self.__det
+        return out
+
+    # Pixels (x, y) holding each (lat, lon) of an Nx2 array, as an Nx2 int array
+    # Points outside of the image get out of bounds pixels, floored so they never land in the image
+    def gps_to_pixels(self, gps_coors):
+        return np.floor(self.gps_to_fractional(gps_coors)).astype(np.int64)
+
+    # Pixel (x, y) of a single (lat, lon), truncated toward zero as RadarWorker always did
+    # Inside of the image it is the pixel of gps_to_pixels, less than a pixel west or north of the
+    # origin it gives 0 where gps_to_pixels gives -1. Overlay windows (compositing.canvas_window)
+    # are built on the truncated pixels, keep it as is for them and use gps_to_pixels for lookups
+    def gps_to_pixel(self, gps_coor):
+        if self.is_north_up:
+            return (int((gps_coor[1] - self.c) / self.a), int((gps_coor[0] - self.f) / self.e))
+        x, y = self.gps_to_fractional([gps_coor])[0]
+        return (int(x), int(y))
+
+    # (lat, lon) of each (x, y) of an Nx2 array, the outer corner of the pixel or its center
+    def pixels_to_gps(self, pixels, center=False):
+        pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+        x, y = pixels[:, 0], pixels[:, 1]
+        if center:
+            x, y = x + 0.5, y + 0.5
+        out = np.empty(pixels.shape, dtype=np.float64)
+        out[:, 0] = self.d * x + self.e * y + self.f
+        out[:, 1] = self.a * x + self.b * y + self.c
+        return out
+
+    # GPS range ((lat_min, lat_max), (lon_min, lon_max)) covered by an image of shape (height, width)
+    def bounds(self, shape):
+        height, width = shape[:2]
+        corners = self.pixels_to_gps([(0, 0), (width, 0), (0, height), (width, height)])
+        return ((float(corners[:, 0].min()), float(corners[:, 0].max())),
+                (float(corners[:, 1].min()), float(corners[:, 1].max())))
+
+    # Pixel window (left, upper, right, lower) covering a bounding box ((lat_min, lat_max), (lon_min, lon_max))
+    # Partly covered pixels are included, with shape (height, width) the window is clipped to the image
+    def window(self, bbox, shape=None):
+        return tuple(int(value) for value in self.windows([bbox], shape)[0])
+
+    # Pixel windows of many bounding boxes, an Nx4 int array of (left, upper, right, lower), see window
+    def windows(self, bboxes, shape=None):
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 2, 2)
+        lat, lon = bboxes[:, 0], bboxes[:, 1]
+        corners = np.stack((lat[:, [0, 0, 1, 1]], lon[:, [0, 1, 0, 1]]), axis=2)
+        corners = self.gps_to_fractional(corners.reshape(-1, 2)).reshape(-1, 4, 2)
+        left, upper = np.floor(corners.min(axis=1)).astype(np.int64).T
+        right, lower = np.ceil(corners.max(axis=1)).astype(np.int64).T
+        if shape is not None:
+            height, width = shape[:2]
+            left, upper = np.clip(left, 0, width), np.clip(upper, 0, height)
+            right, lower = np.clip(right, left, width), np.clip(lower, upper, height)
+        return np.stack((left, upper, right, lower), axis=1)
+
+    def __eq__(self, other):
+        return isinstance(other, GeoTransform) and self.values == other.values
+
+    def __hash__(self):
+        return hash(self.values)
+
+    def __repr__(self):
+        return 'GeoTransform{}'.format(self.values)
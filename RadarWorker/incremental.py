@@ -0,0 +1,304 @@
+import logging, math, struct, zlib
+import numpy as np
+from fractions import Fraction
+from PIL import Image
+import compositing, pngwriter
+from metrics import METRICS
+
+TAG = 'IncrementalRenderer - '
+
+# Incremental overlay renderer, keeps the last composite and its inputs between renders
+#       - Output pixels are grouped in blocks, only blocks whose inputs changed are recomposited:
+#         map pixels that differ, and output pixels under the filter support of canvas pixels
+#         that differ (a new radar frame only touches the areas where the weather changed)
+#       - A viewport shifted by whole tiles keeps the composite of the tiles it still shows,
+#         only the tiles that came into view (and a few pixels along the edges) are rendered
+#       - The PNG of the composite is encoded in bands of rows, clean bands keep their
+#         compressed bytes from the previous save
+# Results are pixel for pixel those of compositing.render_overlay. Region resizes match a full
+# resize exactly only for dyadic canvas/map ratios (tile mosaics always are), other ratios and
+# large changes fall back to a full render
+class IncrementalRenderer:
+    BLOCK = 64
+    FULL_FRACTION = 0.6
+
+    def __init__(self, block=BLOCK, compress_level=6):
+        self.__block = block
+        self.__compress_level = compress_level
+        self.__state = None
+        self.__png = None
+        self.__renders = 0
+        self.__full_renders = 0
+        self.__unchanged = 0
+        self.__rendered_pixels = 0
+        self.__total_pixels = 0
+
+    # The last composite, an Image, None before the first render
+    @property
+    def image(self):
+        if self.__state is None:
+            return None
+        return Image.fromarray(self.__state['composite'], self.__state['mode'])
+
+    def stats(self):
+        return {'renders': self.__renders, 'full_renders': self.__full_renders, 'unchanged': self.__unchanged,
+                'rendered_fraction': self.__rendered_pixels / self.__total_pixels if self.__total_pixels else 0.0}
+
+    # Forgets the last composite, the next render is a full one
+    def reset(self):
+        self.__state = None
+        self.__png = None
+
+    # Overlays a decoded IEM frame on a map image covering gps_range, as compositing.render_overlay
+    def render(self, iem, map_img, gps_range):
+        with METRICS.timer('overlay'):
+            window = compositing.canvas_window(iem, gps_range)
+            state = {'map': np.array(map_img), 'window': window, 'size': map_img.size, 'mode': map_img.mode,
+                     'table': iem.palette_rgba(), 'indices': None}
+            if window is not None:
+                with METRICS.timer('crop'):
+                    state['indices'] = compositing.crop(iem.grid, window)
+            dirty = self._dirty_rects(iem, self.__state, state)
+            if dirty is None:
+                if window is None:
+                    state['canvas'] = compositing.no_data_canvas()
+                else:
+                    state['canvas'] = compositing.window_canvas(iem, window)
+                self._render_full(state)
+            else:
+                self._render_rects(state, *dirty)
+            self.__state = state
+            self.__renders += 1
+            return Image.fromarray(state['composite'], map_img.mode)
+
+    # Saves the last composite as a PNG, only the bands of rows that changed are compressed again
+    def save(self, path):
+        if self.__state is None:
+            raise Exception('Nothing rendered yet')
+        with METRICS.timer('save'):
+            if self.__png is None:
+                # Modes without a matching PNG color type are left to PIL
+                Image.fromarray(self.__state['composite'], self.__state['mode']).save(path, 'PNG')
+                return path
+            with open(path, 'wb') as writer:
+                writer.write(self.__png.encode(self.__state['composite']))
+        return path
+
+    def _render_full(self, state):
+        composite = state['map'].copy()
+        compositing.overlay(composite, state['canvas'], state['size'])
+        state['composite'] = composite
+        self.__full_renders += 1
+        self.__rendered_pixels += composite.shape[0] * composite.shape[1]
+        self.__total_pixels += composite.shape[0] * composite.shape[1]
+        self.__png = _BandedPNG.create(composite, self.__block, self.__compress_level)
+        logging.debug(TAG+'full render of a {} map'.format(state['size']))
+
+    # Recomposites the dirty rectangles, everything else comes from the previous composite
+    def _render_rects(self, state, rects, shifted):
+        composite = state['composite']
+        canvas, map_array, size = state['canvas'], state['map'], state['size']
+        rendered = 0
+        for left, upper, right, lower in rects:
+            composite[upper:lower, left:right] = map_array[upper:lower, left:right]
+            if (canvas.shape[1], canvas.shape[0]) == size:
+                region = canvas[upper:lower, left:right]
+            else:
+                region = compositing.resize_region(canvas, size, (left, upper, right, lower))
+            with METRICS.timer('paste'):
+                compositing.paste(composite[upper:lower, left:right], region)
+            rendered += (right - left) * (lower - upper)
+        if not rects:
+            self.__unchanged += 1
+        self.__rendered_pixels += rendered
+        self.__total_pixels += composite.shape[0] * composite.shape[1]
+        if self.__png is not None:
+            if shifted:
+                self.__png.invalidate()
+            else:
+                self.__png.invalidate_rows(rects)
+        logging.debug(TAG+'rendered {} rects, {} of {} pixels'.format(len(rects), rendered,
+                                                                       composite.shape[0] * composite.shape[1]))
+
+    # Returns (dirty rectangles (left, upper, right, lower), True if the view shifted) for a new render,
+    # None when a full render is needed
+    # Fills state['canvas'] and state['composite'] with what is reused, and updates the changed canvas
+    def _dirty_rects(self, iem, previous, state):
+        map_array, window, size = state['map'], state['window'], state['size']
+        if previous is None or previous['size'] != size or previous['mode'] != state['mode']:
+            return None
+        if (window is None) != (previous['window'] is None):
+            return None
+        if window is None:
+            in_width, in_height = previous['canvas'].shape[1], previous['canvas'].shape[0]
+            shift_in = (0, 0)
+        else:
+            in_width, in_height = window[2] - window[0], window[3] - window[1]
+            shift_in = (window[0] - previous['window'][0], window[1] - previous['window'][1])
+            if previous['indices'].shape != (in_height, in_width) or \
+                    not np.array_equal(previous['table'], state['table']):
+                return None
+        if not self.exact((in_height, in_width), size):
+            return None
+
+        # Shift of the view in map pixels, canvas pixels must fall on the same map pixels
+        width, height = size
+        if shift_in[0] * width % in_width or shift_in[1] * height % in_height:
+            return None
+        shift = (shift_in[0] * width // in_width, shift_in[1] * height // in_height)
+        if abs(shift[0]) >= width or abs(shift[1]) >= height:
+            return None
+
+        # Output pixels (x, y) show what was at (x + dx, y + dy) in the previous composite
+        dirty = np.ones((height, width), dtype=bool)
+        new, old = self._overlap(shift, (width, height))
+        differs = map_array[new] != previous['map'][old]
+        dirty[new] = differs.any(axis=2) if differs.ndim == 3 else differs
+
+        # IEM pixels that differ, or have nothing to compare with, dirty the output pixels they reach
+        changed = np.zeros((in_height, in_width), dtype=bool)
+        new_in, old_in = self._overlap(shift_in, (in_width, in_height))
+        if window is not None:
+            changed[:] = True
+            changed[new_in] = state['indices'][new_in] != previous['indices'][old_in]
+        scale_x, scale_y = in_width / width, in_height / height
+        step_x, step_y = max(int(self.__block * scale_x), 1), max(int(self.__block * scale_y), 1)
+        changed_blocks = self._reduce(changed, step_x, step_y)
+        if (in_width, in_height) == size:
+            dirty |= changed
+        else:
+            self._mark_reach(dirty, changed_blocks, (step_x, step_y), (scale_x, scale_y))
+            # The filter is cut short along the canvas edges, pixels near the old and new edges
+            # of an axis the view moved along differ (the resize is separable)
+            if shift[0]:
+                margin_x = math.ceil(3 * max(scale_x, 1) / scale_x) + 2
+                for edge in (0, width, -shift[0], width - shift[0]):
+                    dirty[:, max(edge - margin_x, 0):max(edge + margin_x, 0)] = True
+            if shift[1]:
+                margin_y = math.ceil(3 * max(scale_y, 1) / scale_y) + 2
+                for edge in (0, height, -shift[1], height - shift[1]):
+                    dirty[max(edge - margin_y, 0):max(edge + margin_y, 0)] = True
+
+        rects = self._rects(dirty)
+        area = sum((right - left) * (lower - upper) for left, upper, right, lower in rects)
+        if area > self.FULL_FRACTION * width * height:
+            return None
+
+        # The canvas keeps the pixels of unchanged blocks, changed blocks are built again
+        canvas = np.empty_like(previous['canvas'])
+        canvas[new_in] = previous['canvas'][old_in]
+        for row, column in zip(*np.nonzero(changed_blocks)):
+            box = (int(column * step_x), int(row * step_y),
+                   int(min((column + 1) * step_x, in_width)), int(min((row + 1) * step_y, in_height)))
+            canvas[box[1]:box[3], box[0]:box[2]] = compositing.canvas_region(iem, window, box)
+        composite = np.empty_like(map_array)
+        composite[new] = previous['composite'][old]
+        state['canvas'] = canvas
+        state['composite'] = composite
+        return rects, shift != (0, 0)
+
+    # Marks the output pixels reached by the filter support of the changed blocks of canvas pixels
+    @staticmethod
+    def _mark_reach(dirty, blocks, steps, scale):
+        (step_x, step_y), (scale_x, scale_y) = steps, scale
+        support_x, support_y = 3 * max(scale_x, 1), 3 * max(scale_y, 1)
+        height, width = dirty.shape
+        for row, column in zip(*np.nonzero(blocks)):
+            x0, x1 = column * step_x, (column + 1) * step_x
+            y0, y1 = row * step_y, (row + 1) * step_y
+            left = max(int(math.floor((x0 - support_x) / scale_x)) - 1, 0)
+            right = min(int(math.ceil((x1 + support_x) / scale_x)) + 1, width)
+            upper = max(int(math.floor((y0 - support_y) / scale_y)) - 1, 0)
+            lower = min(int(math.ceil((y1 + support_y) / scale_y)) + 1, height)
+            dirty[upper:lower, left:right] = True
+
+    # Merges dirty pixels into block aligned rectangles, one run of blocks per row of blocks
+    def _rects(self, dirty):
+        block = self.__block
+        height, width = dirty.shape
+        blocks = self._reduce(dirty, block, block)
+        rects = []
+        for row in range(blocks.shape[0]):
+            columns = np.flatnonzero(blocks[row])
+            if len(columns) == 0:
+                continue
+            breaks = np.flatnonzero(np.diff(columns) > 1)
+            starts = np.concatenate(([columns[0]], columns[breaks + 1]))
+            ends = np.concatenate((columns[breaks], [columns[-1]])) + 1
+            for start, end in zip(starts, ends):
+                rects.append((int(start * block), int(row * block),
+                              int(min(end * block, width)), int(min((row + 1) * block, height))))
+        return rects
+
+    # Any of every (step_y, step_x) block of a boolean array
+    @staticmethod
+    def _reduce(mask, step_x, step_y):
+        height, width = mask.shape
+        rows, columns = -(-height // step_y), -(-width // step_x)
+        padded = np.zeros((rows * step_y, columns * step_x), dtype=bool)
+        padded[:height, :width] = mask
+        return padded.reshape(rows, step_y, columns, step_x).any(axis=(1, 3))
+
+    # Slices of the new and old arrays that show the same area for a shift (dx, dy)
+    @staticmethod
+    def _overlap(shift, size):
+        (dx, dy), (width, height) = shift, size
+        new = (slice(max(-dy, 0), min(height - dy, height)), slice(max(-dx, 0), min(width - dx, width)))
+        old = (slice(max(dy, 0), min(height + dy, height)), slice(max(dx, 0), min(width + dx, width)))
+        return new, old
+
+    # True when regions of a canvas of shape (height, width) resize to size exactly as the whole does,
+    # pixel centers are then computed without rounding, which needs dyadic scales
+    @staticmethod
+    def exact(shape, size):
+        for in_size, out_size in ((shape[1], size[0]), (shape[0], size[1])):
+            denominator = Fraction(in_size, out_size).denominator
+            if denominator & (denominator - 1):
+                return False
+        return True
+
+# PNG writer that keeps the compressed bytes of every band of rows
+# Bands are compressed as independent deflate blocks of one zlib stream, so a band is only
+# compressed again when its rows changed
+class _BandedPNG:
+    def __init__(self, shape, band, compress_level):
+        self.__shape = shape
+        self.__band = band
+        self.__compress_level = compress_level
+        self.__bands = [None] * -(-shape[0] // band)
+
+    # Returns a writer for an array, None if PNG has no matching color type
+    @classmethod
+    def create(cls, array, band, compress_level):
+        if not pngwriter.supported(array):
+            return None
+        return cls(array.shape, band, compress_level)
+
+    def invalidate(self):
+        self.__bands = [None] * len(self.__bands)
+
+    def invalidate_rows(self, rects):
+        for left, upper, right, lower in rects:
+            for band in range(upper // self.__band, -(-lower // self.__band)):
+                self.__bands[band] = None
+
+    def encode(self, array):
+        adler, parts = 1, []
+        for i in range(len(self.__bands)):
+            if self.__bands[i] is None:
+                self.__bands[i] = self._compress(array[i * self.__band:(i + 1) * self.__band], i == len(self.__bands) - 1)
+            data, band_adler, band_length = self.__bands[i]
+            parts.append(data)
+            adler = pngwriter.adler32_combine(adler, band_adler, band_length)
+
+        # zlib header for the default window, the Adler-32 of all filtered rows closes the stream
+        idat = b'\x78\x9c' + b''.join(parts) + struct.pack('>I', adler)
+        return pngwriter.SIGNATURE + pngwriter.header(self.__shape) + pngwriter.chunk(b'IDAT', idat) + \
+            pngwriter.chunk(b'IEND', b'')
+
+    # Filters and deflates a band, the last band ends the deflate stream
+    def _compress(self, rows, last):
+        raw = pngwriter.filter_rows(rows)
+        compressor = zlib.compressobj(self.__compress_level, zlib.DEFLATED, -15)
+        data = compressor.compress(raw) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+        return data, zlib.adler32(raw), len(raw)
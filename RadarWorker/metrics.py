@@ -0,0 +1,164 @@
+import bisect, json, threading, time, config
+
+TAG = 'metrics - '
+
+# Upper bounds of the timing histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Timing histogram of one stage, bucket counts are not cumulative
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts))}
+
+# Context manager handed out while metrics are disabled, does nothing
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+# Times the body of a with block into a stage histogram
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+# Registry of stage timings and counters
+#       - Stages (download, decode, wld_parse, crop, filter, resize, paste, save, ...) get histograms
+#       - Counters hold totals such as downloaded bytes, cache hits and HTTP errors
+#       - Sinks are callables called as sink(kind, name, value) for every recorded value,
+#         kind being 'timing' or 'counter'
+#       - Snapshots are available as a dictionary, JSON or Prometheus text
+# While disabled, timer returns a shared no-op and count returns at once
+class Metrics:
+    PREFIX = 'radarworker'
+
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.__buckets = buckets
+        self.__histograms = {}
+        self.__counters = {}
+        self.__sinks = []
+        self.__lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_sink(self, sink):
+        with self.__lock:
+            self.__sinks.append(sink)
+
+    def remove_sink(self, sink):
+        with self.__lock:
+            self.__sinks.remove(sink)
+
+    # Use as: with METRICS.timer('decode'): ...
+    def timer(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    # Records one duration, in seconds, for a stage
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.__lock:
+            histogram = self.__histograms.get(stage)
+            if histogram is None:
+                histogram = self.__histograms[stage] = Histogram(self.__buckets)
+            histogram.observe(seconds)
+            sinks = list(self.__sinks)
+        for sink in sinks:
+            sink('timing', stage, seconds)
+
+    # Adds value to a counter
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+            sinks = list(self.__sinks)
+        for sink in sinks:
+            sink('counter', name, value)
+
+    def counter(self, name):
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def reset(self):
+        with self.__lock:
+            self.__histograms.clear()
+            self.__counters.clear()
+
+    def snapshot(self):
+        with self.__lock:
+            return {'timings': {stage: histogram.to_dict() for stage, histogram in self.__histograms.items()},
+                    'counters': dict(self.__counters)}
+
+    def to_json(self, indent=None):
+        return json.dumps(self.snapshot(), indent=indent)
+
+    # Prometheus text exposition format, histograms are exported with cumulative buckets
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        name = self.PREFIX + '_stage_seconds'
+        lines = ['# HELP {} Time spent per processing stage'.format(name), '# TYPE {} histogram'.format(name)]
+        for stage, histogram in sorted(snapshot['timings'].items()):
+            total = 0
+            for bound, count in histogram['buckets'].items():
+                total += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, total))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, histogram['sum']))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, histogram['count']))
+        for counter, value in sorted(snapshot['counters'].items()):
+            counter = '{}_{}_total'.format(self.PREFIX, counter)
+            lines.append('# TYPE {} counter'.format(counter))
+            lines.append('{} {}'.format(counter, value))
+        return '\n'.join(lines) + '\n'
+
+    # Writes a snapshot to path as 'json' or 'prometheus'
+    def write(self, path, format='json'):
+        if format == 'json':
+            text = self.to_json(indent=2)
+        elif format == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            raise Exception('Unknown metrics format {}'.format(format))
+        with open(path, 'w') as writer:
+            writer.write(text)
+
+# Metrics recorded by every worker in this process
+METRICS = Metrics(config.METRICS_ENABLED)
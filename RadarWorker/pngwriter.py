@@ -0,0 +1,112 @@
+import struct, zlib
+import numpy as np
+
+TAG = 'pngwriter - '
+
+# Minimal PNG and APNG writing for 8 bit RGB and RGBA arrays
+#       - Rows use the Sub filter, which stays within the row, so bands of rows and whole
+#         frames can be compressed independently (in other threads or processes)
+#       - APNG frames are written as they come, nothing but the current frame is held in memory
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color type per number of bands
+COLOR_TYPES = {3: 2, 4: 6}
+
+# True if an array can be written by this module
+def supported(array):
+    return array.ndim == 3 and array.shape[2] in COLOR_TYPES and array.dtype == np.uint8
+
+def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+# IHDR chunk of a (height, width, bands) array
+def header(shape):
+    height, width, bands = shape
+    return chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, COLOR_TYPES[bands], 0, 0, 0))
+
+# Sub filtered scanlines of a (height, width, bands) array, as bytes
+def filter_rows(rows):
+    bands = rows.shape[2]
+    filtered = np.empty((rows.shape[0], rows.shape[1] * bands + 1), dtype=np.uint8)
+    filtered[:, 0] = 1
+    flat = rows.reshape(rows.shape[0], -1)
+    filtered[:, 1:bands + 1] = flat[:, :bands]
+    filtered[:, bands + 1:] = flat[:, bands:] - flat[:, :-bands]
+    return filtered.tobytes()
+
+# zlib stream of the image data of an array, the payload of its IDAT or fdAT chunks
+def compress(array, level=6):
+    return zlib.compress(filter_rows(array), level)
+
+# Adler-32 of two concatenated buffers from the checksums of each, as zlib's adler32_combine
+def adler32_combine(adler1, adler2, length2):
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - remainder
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= base << 1:
+        sum2 -= base << 1
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+# Streams an animated PNG to a file, frames are the compress() data of same sized arrays
+# The number of frames goes in the header, so it has to be known up front
+class APNGWriter:
+    def __init__(self, path, shape, frames, delay_ms=500, loops=0):
+        if frames < 1:
+            raise Exception('An animation needs at least one frame')
+        self.__writer = open(path, 'wb')
+        self.__shape = shape
+        self.__frames = frames
+        self.__delay_ms = delay_ms
+        self.__written = 0
+        self.__sequence = 0
+        self.__writer.write(SIGNATURE + header(shape) + chunk(b'acTL', struct.pack('>II', frames, loops)))
+
+    @property
+    def written(self):
+        return self.__written
+
+    def add(self, data):
+        if self.__written == self.__frames:
+            raise Exception('All {} frames were already written'.format(self.__frames))
+        height, width = self.__shape[:2]
+        # Frames cover the whole image and replace the previous one
+        control = struct.pack('>IIIIIHHBB', self.__sequence, width, height, 0, 0, self.__delay_ms, 1000, 0, 0)
+        self.__writer.write(chunk(b'fcTL', control))
+        self.__sequence += 1
+        if self.__written == 0:
+            self.__writer.write(chunk(b'IDAT', data))
+        else:
+            self.__writer.write(chunk(b'fdAT', struct.pack('>I', self.__sequence) + data))
+            self.__sequence += 1
+        self.__written += 1
+
+    # Ends the file, raises if frames are missing as the header announced them
+    def close(self):
+        if self.__writer.closed:
+            return
+        try:
+            if self.__written != self.__frames:
+                raise Exception('Got {} of {} frames'.format(self.__written, self.__frames))
+            self.__writer.write(chunk(b'IEND', b''))
+        finally:
+            self.__writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.__writer.close()
+        return False
@@ -0,0 +1,184 @@
+import json, logging, os, shutil, config, fileio, framestore
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from workers import mapworker as MapWorker
+from PIL import Image
+
+TAG = 'RadarTiles - '
+
+# Pre-rendered z/x/y tile pyramids of IEM frames, on the EPSG:4326 grid of the GBIF map tiles
+#       - The deepest zoom is sampled from the frame grid, every other zoom is built from the
+#         zoom below it by taking the max of each 2x2 block of palette indices
+#       - Palette indices grow with dBZ, so the max keeps storm cores visible when zoomed out
+#       - Tiles with no visible data are not written, a missing tile is a transparent tile
+#       - The work is split by subtrees of tiles across a process pool, each process maps the
+#         stored frame grid once
+#       - A manifest is written last and marks a complete pyramid
+# Tiles are stored as {directory}/{frame key}/{z}/{x}/{y}.png
+MANIFEST = 'manifest.json'
+
+# Frame mapped in each worker process of the pool
+_process_frame = None
+
+# Directory holding the pyramid of a frame
+def pyramid_path(directory, key):
+    return os.path.join(directory, key)
+
+# Path of one tile of a pyramid
+def tile_path(directory, key, z, x, y):
+    return os.path.join(directory, key, str(z), str(x), '{}.png'.format(y))
+
+# Returns the manifest of a built pyramid, None if it was never completed
+def read_manifest(directory, key):
+    try:
+        with open(os.path.join(pyramid_path(directory, key), MANIFEST), 'r') as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+# Returns the path of a tile, None when the tile is empty (transparent)
+# Raises if the pyramid was not built or the zoom level is not part of it
+def get_tile(directory, key, z, x, y):
+    manifest = read_manifest(directory, key)
+    if manifest is None:
+        raise Exception('No tile pyramid for frame {}'.format(key))
+    if not manifest['min_zoom'] <= z <= manifest['max_zoom']:
+        raise Exception('Zoom {} is not part of the pyramid of frame {}'.format(z, key))
+    path = tile_path(directory, key, z, x, y)
+    return path if os.path.exists(path) else None
+
+# Range of tiles (x0, y0, x1, y1), end exclusive, covering the frame at zoom z
+def frame_tiles(transform, shape, z):
+    x_tiles, y_tiles = MapWorker.tile_counts(z)
+    (lat_min, lat_max), (lon_min, lon_max) = transform.bounds(shape)
+    x0 = int(np.floor((lon_min + 180) / (360 / x_tiles)))
+    x1 = int(np.ceil((lon_max + 180) / (360 / x_tiles)))
+    y0 = int(np.floor((90 - lat_max) / (180 / y_tiles)))
+    y1 = int(np.ceil((90 - lat_min) / (180 / y_tiles)))
+    return max(x0, 0), max(y0, 0), min(x1, x_tiles), min(y1, y_tiles)
+
+# Samples the palette indices of one tile from the frame grid, nearest pixel to each tile pixel center
+# Tile pixels outside of the frame are 0, which is transparent
+def sample_tile(frame, z, x, y, size):
+    (lat_min, lat_max), (lon_min, lon_max) = MapWorker.tile_range(x, y, z)
+    centers = (np.arange(size) + 0.5) / size
+    lons = lon_min + centers * (lon_max - lon_min)
+    lats = lat_max - centers * (lat_max - lat_min)
+
+    tile = np.zeros((size, size), dtype=np.uint8)
+    if frame.transform.is_north_up:
+        # Columns only depend on longitude and rows on latitude, sample on the outer product
+        columns = frame.transform.gps_to_pixels(np.column_stack((np.full(size, lats[0]), lons)))[:, 0]
+        rows = frame.transform.gps_to_pixels(np.column_stack((lats, np.full(size, lons[0]))))[:, 1]
+        col_ok = (columns >= 0) & (columns < frame.width)
+        row_ok = (rows >= 0) & (rows < frame.height)
+        if col_ok.any() and row_ok.any():
+            tile[np.ix_(row_ok, col_ok)] = frame.grid[np.ix_(rows[row_ok], columns[col_ok])]
+        return tile
+
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing='ij')
+    pixels = frame.transform.gps_to_pixels(np.column_stack((lat_grid.ravel(), lon_grid.ravel())))
+    inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < frame.width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < frame.height)
+    tile.ravel()[inside] = frame.grid[pixels[inside, 1], pixels[inside, 0]]
+    return tile
+
+# Builds a parent tile from its four children (None for empty children) by 2x2 max downsampling
+def downsample(children, size):
+    parent = np.zeros((size, size), dtype=np.uint8)
+    half = size // 2
+    for (dx, dy), child in children.items():
+        if child is None:
+            continue
+        block = child.reshape(half, 2, half, 2).max(axis=(1, 3))
+        parent[dy * half:(dy + 1) * half, dx * half:(dx + 1) * half] = block
+    return parent
+
+# True when no pixel of the tile is visible with the given (256, 4) RGBA table
+def is_empty(tile, table):
+    return not table[tile, 3].any()
+
+# Writes a tile as a palette png, transparency follows the frame's RGBA table
+def save_tile(frame, table, path, tile):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img = Image.fromarray(tile, 'P')
+    img.putpalette(frame.palette.ravel().tolist())
+    fileio.atomic_write(path, lambda file: img.save(file, 'PNG', transparency=table[:, 3].tobytes()))
+
+# Pool initializer, maps the stored frame once per worker process
+def _init_process(store_directory, img_path, wld_path):
+    global _process_frame
+    _process_frame = framestore.FrameStore(store_directory).load(img_path, wld_path)
+
+# Renders the subtree of tile (x, y) at zoom root_z down to max_zoom, writing non-empty tiles
+# Returns (x, y, root tile or None, number of tiles written)
+def _render_subtree(job):
+    directory, root_z, x, y, max_zoom, size = job
+    frame = _process_frame
+    table = frame.palette_rgba()
+    written = [0]
+
+    def render(z, tx, ty):
+        if z == max_zoom:
+            tile = sample_tile(frame, z, tx, ty, size)
+        else:
+            children = {(dx, dy): render(z + 1, 2 * tx + dx, 2 * ty + dy) for dy in (0, 1) for dx in (0, 1)}
+            if all(child is None for child in children.values()):
+                return None
+            tile = downsample(children, size)
+        if is_empty(tile, table):
+            return None
+        save_tile(frame, table, tile_path(directory, frame.key, z, tx, ty), tile)
+        written[0] += 1
+        return tile
+
+    return x, y, render(root_z, x, y), written[0]
+
+# Builds the tile pyramid of a frame stored in a FrameStore, zooms min_zoom to max_zoom
+# Subtrees rooted at split_zoom are rendered in parallel, the zooms above it by this process
+# Returns the manifest of the pyramid
+def build_pyramid(store, img_path, wld_path, directory, min_zoom=0, max_zoom=7, size=512,
+                  workers=None, split_zoom=None):
+    if size % 2:
+        raise Exception('Tile size must be even, got {}'.format(size))
+    frame = store.load(img_path, wld_path)
+    table = frame.palette_rgba()
+
+    # Tiles of an earlier build may not be part of this one, start from an empty pyramid
+    shutil.rmtree(pyramid_path(directory, frame.key), ignore_errors=True)
+    if split_zoom is None:
+        split_zoom = max(min_zoom, max_zoom - 3)
+    split_zoom = min(max(split_zoom, min_zoom), max_zoom)
+
+    x0, y0, x1, y1 = frame_tiles(frame.transform, frame.shape, split_zoom)
+    jobs = [(directory, split_zoom, x, y, max_zoom, size) for y in range(y0, y1) for x in range(x0, x1)]
+    logging.info(TAG+'rendering {} subtrees of frame {} at zooms {}-{}'.format(len(jobs), frame.key,
+                                                                              min_zoom, max_zoom))
+    with ProcessPoolExecutor(max_workers=workers or config.RENDER_WORKERS, initializer=_init_process,
+                             initargs=(store.directory, img_path, wld_path)) as executor:
+        results = list(executor.map(_render_subtree, jobs))
+
+    level = {(x, y): tile for x, y, tile, count in results}
+    written = sum(result[3] for result in results)
+
+    # Zooms above the split are only a few tiles, they are built here from the level below
+    for z in range(split_zoom - 1, min_zoom - 1, -1):
+        parents = {}
+        for (x, y) in set((x // 2, y // 2) for x, y in level):
+            children = {(dx, dy): level.get((2 * x + dx, 2 * y + dy)) for dy in (0, 1) for dx in (0, 1)}
+            if all(child is None for child in children.values()):
+                continue
+            tile = downsample(children, size)
+            if is_empty(tile, table):
+                continue
+            save_tile(frame, table, tile_path(directory, frame.key, z, x, y), tile)
+            parents[(x, y)] = tile
+            written += 1
+        level = parents
+
+    manifest = {'key': frame.key, 'min_zoom': min_zoom, 'max_zoom': max_zoom, 'tile_size': size,
+                'tiles': written}
+    os.makedirs(pyramid_path(directory, frame.key), exist_ok=True)
+    manifest_path = os.path.join(pyramid_path(directory, frame.key), MANIFEST)
+    fileio.atomic_write(manifest_path, json.dumps(manifest).encode())
+    logging.info(TAG+'wrote {} tiles for frame {}'.format(written, frame.key))
+    return manifest
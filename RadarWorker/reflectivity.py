@@ -0,0 +1,33 @@
+import numpy as np
+
+TAG = 'reflectivity - '
+
+# IEM n0q composites encode base reflectivity in 0.5 dBZ steps starting at -32 dBZ
+# Index 0 (no echo) therefore maps to -32 dBZ, the bottom of the scale
+N0Q_MIN_DBZ = -32.0
+N0Q_STEP_DBZ = 0.5
+
+# Lookup table from n0q palette index to dBZ, computed once
+N0Q_DBZ = (np.arange(256, dtype=np.float32) * N0Q_STEP_DBZ + N0Q_MIN_DBZ)
+N0Q_DBZ.flags.writeable = False
+
+# Converts an array of palette indices to dBZ values
+def index_to_dbz(indices):
+    return N0Q_DBZ[np.asarray(indices, dtype=np.uint8)]
+
+# Converts dBZ values to the lowest palette index representing at least that reflectivity
+def dbz_to_index(dbz):
+    index = np.ceil((np.asarray(dbz, dtype=np.float64) - N0Q_MIN_DBZ) / N0Q_STEP_DBZ)
+    return np.clip(index, 0, 255).astype(np.uint8)
+
+# Samples dBZ values from a grid of palette indices at integer pixel locations
+# Pixels that fall outside of the grid are returned as NaN
+def sample(grid, x, y):
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    height, width = grid.shape[:2]
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+
+    dbz = np.full(x.shape, np.nan, dtype=np.float32)
+    dbz[inside] = N0Q_DBZ[grid[y[inside], x[inside]]]
+    return dbz
@@ -0,0 +1,178 @@
+import logging, threading, time, config
+from concurrent.futures import ThreadPoolExecutor
+from metrics import METRICS
+from timeline import FRAME_STEP
+
+TAG = 'SimClock - '
+
+# Drives the sim_time of a RadarWorker, frames are loaded ahead of time in the background
+#       - The next lookahead 5 minute frames are fetched and decoded by loader threads, so a tick
+#         that crosses into a new frame only switches to an already decoded frame
+#       - A tick whose frame is not ready yet waits for it, waits are counted and timed in stats
+#       - Jumping in time cancels the loads outside of the new look-ahead window: queued loads are
+#         dropped, running ones stop before their next stage (fetch, then decode)
+# Downloads and png decodes release the GIL, and decoded frames land in the shared memory-mapped
+# frame store, so threads are enough to keep ticks off the critical path
+# Only the thread driving the clock should touch the RadarWorker while the clock is running
+class SimClock:
+    def __init__(self, radar_worker, lookahead=None, workers=None, step=FRAME_STEP):
+        self.__worker = radar_worker
+        self.__lookahead = config.SIM_LOOKAHEAD if lookahead is None else lookahead
+        self.__step = step
+        self.__executor = ThreadPoolExecutor(max_workers=workers or config.SIM_LOADER_WORKERS)
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__time = None
+        self.__slot = None
+
+        self.__ticks = 0
+        self.__switches = 0
+        self.__ready = 0
+        self.__waits = 0
+        self.__wait_seconds = 0.0
+        self.__max_wait = 0.0
+        self.__jumps = 0
+        self.__cancelled = 0
+
+    @property
+    def radar_worker(self):
+        return self.__worker
+
+    # Current time of the clock, not snapped, None before the clock was started
+    @property
+    def sim_time(self):
+        return self.__time
+
+    # 5 minute slot of the frame in use
+    @property
+    def frame_time(self):
+        return self.__slot
+
+    @property
+    def lookahead(self):
+        return self.__lookahead
+
+    # Changing the look-ahead depth takes effect at once, frames no longer wanted are cancelled
+    @lookahead.setter
+    def lookahead(self, lookahead):
+        self.__lookahead = lookahead
+        if self.__slot is not None:
+            self._schedule(self.__slot)
+
+    # Slots currently loading or loaded but not used yet
+    @property
+    def pending_times(self):
+        with self.__lock:
+            return sorted(self.__pending)
+
+    # Slots loaded ahead of time, a switch to them does not wait
+    @property
+    def ready_times(self):
+        with self.__lock:
+            return sorted(slot for slot, pending in self.__pending.items() if pending[0].done())
+
+    # Starts the clock at time, or at the sim_time of the worker, blocks until that frame is loaded
+    def start(self, sim_time=None):
+        return self.set_time(self.__worker.sim_time if sim_time is None else sim_time)
+
+    # Moves the clock forward by delta, one frame by default
+    def advance(self, delta=None):
+        if self.__time is None:
+            raise Exception('The clock has not been started')
+        return self.set_time(self.__time + (self.__step if delta is None else delta))
+
+    # Moves the clock to any time, returns the DecodedFrame in use
+    # Ticks within the same 5 minute slot cost nothing, crossing into a new slot switches frames
+    def set_time(self, sim_time):
+        slot = self.__worker.snap_time(sim_time)
+        self.__ticks += 1
+        self.__time = sim_time
+        if slot != self.__slot:
+            if self.__slot is not None and not self._in_window(self.__slot, slot):
+                self.__jumps += 1
+                logging.info(TAG+'jumped from {} to {}'.format(self.__slot, slot))
+            # Loads that are of no use anymore must not hold up the loader threads
+            self._cancel(lambda pending: pending != slot and not self._in_window(slot, pending))
+            paths, frame = self._take(slot)
+            self.__worker.use_frame(slot, paths, frame)
+            self.__slot = slot
+            self.__switches += 1
+        self._schedule(slot)
+        return self.__worker.frame
+
+    def stats(self):
+        return {'ticks': self.__ticks, 'switches': self.__switches, 'ready': self.__ready,
+                'waits': self.__waits, 'wait_rate': self.__waits / self.__switches if self.__switches else 0.0,
+                'wait_seconds': self.__wait_seconds, 'max_wait_seconds': self.__max_wait,
+                'jumps': self.__jumps, 'cancelled': self.__cancelled}
+
+    # Cancels every load and stops the loader threads
+    def close(self):
+        self._cancel(lambda pending: True)
+        self.__executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    # True if slot is one of the lookahead frames following current
+    def _in_window(self, current, slot):
+        return current < slot <= current + self.__lookahead * self.__step
+
+    # Returns (paths, frame) for a slot, waiting for its load or loading it in this thread
+    def _take(self, slot):
+        with self.__lock:
+            pending = self.__pending.pop(slot, None)
+        if pending is not None and pending[0].done():
+            self.__ready += 1
+            result = pending[0].result()
+        else:
+            start = time.perf_counter()
+            if pending is None:
+                result = self._load(slot, threading.Event())
+            else:
+                result = pending[0].result()
+            waited = time.perf_counter() - start
+            self.__waits += 1
+            self.__wait_seconds += waited
+            self.__max_wait = max(self.__max_wait, waited)
+            METRICS.observe('tick_wait', waited)
+            logging.debug(TAG+'waited %.3fs for the frame of %s', waited, slot)
+        if result is None:
+            raise Exception('Could not get IEM data for {}'.format(slot))
+        return result
+
+    # Loads the frames of the look-ahead window of slot that are not loading yet, nearest first
+    def _schedule(self, slot):
+        self._cancel(lambda pending: not self._in_window(slot, pending))
+        with self.__lock:
+            for i in range(1, self.__lookahead + 1):
+                ahead = slot + i * self.__step
+                if ahead not in self.__pending:
+                    cancelled = threading.Event()
+                    self.__pending[ahead] = (self.__executor.submit(self._load, ahead, cancelled), cancelled)
+
+    # Cancels the loads of the slots for which drop returns True
+    def _cancel(self, drop):
+        with self.__lock:
+            dropped = [slot for slot in self.__pending if drop(slot)]
+            for slot in dropped:
+                future, cancelled = self.__pending.pop(slot)
+                cancelled.set()
+                future.cancel()
+        if dropped:
+            self.__cancelled += len(dropped)
+            logging.debug(TAG+'cancelled the loads of %s frames', len(dropped))
+
+    # Fetches and decodes the frame of a slot, returns (paths, frame) or None
+    # Stops between stages once cancelled
+    def _load(self, slot, cancelled):
+        if cancelled.is_set():
+            return None
+        paths = self.__worker.frame_paths(slot)
+        if paths is None or cancelled.is_set():
+            return None
+        return paths, self.__worker.frame_store.load(*paths)
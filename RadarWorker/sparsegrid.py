@@ -0,0 +1,133 @@
+import numpy as np
+import config
+from framestore import DecodedFrame
+
+TAG = 'SparseGrid - '
+
+# Block-sparse grid of palette indices for mostly empty composites
+#       - The grid is cut in square blocks, blocks holding only the fill value (0, no echo) are
+#         not stored, all of them point to one shared fill block
+#       - Indexing works like a numpy grid for what frames use: slices return dense crops,
+#         integer arrays (as in grid[y, x] or grid[np.ix_(rows, columns)]) gather single pixels
+#       - A DecodedFrame holding a SparseGrid works with reflectivity lookups, overlays,
+#         tiles and routes unchanged, see compact
+# A CONUS n0q frame is about 66MB as indices and 264MB as RGBA, the busy 2020-01-03 02:00 frame
+# is 18MB as 64 pixel blocks (smaller blocks save a little more memory but crop slower)
+class SparseGrid:
+    def __init__(self, shape, block, index, blocks, fill=0):
+        self.shape = tuple(shape)
+        self.block = block
+        self.fill = fill
+        self.__index = index
+        self.__blocks = blocks
+
+    # Builds a sparse grid from a dense (height, width) uint8 grid
+    @classmethod
+    def from_dense(cls, grid, block=None, fill=0):
+        block = block or config.SPARSE_BLOCK
+        grid = np.asarray(grid)
+        height, width = grid.shape
+        rows, columns = -(-height // block), -(-width // block)
+
+        # One row of blocks at a time, so memory-mapped grids are never copied whole
+        index = np.empty((rows, columns), dtype=np.int32)
+        stored, count = [], 0
+        strip = np.empty((block, columns * block), dtype=np.uint8)
+        for row in range(rows):
+            lines = grid[row * block:(row + 1) * block]
+            strip[:] = fill
+            strip[:len(lines), :width] = lines
+            tiles = strip.reshape(block, columns, block).swapaxes(0, 1)
+            kept = np.flatnonzero((tiles != fill).any(axis=(1, 2)))
+            stored.append(tiles[kept])
+            index[row] = -1
+            index[row, kept] = np.arange(count, count + len(kept), dtype=np.int32)
+            count += len(kept)
+
+        # The fill block goes last, empty blocks point to it
+        blocks = np.empty((count + 1, block, block), dtype=np.uint8)
+        np.concatenate(stored, out=blocks[:count])
+        blocks[count] = fill
+        index[index < 0] = count
+        return cls((height, width), block, index, blocks, fill)
+
+    @property
+    def dtype(self):
+        return self.__blocks.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    # Bytes held by the grid
+    @property
+    def nbytes(self):
+        return self.__index.nbytes + self.__blocks.nbytes
+
+    # Number of stored blocks, and of blocks in the grid
+    @property
+    def stored_blocks(self):
+        return len(self.__blocks) - 1
+
+    @property
+    def total_blocks(self):
+        return self.__index.size
+
+    # Memory of the grid against the dense forms of the same frame
+    def memory(self):
+        pixels = self.shape[0] * self.shape[1]
+        return {'sparse_bytes': self.nbytes, 'dense_bytes': pixels, 'rgba_bytes': 4 * pixels,
+                'stored_blocks': self.stored_blocks, 'total_blocks': self.total_blocks,
+                'ratio_to_dense': self.nbytes / pixels, 'ratio_to_rgba': self.nbytes / (4 * pixels)}
+
+    def to_dense(self):
+        return self[0:self.shape[0], 0:self.shape[1]]
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or len(key) != 2:
+            raise Exception('SparseGrid takes (rows, columns) indices, got {}'.format(key))
+        rows, columns = key
+        if isinstance(rows, slice) and isinstance(columns, slice):
+            return self._crop(rows, columns)
+        if isinstance(rows, slice) or isinstance(columns, slice):
+            return self.to_dense()[key]
+        return self._gather(rows, columns)
+
+    # Pixels at integer (y, x) arrays, broadcast together, must be inside of the grid
+    def _gather(self, y, x):
+        y, x = np.broadcast_arrays(np.asarray(y, dtype=np.int64), np.asarray(x, dtype=np.int64))
+        height, width = self.shape
+        y = np.where(y < 0, y + height, y)
+        x = np.where(x < 0, x + width, x)
+        if y.size and (y.min() < 0 or y.max() >= height or x.min() < 0 or x.max() >= width):
+            raise IndexError('index out of bounds for a grid of shape {}'.format(self.shape))
+        block = self.block
+        return self.__blocks[self.__index[y // block, x // block], y % block, x % block]
+
+    # Dense copy of a crop given as two slices
+    def _crop(self, rows, columns):
+        height, width = self.shape
+        top, bottom, row_step = rows.indices(height)
+        left, right, column_step = columns.indices(width)
+        if row_step != 1 or column_step != 1:
+            return self.to_dense()[rows, columns]
+        bottom, right = max(bottom, top), max(right, left)
+        if bottom == top or right == left:
+            return np.empty((bottom - top, right - left), dtype=self.dtype)
+
+        # Gather the covering blocks, empty ones come from the fill block, then cut the crop out
+        block = self.block
+        first_row, first_column = top // block, left // block
+        index = self.__index[first_row:-(-bottom // block), first_column:-(-right // block)]
+        tiles = self.__blocks[index].swapaxes(1, 2).reshape(index.shape[0] * block, index.shape[1] * block)
+        offset_y, offset_x = top - first_row * block, left - first_column * block
+        return tiles[offset_y:offset_y + bottom - top, offset_x:offset_x + right - left]
+
+# Returns a DecodedFrame with the grid of frame held as a SparseGrid
+def compact(frame, block=None):
+    grid = frame.grid if isinstance(frame.grid, SparseGrid) else SparseGrid.from_dense(frame.grid, block)
+    return DecodedFrame(frame.key, grid, frame.wld, frame.palette, frame.transparency, frame.source)
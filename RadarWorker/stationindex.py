@@ -0,0 +1,192 @@
+import hashlib, logging, os, threading, fileio
+import numpy as np
+from txtparsing import DataWorker
+
+TAG = 'StationIndex - '
+
+# Mean earth radius in nautical miles
+EARTH_RADIUS_NM = 3440.065
+
+# Approximate useful range of a NEXRAD for base reflectivity, in nautical miles
+RADAR_RANGE_NM = 124.0
+
+# Columns of the station file kept in the index
+STATION_COLUMNS = ['icao', 'state', 'elevation', 'latitude', 'longitude']
+
+# Indexes already loaded in this process, path -> (mtime_ns, size, index)
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+# Converts (lat, lon) in degrees to unit vectors on the sphere
+def to_unit_vectors(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)), axis=-1)
+
+# Great circle distance in nautical miles for cosines of the central angle
+def cos_to_nm(cosines):
+    return EARTH_RADIUS_NM * np.arccos(np.clip(cosines, -1.0, 1.0))
+
+# Spatial index over radar stations for nearest station and radius queries
+#       - Station metadata is held in parallel numpy arrays, not one object per station
+#       - Distances are great circle distances, computed from dot products of unit vectors
+#       - Queries take an Nx2 array of (lat, lon) and are answered for all points at once
+#       - Points are processed in chunks so memory stays bounded for large batches
+# With a few hundred NEXRAD sites a dense dot product beats any tree, so no tree is built
+class StationIndex:
+    def __init__(self, icao, state, elevation, latitude, longitude, chunk_size=8192):
+        self.icao = np.asarray(icao, dtype='U4')
+        self.state = np.asarray(state, dtype='U2')
+        self.elevation = np.asarray(elevation, dtype=np.int32)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.__vectors = to_unit_vectors(self.latitude, self.longitude)
+        self.__chunk_size = chunk_size
+        logging.debug(TAG+'indexed {} stations'.format(len(self)))
+
+    # Builds an index from RadarStation objects
+    @classmethod
+    def from_stations(cls, stations):
+        return cls([station.icao for station in stations], [station.state for station in stations],
+                   [station.elevation for station in stations], [station.latitude for station in stations],
+                   [station.longitude for station in stations])
+
+    def __len__(self):
+        return len(self.icao)
+
+    # Position of a station in the index from its ICAO identifier
+    def find(self, icao):
+        matches = np.nonzero(self.icao == icao.strip())[0]
+        if len(matches) == 0:
+            raise Exception('No radar station {} in the index'.format(icao))
+        return int(matches[0])
+
+    # Cosines of the angles between every point and every station, chunk by chunk
+    def _cosines(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        for start in range(0, len(points), self.__chunk_size):
+            chunk = points[start:start + self.__chunk_size]
+            yield start, to_unit_vectors(chunk[:, 0], chunk[:, 1]) @ self.__vectors.T
+
+    # Returns (distances, indices), both (N, k), of the k nearest stations of every point
+    # Columns are ordered from nearest to farthest, distances are in nautical miles
+    def nearest(self, points, k=1):
+        k = min(k, len(self))
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        distances = np.empty((len(points), k), dtype=np.float64)
+        indices = np.empty((len(points), k), dtype=np.int64)
+
+        for start, cosines in self._cosines(points):
+            stop = start + len(cosines)
+            if k < len(self):
+                part = np.argpartition(-cosines, k - 1, axis=1)[:, :k]
+            else:
+                part = np.broadcast_to(np.arange(len(self)), cosines.shape)
+            part_cos = np.take_along_axis(cosines, part, axis=1)
+            order = np.argsort(-part_cos, axis=1, kind='stable')
+            indices[start:stop] = np.take_along_axis(part, order, axis=1)
+            distances[start:stop] = cos_to_nm(np.take_along_axis(part_cos, order, axis=1))
+        return distances, indices
+
+    # Returns (point_indices, station_indices, distances) for every station within radius_nm of a point
+    # Pairs are ordered by point, then by distance
+    def within(self, points, radius_nm):
+        min_cos = np.cos(radius_nm / EARTH_RADIUS_NM)
+        point_parts, station_parts, distance_parts = [], [], []
+
+        for start, cosines in self._cosines(points):
+            rows, cols = np.nonzero(cosines >= min_cos)
+            distance = cos_to_nm(cosines[rows, cols])
+            order = np.lexsort((distance, rows))
+            point_parts.append(rows[order] + start)
+            station_parts.append(cols[order])
+            distance_parts.append(distance[order])
+
+        if not point_parts:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        return (np.concatenate(point_parts), np.concatenate(station_parts), np.concatenate(distance_parts))
+
+    # Stations whose radar range covers each point, same format as within
+    def covering(self, points, range_nm=RADAR_RANGE_NM):
+        return self.within(points, range_nm)
+
+    # Number of stations covering each point
+    def coverage_count(self, points, range_nm=RADAR_RANGE_NM):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        point_indices = self.within(points, range_nm)[0]
+        return np.bincount(point_indices, minlength=len(points))
+
+# Returns the StationIndex for a fixed width station file, parsing the text file only when needed
+#       - Indexes are memoized per process, a later call only costs an os.stat
+#       - A binary .npz cache next to the file survives restarts, it is rebuilt when the file
+#         size or mtime changes and its content hash no longer matches
+#       - The station file itself is never written
+def load_station_index(stations_path, template_path, cache_path=None):
+    if cache_path is None:
+        cache_path = os.path.splitext(stations_path)[0] + '.npz'
+    stat = os.stat(stations_path)
+    with _loaded_lock:
+        loaded = _loaded.get(stations_path)
+        if loaded is not None and loaded[:2] == (stat.st_mtime_ns, stat.st_size):
+            return loaded[2]
+
+    index = _read_cache(cache_path, stations_path, stat)
+    if index is None:
+        index = _parse_stations(stations_path, template_path)
+        _write_cache(cache_path, index, stat, _file_hash(stations_path))
+
+    with _loaded_lock:
+        _loaded[stations_path] = (stat.st_mtime_ns, stat.st_size, index)
+    return index
+
+def _file_hash(path):
+    with open(path, 'rb') as reader:
+        return hashlib.sha1(reader.read()).hexdigest()
+
+# Parses the station file, stations are ordered by longitude as the sorted file used to be
+def _parse_stations(stations_path, template_path):
+    logging.info(TAG+'parsing '+stations_path)
+    worker = DataWorker(template_path)
+    rows = worker.get_vals(stations_path, STATION_COLUMNS)
+    columns = list(zip(*rows)) if rows else [[]] * len(STATION_COLUMNS)
+
+    icao = [value.strip() for value in columns[0]]
+    state = [value.strip() for value in columns[1]]
+    elevation = [int(value) for value in columns[2]]
+    latitude = np.array([float(value) for value in columns[3]], dtype=np.float64)
+    longitude = np.array([float(value) for value in columns[4]], dtype=np.float64)
+
+    order = np.argsort(longitude, kind='stable')
+    return StationIndex(np.asarray(icao, dtype='U4')[order], np.asarray(state, dtype='U2')[order],
+                        np.asarray(elevation, dtype=np.int32)[order], latitude[order], longitude[order])
+
+# Loads the binary cache, returns None if it is missing or out of date
+def _read_cache(cache_path, stations_path, stat):
+    try:
+        with np.load(cache_path) as cache:
+            arrays = {name: cache[name] for name in STATION_COLUMNS}
+            source = cache['source']
+            digest = str(cache['sha1'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+    if (int(source[0]), int(source[1])) != (stat.st_mtime_ns, stat.st_size):
+        # Touched but not changed, keep the cache and record the new mtime
+        if digest != _file_hash(stations_path):
+            return None
+        index = StationIndex(*[arrays[name] for name in STATION_COLUMNS])
+        _write_cache(cache_path, index, stat, digest)
+        return index
+    return StationIndex(*[arrays[name] for name in STATION_COLUMNS])
+
+# Writes the binary cache atomically, a failed write only costs a reparse next time
+def _write_cache(cache_path, index, stat, digest):
+    try:
+        fileio.atomic_write(cache_path, lambda file: np.savez(
+            file, icao=index.icao, state=index.state, elevation=index.elevation,
+            latitude=index.latitude, longitude=index.longitude,
+            source=np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64),
+            sha1=np.array(digest)))
+    except OSError:
+        logging.warning(TAG+'could not write station cache '+cache_path)
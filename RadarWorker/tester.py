@@ -1,5 +1,5 @@
 import logging, config
-from workers import MapWorker
+from workers import mapworker as MapWorker
 from datetime import datetime, timezone
 from RadarWorker import RadarWorker
 
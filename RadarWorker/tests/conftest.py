@@ -0,0 +1,12 @@
+import os, sys
+
+# Tests import the modules of the project directly, as the scripts of the project do
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Committed fixtures
+DATA = os.path.join(ROOT, 'data')
+FIXTURE_PNG = os.path.join(DATA, 'nexrad-data', 'n0q_202001030200.png')
+FIXTURE_WLD = os.path.join(DATA, 'nexrad-data', 'n0q_202001030200.txt')
+STATIONS = os.path.join(DATA, 'meta-data', 'nexrad-stations.txt')
+STATIONS_TEMPLATE = os.path.join(DATA, 'meta-data', 'nexrad-stations-template.txt')
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from conftest import FIXTURE_PNG, FIXTURE_WLD
+import areaindex, framestore, reflectivity
+
+THRESHOLDS = (20, 30, 40, 50)
+
+@pytest.fixture(scope='module')
+def frame(tmp_path_factory):
+    return framestore.FrameStore(str(tmp_path_factory.mktemp('frames'))).load(FIXTURE_PNG, FIXTURE_WLD)
+
+# Max dBZ, mean dBZ and coverage of a set of palette indices, NaN when empty
+def brute_stats(values):
+    if values.size == 0:
+        return np.nan, np.nan, np.full(len(THRESHOLDS), np.nan)
+    levels = reflectivity.dbz_to_index(THRESHOLDS).reshape(-1)
+    return (float(reflectivity.index_to_dbz(values.max())),
+            reflectivity.N0Q_MIN_DBZ + reflectivity.N0Q_STEP_DBZ * values.mean(dtype=np.float64),
+            np.array([(values >= level).mean() for level in levels]))
+
+def brute_box(frame, bbox):
+    left, upper, right, lower = frame.transform.window(bbox, frame.shape)
+    return brute_stats(np.asarray(frame.grid[upper:lower, left:right]))
+
+# Pixels whose center is within radius_nm, on the local flat earth of AreaIndex.disk_stats
+def brute_disk(frame, center, radius_nm):
+    t = frame.transform
+    fx, fy = t.gps_to_fractional([center])[0]
+    reach = radius_nm / (areaindex.NM_PER_DEGREE * abs(t.e) * np.cos(np.radians(center[0]))) + 2
+    top, bottom = min(max(int(fy - reach), 0), frame.height), min(max(int(fy + reach) + 1, 0), frame.height)
+    left, right = min(max(int(fx - reach), 0), frame.width), min(max(int(fx + reach) + 1, 0), frame.width)
+    y, x = np.mgrid[top:bottom, left:right]
+    dx, dy = x + 0.5 - fx, y + 0.5 - fy
+    dlat, dlon = t.d * dx + t.e * dy, t.a * dx + t.b * dy
+    distance = areaindex.NM_PER_DEGREE * np.hypot(dlat, np.cos(np.radians(center[0])) * dlon)
+    return brute_stats(np.asarray(frame.grid[top:bottom, left:right])[distance <= radius_nm])
+
+def assert_stats(result, expected, i):
+    max_dbz, mean_dbz, coverage = result
+    np.testing.assert_allclose(max_dbz[i], expected[0], equal_nan=True)
+    np.testing.assert_allclose(mean_dbz[i], expected[1], rtol=1e-5, atol=1e-4, equal_nan=True)
+    np.testing.assert_allclose(coverage[i], expected[2], atol=1e-12, equal_nan=True)
+
+def random_boxes(rng, count):
+    lat = rng.uniform(22, 51, count)
+    lon = rng.uniform(-127, -64, count)
+    height, width = rng.uniform(0.01, 3, count), rng.uniform(0.01, 5, count)
+    return [((a, a + h), (o, o + w)) for a, o, h, w in zip(lat, lon, height, width)]
+
+# Boxes inside of the grid, across each of its edges, around all of it and entirely outside of it
+EDGE_BOXES = [((34.0, 36.0), (-128.0, -124.0)), ((49.0, 52.0), (-100.0, -96.0)),
+              ((35.0, 37.0), (-66.0, -60.0)), ((20.0, 24.0), (-90.0, -85.0)),
+              ((48.0, 55.0), (-130.0, -120.0)), ((10.0, 60.0), (-140.0, -50.0)),
+              ((0.0, 10.0), (0.0, 20.0)), ((30.0, 40.0), (-60.0, -50.0)),
+              ((35.0, 35.0), (-90.0, -90.0))]
+
+@pytest.mark.parametrize('cell', [16, 64])
+def test_box_stats_match_brute_force(frame, cell):
+    index = areaindex.AreaIndex.from_frame(frame, cell=cell, thresholds=THRESHOLDS)
+    boxes = random_boxes(np.random.default_rng(cell), 150) + EDGE_BOXES
+    result = index.box_stats(boxes)
+    for i, bbox in enumerate(boxes):
+        assert_stats(result, brute_box(frame, bbox), i)
+    # The last boxes are outside of the grid or empty
+    assert np.isnan(result[0][-3:]).all()
+
+@pytest.mark.parametrize('cell', [16, 64])
+def test_disk_stats_match_brute_force(frame, cell):
+    index = areaindex.AreaIndex.from_frame(frame, cell=cell, thresholds=THRESHOLDS)
+    rng = np.random.default_rng(cell)
+    centers = np.column_stack((rng.uniform(22, 51, 150), rng.uniform(-127, -64, 150)))
+    radii = rng.uniform(0.1, 80, 150)
+    # Disks across the grid edges, entirely outside of it, and too small to hold a pixel center
+    centers = np.vstack((centers, [(50.0, -126.0), (23.2, -65.1), (36.0, -127.0), (51.0, -100.0),
+                                   (5.0, 5.0), (35.0, -90.0)]))
+    radii = np.concatenate((radii, [60.0, 40.0, 120.0, 30.0, 50.0, 0.05]))
+
+    result = index.disk_stats(centers, radii)
+    for i, (center, radius) in enumerate(zip(centers, radii)):
+        assert_stats(result, brute_disk(frame, center, radius), i)
+    assert np.isnan(result[0][-2:]).all()
+
+def test_frame_area_index_is_cached(frame):
+    assert frame.area_index(THRESHOLDS) is frame.area_index(THRESHOLDS)
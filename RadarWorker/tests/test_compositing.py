@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import FIXTURE_PNG, FIXTURE_WLD, DATA
+import os, compositing, framestore
+
+MAP = os.path.join(DATA, 'map-data', 'stitched.png')
+
+# Viewports inside of the IEM data, over its north west edge, partly south east of it and out of it
+VIEWPORTS = {'inside': ((35.0, 37.0), (-98.0, -94.0)),
+             'edge': ((49.0, 51.0), (-128.0, -124.0)),
+             'partial': ((22.0, 24.0), (-68.0, -62.0)),
+             'outside': ((0.0, 10.0), (0.0, 20.0))}
+
+RED = (230, 14, 14, 90)
+
+# The PIL paste / resize path RadarWorker.create_overlay_image used before compositing
+# (Image.ANTIALIAS was an alias of Image.LANCZOS)
+def legacy_overlay(map_img, gps_range, wld):
+    iem = Image.open(FIXTURE_PNG).convert('RGBA')
+    mp_lat_r, mp_lon_r = gps_range
+
+    def gps_to_pixel(gps_coor):
+        return (int((gps_coor[1] - wld[4]) / wld[0]), int((wld[5] - gps_coor[0]) / wld[0]))
+
+    iem_min_x, iem_min_y = gps_to_pixel((mp_lat_r[1], mp_lon_r[0]))
+    iem_max_x, iem_max_y = gps_to_pixel((mp_lat_r[0], mp_lon_r[1]))
+    if ((iem_max_x > iem.width and iem_min_x > iem.width) or iem_max_x < 0 or
+            (iem_max_y > iem.height and iem_min_y > iem.height) or iem_max_y < 0):
+        canvas = Image.new('RGBA', (200, 100), RED)
+        canvas = canvas.resize(map_img.size, Image.LANCZOS)
+        map_img.paste(canvas, (0, 0), canvas)
+        return map_img
+
+    add_x = [max(-iem_min_x, 0), max(iem_max_x - iem.width, 0)]
+    add_y = [max(-iem_min_y, 0), max(iem_max_y - iem.height, 0)]
+    crop = iem.crop((max(iem_min_x, 0), max(iem_min_y, 0), min(iem_max_x, iem.width), min(iem_max_y, iem.height)))
+    canvas = Image.new('RGBA', (crop.width + sum(add_x), crop.height + sum(add_y)), (0, 0, 0, 0))
+
+    # Transparency filter, black pixels become transparent
+    crop.putdata([(0, 0, 0, 0) if pixel[:3] == (0, 0, 0) else pixel for pixel in crop.getdata()])
+    canvas.paste(crop, (add_x[0], add_y[0]), crop)
+
+    canv_h = canvas.height
+    for size, position in (((crop.width, add_y[0]), (add_x[0], 0)),
+                           ((add_x[0], canv_h), (0, 0)),
+                           ((add_x[1], canv_h), (crop.width + add_x[0], 0)),
+                           ((crop.width, add_y[1]), (add_x[0], crop.height + add_y[0]))):
+        red = Image.new('RGBA', size, RED)
+        canvas.paste(red, position, red)
+
+    canvas = canvas.resize(map_img.size, Image.LANCZOS)
+    map_img.paste(canvas, (0, 0), canvas)
+    return map_img
+
+@pytest.fixture(scope='module')
+def frame(tmp_path_factory):
+    return framestore.FrameStore(str(tmp_path_factory.mktemp('frames'))).load(FIXTURE_PNG, FIXTURE_WLD)
+
+@pytest.fixture(scope='module')
+def map_img():
+    return Image.open(MAP).convert('RGBA').resize((400, 200))
+
+@pytest.mark.parametrize('name', sorted(VIEWPORTS))
+def test_render_overlay_matches_pil_path(frame, map_img, name):
+    gps_range = VIEWPORTS[name]
+    expected = legacy_overlay(map_img.copy(), gps_range, frame.wld)
+    rendered = compositing.render_overlay(frame, map_img.copy(), gps_range)
+    assert np.array_equal(np.asarray(rendered), np.asarray(expected))
+
+def test_paste_and_fill_match_pil_in_strips(monkeypatch):
+    rng = np.random.default_rng(0)
+    dst = rng.integers(0, 256, (61, 47, 4), dtype=np.uint8)
+    src = rng.integers(0, 256, (40, 30, 4), dtype=np.uint8)
+    src[::3, ::2, 3] = 0
+    expected = Image.fromarray(dst, 'RGBA')
+    src_img = Image.fromarray(src, 'RGBA')
+    expected.paste(src_img, (25, -7), src_img)
+    red = Image.new('RGBA', (20, 80), RED)
+    expected.paste(red, (-5, 3), red)
+
+    # A small strip size makes the blend run over many strips
+    monkeypatch.setattr(compositing, 'BLEND_PIXELS', 64)
+    out = compositing.paste(dst.copy(), src, (25, -7))
+    out = compositing.fill(out, (-5, 3, 15, 83), RED)
+    assert np.array_equal(out, np.asarray(expected))
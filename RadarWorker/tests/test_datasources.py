@@ -0,0 +1,109 @@
+import datetime, os, shutil, tarfile, zipfile
+import numpy as np
+import pytest
+from conftest import FIXTURE_PNG, FIXTURE_WLD, ROOT
+import datasources, framecache, framestore
+
+FRAME_TIME = datetime.datetime(2020, 1, 3, 2, 0)
+MISSING_TIME = datetime.datetime(2020, 1, 3, 2, 5)
+# A frame with its png but no wld, never complete
+HALF_TIME = datetime.datetime(2020, 1, 3, 2, 10)
+
+with open(FIXTURE_PNG, 'rb') as reader:
+    PNG = reader.read()
+with open(FIXTURE_WLD, 'rb') as reader:
+    WLD = reader.read()
+
+# IEM tree holding the fixture frame, and the png alone of another frame
+@pytest.fixture(scope='module')
+def tree(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('iem'))
+    for time, files in ((FRAME_TIME, ((FIXTURE_PNG, '.png'), (FIXTURE_WLD, '.wld'))), (HALF_TIME, ((FIXTURE_PNG, '.png'),))):
+        for path, ext in files:
+            target = os.path.join(root, datasources.relative_path('n0q', time, ext))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+    return root
+
+# Archives of the tree in the IEM layout, and of flat files with the wld saved as .txt like the fixture
+@pytest.fixture(scope='module', params=['tar', 'tar.gz', 'tar.xz', 'zip', 'flat.zip', 'flat.tar.bz2'])
+def archive(request, tree, tmp_path_factory):
+    kind = request.param
+    path = str(tmp_path_factory.mktemp('archives') / ('n0q.' + kind))
+    members = [(os.path.join(tree, datasources.relative_path('n0q', time, ext)), datasources.relative_path('n0q', time, ext))
+               for time, ext in ((FRAME_TIME, '.png'), (HALF_TIME, '.png'), (FRAME_TIME, '.wld'))]
+    if kind.startswith('flat'):
+        members = [(FIXTURE_WLD, os.path.basename(FIXTURE_WLD))] + [(source, os.path.basename(name)) for source, name in members[:2]]
+    # Other files of the archive are skipped
+    members.append((FIXTURE_WLD, 'README.md'))
+    if kind.endswith('zip'):
+        with zipfile.ZipFile(path, 'w') as writer:
+            for source, name in members:
+                writer.write(source, name)
+    else:
+        mode = 'w:' + (kind.rsplit('.', 1)[-1] if kind.count('.') else '')
+        with tarfile.open(path, mode) as writer:
+            for source, name in members:
+                writer.add(source, name)
+    return path
+
+def test_directory_source_reads_frames_in_place(tree):
+    source = datasources.open_source(tree)
+    assert isinstance(source, datasources.DirectorySource)
+    paths = source.local_paths('n0q', FRAME_TIME)
+    assert paths == tuple(os.path.join(tree, datasources.relative_path('n0q', FRAME_TIME, ext)) for ext in ('.png', '.wld'))
+    assert source.fetch('n0q', FRAME_TIME) == (PNG, WLD)
+    for time in (MISSING_TIME, HALF_TIME):
+        assert source.local_paths('n0q', time) is None
+        assert source.fetch('n0q', time) is None
+    assert list(source.fetch_many('n0q', [FRAME_TIME, MISSING_TIME, HALF_TIME])) == [(FRAME_TIME, (PNG, WLD))]
+
+def test_archive_source_reads_frames(archive):
+    source = datasources.open_source(archive)
+    assert isinstance(source, datasources.ArchiveSource)
+    assert source.local_paths('n0q', FRAME_TIME) is None
+    assert source.fetch('n0q', FRAME_TIME) == (PNG, WLD)
+    assert source.fetch('n0q', MISSING_TIME) is None
+    assert source.fetch('n0q', HALF_TIME) is None
+    assert list(source.fetch_many('n0q', [MISSING_TIME, HALF_TIME, FRAME_TIME])) == [(FRAME_TIME, (PNG, WLD))]
+    assert list(source.fetch_many('n0q', [])) == []
+
+def test_sources_reject_what_they_cannot_read(tmp_path):
+    with pytest.raises(Exception):
+        datasources.DirectorySource(str(tmp_path / 'missing'))
+    with pytest.raises(Exception):
+        datasources.open_source(str(tmp_path / 'missing.tar'))
+    with pytest.raises(Exception):
+        datasources.open_source(FIXTURE_PNG)
+
+# RadarWorker replaying the fixture frame from a source, as a sim without network would
+# Returns the prefetched paths of the frame and whether the frame cache holds it
+def replay(spec, tmp_path, monkeypatch):
+    # RadarWorker reads the station files from paths relative to the project
+    monkeypatch.chdir(ROOT)
+    from RadarWorker import RadarWorker
+
+    cache = framecache.FrameCache(str(tmp_path / 'nexrad'), 10**9)
+    worker = RadarWorker(FRAME_TIME, frame_cache=cache, frame_store=framestore.FrameStore(str(tmp_path / 'frames')),
+                         source=datasources.open_source(spec))
+    frames = worker.prefetch(FRAME_TIME, HALF_TIME)
+    assert list(frames) == [FRAME_TIME]
+
+    worker.pull_data()
+    expected = framestore.FrameStore(str(tmp_path / 'expected')).load(FIXTURE_PNG, FIXTURE_WLD)
+    assert worker.frame.wld == expected.wld
+    assert np.array_equal(worker.frame.grid, expected.grid)
+    assert worker.get_frame(MISSING_TIME) is None
+    assert worker.http_errors == 0
+    return frames[FRAME_TIME], framecache.FrameCache.key('n0q', FRAME_TIME) in cache
+
+def test_radar_worker_replays_a_directory(tree, tmp_path, monkeypatch):
+    paths, cached = replay(tree, tmp_path, monkeypatch)
+    # Frames of a directory are used in place
+    assert paths[0].startswith(tree) and not cached
+
+def test_radar_worker_replays_an_archive(archive, tmp_path, monkeypatch):
+    paths, cached = replay(archive, tmp_path, monkeypatch)
+    assert cached
+    with open(paths[0], 'rb') as reader:
+        assert reader.read() == PNG
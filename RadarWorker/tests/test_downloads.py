@@ -0,0 +1,146 @@
+import datetime, os, threading, time
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from conftest import FIXTURE_PNG, FIXTURE_WLD, ROOT
+import datasources, downloader, framecache, framestore
+
+FRAME_TIME = datetime.datetime(2020, 1, 3, 2, 0)
+
+with open(FIXTURE_PNG, 'rb') as reader:
+    PNG = reader.read()
+with open(FIXTURE_WLD, 'rb') as reader:
+    WLD = reader.read()
+
+# Stand-in for the IEM archive, serves the fixture frame at every time of 2020-01-03
+#       - failures maps a path to the status codes it answers with before serving the file
+#       - delay slows every answer down, so concurrent downloads overlap
+class IemServer:
+    def __init__(self, failures=None, delay=0):
+        self.failures = dict(failures or {})
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.__server.server_address[1])
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    # Status and body for a path, called with the lock held
+    def _answer(self, path):
+        self.requests.append(path)
+        failures = self.failures.get(path)
+        if failures:
+            return failures.pop(0), b''
+        name = os.path.basename(path)
+        if not path.startswith('/2020/01/03/GIS/uscomp/n0q_20200103'):
+            return 404, b''
+        if name.endswith('.png'):
+            return 200, PNG
+        if name.endswith('.wld'):
+            return 200, WLD
+        return 404, b''
+
+    def _handler(self):
+        server, lock = self, self.__lock
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    status, body = server._answer(self.path)
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                time.sleep(server.delay)
+                with lock:
+                    server.active -= 1
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(failures=None, delay=0):
+        servers.append(IemServer(failures, delay).start())
+        return servers[-1]
+
+    yield start
+    for running in servers:
+        running.stop()
+
+def source(url, retries=3):
+    return datasources.HttpSource(url, downloader.create_session(retries=retries, backoff=0))
+
+def frame_path(time, ext):
+    return '/' + datasources.relative_path('n0q', time, ext)
+
+def test_download_retries_on_429_and_5xx(server):
+    png, wld = frame_path(FRAME_TIME, '.png'), frame_path(FRAME_TIME, '.wld')
+    iem = server({png: [429, 503], wld: [500]})
+    http = source(iem.url)
+
+    assert http.fetch('n0q', FRAME_TIME) == (PNG, WLD)
+    assert iem.requests.count(png) == 3
+    assert iem.requests.count(wld) == 2
+    assert http.http_errors == 0
+
+def test_download_gives_up_after_retries(server):
+    png = frame_path(FRAME_TIME, '.png')
+    iem = server({png: [503] * 10})
+    http = source(iem.url, retries=2)
+
+    assert http.fetch('n0q', FRAME_TIME) is None
+    assert iem.requests.count(png) == 3
+    assert frame_path(FRAME_TIME, '.wld') not in iem.requests
+    assert http.http_errors == 1
+
+def test_missing_frame_is_not_retried(server):
+    missing = datetime.datetime(2020, 1, 4, 2, 0)
+    iem = server()
+    http = source(iem.url)
+
+    assert http.fetch('n0q', missing) is None
+    assert iem.requests == [frame_path(missing, '.png')]
+    assert http.http_errors == 1
+
+def test_prefetch_downloads_in_parallel(server, tmp_path, monkeypatch):
+    # RadarWorker reads the station files from paths relative to the project
+    monkeypatch.chdir(ROOT)
+    from RadarWorker import RadarWorker
+
+    times = [FRAME_TIME + datetime.timedelta(minutes=5 * i) for i in range(6)]
+    iem = server({frame_path(times[1], '.png'): [502]}, delay=0.2)
+    cache = framecache.FrameCache(str(tmp_path / 'nexrad'), 10**9)
+    worker = RadarWorker(FRAME_TIME, frame_cache=cache, frame_store=framestore.FrameStore(str(tmp_path / 'frames')),
+                         source=source(iem.url))
+
+    frames = worker.prefetch(times[0], times[-1], workers=4)
+    assert list(frames) == times
+    for png_path, wld_path in frames.values():
+        with open(png_path, 'rb') as reader:
+            assert reader.read() == PNG
+    assert iem.max_active > 1
+
+    # Cached frames are not downloaded again
+    count = len(iem.requests)
+    assert worker.prefetch(times[0], times[-1], workers=4) == frames
+    assert len(iem.requests) == count
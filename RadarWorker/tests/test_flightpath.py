@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+import flightpath, framestore, reflectivity
+from stationindex import to_unit_vectors, cos_to_nm
+
+# Small grid of 20x16 pixels, half a degree wide and a quarter degree tall, with exact binary
+# values so segments through pixel corners cross both boundaries at the same fraction
+WLD = (0.5, 0.0, 0.0, -0.25, -100.0, 40.0)
+DENSE = 20000
+
+@pytest.fixture(scope='module')
+def frame():
+    grid = np.random.default_rng(15).integers(0, 256, size=(16, 20), dtype=np.uint8)
+    return framestore.DecodedFrame('grid', grid, WLD, np.zeros((256, 3), dtype=np.uint8))
+
+# (lat, lon) of a fractional pixel (x, y)
+def gps(x, y):
+    return (WLD[5] + WLD[3] * y, WLD[4] + WLD[0] * x)
+
+def length_nm(start, end):
+    return float(cos_to_nm(np.dot(to_unit_vectors(*start), to_unit_vectors(*end))))
+
+# Pixels crossed by the segment in order, with the share of its length spent in each,
+# from DENSE evenly spaced points along it
+def dense_cells(frame, start, end):
+    fraction = (np.arange(DENSE) + 0.5) / DENSE
+    points = np.asarray(start) + fraction[:, np.newaxis] * (np.asarray(end) - np.asarray(start))
+    pixels = frame.gps_to_pixels(points)
+    cells, first, counts = np.unique(pixels, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    return [tuple(cell) for cell in cells[order]], counts[order] / DENSE
+
+# Segments of fractional pixels (x, y): along rows and columns, along pixel boundaries, diagonals
+# through pixel corners, shallow and steep diagonals, and segments leaving the grid
+SEGMENTS = [((0.5, 3.5), (9.5, 3.5)), ((7.5, 12.2), (7.5, 1.1)), ((2.0, 6.0), (11.0, 6.0)),
+            ((4.0, 0.5), (4.0, 9.5)), ((2.0, 2.0), (9.0, 9.0)), ((12.0, 1.0), (3.0, 10.0)),
+            ((1.0, 1.0), (7.0, 4.0)), ((0.3, 0.7), (17.9, 5.2)), ((3.2, 0.4), (5.9, 15.6)),
+            ((18.7, 14.1), (1.3, 2.9)), ((15.5, 8.5), (26.5, 8.5)), ((10.2, 12.3), (14.8, 21.4)),
+            ((-3.5, -2.5), (4.5, 5.5)), ((-6.2, 18.4), (25.3, -1.7)), ((8.25, 4.75), (8.25, 4.75))]
+
+def test_traversal_visits_the_pixels_of_dense_sampling(frame):
+    routes = [(gps(*start), gps(*end)) for start, end in SEGMENTS]
+    route_ids, latitude, longitude, weights, fraction, segment = flightpath._traverse(frame, routes)
+    pixels = frame.gps_to_pixels(np.stack((latitude, longitude), axis=1))
+    for route_id, (start, end) in enumerate(routes):
+        ours = route_ids == route_id
+        # The last sample is the end waypoint, with no weight
+        assert weights[ours][-1] == 0 and fraction[ours][-1] == 1
+        cells = [tuple(pixel) for pixel in pixels[ours][:-1]]
+        length = length_nm(start, end)
+        if length == 0:
+            # A repeated waypoint is sampled once, in its own pixel
+            assert cells == [tuple(frame.gps_to_pixels([start])[0])] and weights[ours].sum() == 0
+            continue
+
+        expected, shares = dense_cells(frame, start, end)
+        assert cells == expected, 'segment {} visits {}, expected {}'.format(route_id, cells, expected)
+        np.testing.assert_allclose(weights[ours][:-1], shares * length, atol=2 * length / DENSE)
+        assert weights[ours].sum() == pytest.approx(length)
+
+def test_corner_segments_do_not_visit_neighbours(frame):
+    route_ids, latitude, longitude, weights, fraction, segment = flightpath._traverse(
+        frame, [(gps(2.0, 2.0), gps(6.0, 6.0)), (gps(6.0, 2.0), gps(2.0, 6.0))])
+    pixels = frame.gps_to_pixels(np.stack((latitude, longitude), axis=1))
+    # Both diagonals only cross pixel corners, the last sample of each route is its end waypoint
+    assert [tuple(pixel) for pixel in pixels[route_ids == 0][:-1]] == [(2, 2), (3, 3), (4, 4), (5, 5)]
+    assert [tuple(pixel) for pixel in pixels[route_ids == 1][:-1]] == [(5, 2), (4, 3), (3, 4), (2, 5)]
+    assert np.allclose(weights[weights > 0], weights[0])
+
+def test_polyline_profile_and_scores_match_dense_sampling(frame):
+    waypoints = [gps(-2.5, 3.5), gps(6.0, 3.5), gps(6.0, 10.0), gps(13.7, 2.2), gps(23.0, 14.5)]
+    thresholds = (-10, 10, 30, 50)
+    profile = flightpath.route_profile(frame, waypoints)
+
+    # Dense samples of every leg, each standing for an equal share of its leg
+    dbz, weights = [], []
+    for start, end in zip(waypoints[:-1], waypoints[1:]):
+        cells, shares = dense_cells(frame, start, end)
+        cells = np.array(cells)
+        dbz.append(reflectivity.sample(frame.grid, cells[:, 0], cells[:, 1]))
+        weights.append(shares * length_nm(start, end))
+    dbz, weights = np.concatenate(dbz), np.concatenate(weights)
+    total = weights.sum()
+
+    assert profile.distance[-1] == pytest.approx(total)
+    assert profile.max_dbz == np.nanmax(dbz)
+    summary = profile.summary(thresholds)
+    max_dbz, above = flightpath.score_routes(frame, [waypoints, waypoints[1:3]], thresholds)
+    for i, threshold in enumerate(thresholds):
+        expected = weights[dbz >= threshold].sum()
+        assert summary['distance_above'][threshold] == pytest.approx(expected, abs=len(dbz) * total / DENSE)
+        assert above[0, i] == pytest.approx(summary['distance_above'][threshold])
+    assert max_dbz[0] == profile.max_dbz
+
+def test_routes_outside_of_the_grid_score_nan(frame):
+    max_dbz, above = flightpath.score_routes(frame, [[gps(-5.0, -5.0), gps(-1.0, -3.0)], [gps(30.0, 4.0)]])
+    assert np.isnan(max_dbz).all()
+    assert (above == 0).all()
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from conftest import FIXTURE_WLD
+import framestore
+from geotransform import GeoTransform
+
+SHAPE = (5400, 12200)
+
+# The IEM transform, rectangular pixels, and a rotated and skewed transform
+TRANSFORMS = {'iem': framestore.read_wld(FIXTURE_WLD),
+              'rectangular': (0.01, 0.0, 0.0, -0.004, -126.0, 50.0),
+              'skewed': (0.004, -0.001, 0.0015, -0.005, -126.0, 50.0)}
+
+# (lat, lon) of fractional pixels (x, y)
+def gps_of(transform, pixels):
+    pixels = np.asarray(pixels, dtype=np.float64)
+    return np.column_stack((transform.d * pixels[:, 0] + transform.e * pixels[:, 1] + transform.f,
+                            transform.a * pixels[:, 0] + transform.b * pixels[:, 1] + transform.c))
+
+@pytest.mark.parametrize('name', sorted(TRANSFORMS))
+def test_single_and_batched_pixels_agree_inside_of_the_grid(name):
+    transform = GeoTransform.from_wld(TRANSFORMS[name])
+    rng = np.random.default_rng(18)
+    height, width = SHAPE
+    pixels = np.column_stack((rng.uniform(0, width, 5000), rng.uniform(0, height, 5000)))
+    # Pixel corners and centers, along the edges of the grid
+    corners = np.array([(x, y) for x in (0, 1, 2, 6100, width - 1) for y in (0, 1, 2700, height - 1)], dtype=np.float64)
+    points = gps_of(transform, np.vstack((pixels, corners, corners + 0.5)))
+
+    batched = transform.gps_to_pixels(points)
+    single = np.array([transform.gps_to_pixel(point) for point in points])
+    inside = (batched[:, 0] >= 0) & (batched[:, 0] < width) & (batched[:, 1] >= 0) & (batched[:, 1] < height)
+    assert inside[:len(pixels)].all()
+    assert np.array_equal(single[inside], batched[inside])
+    assert np.array_equal(batched[:len(pixels)], np.floor(pixels).astype(np.int64))
+
+@pytest.mark.parametrize('name', sorted(TRANSFORMS))
+def test_single_pixels_truncate_outside_of_the_grid(name):
+    transform = GeoTransform.from_wld(TRANSFORMS[name])
+    points = gps_of(transform, [(-0.5, 10.5), (10.5, -0.5), (-0.5, -0.5), (-3.5, 10.5), (12210.5, 5420.5)])
+    single = [transform.gps_to_pixel(point) for point in points]
+    batched = [tuple(pixel) for pixel in transform.gps_to_pixels(points)]
+    # Less than a pixel west or north of the origin, truncation lands on the first column or row
+    assert single == [(0, 10), (10, 0), (0, 0), (-3, 10), (12210, 5420)]
+    assert batched == [(-1, 10), (10, -1), (-1, -1), (-4, 10), (12210, 5420)]
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import FIXTURE_PNG, FIXTURE_WLD, DATA
+import compositing, framestore, incremental
+
+MAP = os.path.join(DATA, 'map-data', 'stitched.png')
+
+# Map images are cut from one base image at 0.01 degree per pixel, half the IEM resolution,
+# so viewports shifted by whole map pixels show the same map pixels
+MAP_ORIGIN = (51.0, -128.0)
+MAP_DEGREES = 0.01
+
+def viewport(lat_max, lon_min, size=(512, 256)):
+    width, height = size
+    return ((lat_max - height * MAP_DEGREES, lat_max), (lon_min, lon_min + width * MAP_DEGREES))
+
+# Frame with some palette indices changed, as the next radar frame would
+def changed_frame(frame, box, index):
+    grid = np.array(frame.grid)
+    left, upper, right, lower = box
+    grid[upper:lower, left:right] = index
+    return framestore.DecodedFrame(frame.key + '-changed', grid, frame.wld, frame.palette,
+                                   frame.transparency)
+
+@pytest.fixture(scope='module')
+def frames(tmp_path_factory):
+    frame = framestore.FrameStore(str(tmp_path_factory.mktemp('frames'))).load(FIXTURE_PNG, FIXTURE_WLD)
+    # Echoes appearing over central Missouri and over the north west corner of the grid
+    return {'a': frame, 'b': changed_frame(frame, (6300, 2250, 6350, 2300), 120),
+            'c': changed_frame(frame, (0, 0, 60, 40), 90)}
+
+@pytest.fixture(scope='module')
+def base_map():
+    return Image.open(MAP).convert('RGBA')
+
+def map_image(base_map, gps_range, size):
+    (lat_min, lat_max), (lon_min, lon_max) = gps_range
+    # Places far from the origin wrap around the base image
+    left = int(round((lon_min - MAP_ORIGIN[1]) / MAP_DEGREES)) % (base_map.width - size[0])
+    upper = int(round((MAP_ORIGIN[0] - lat_max) / MAP_DEGREES)) % (base_map.height - size[1])
+    return base_map.crop((left, upper, left + size[0], upper + size[1]))
+
+# (frame, gps_range, map size) renders in order: frame changes, unchanged renders, shifts by whole
+# map pixels, viewports across the grid edges and outside of it, and a non-dyadic map size
+SEQUENCE = [('a', viewport(40.0, -97.0), (512, 256)),
+            ('a', viewport(40.0, -97.0), (512, 256)),
+            ('b', viewport(40.0, -97.0), (512, 256)),
+            ('b', viewport(40.0, -96.36), (512, 256)),
+            ('b', viewport(40.32, -96.36), (512, 256)),
+            ('a', viewport(40.32, -96.36), (512, 256)),
+            ('a', viewport(51.0, -128.0), (512, 256)),
+            ('c', viewport(51.0, -128.0), (512, 256)),
+            ('c', viewport(51.0, -127.36), (512, 256)),
+            ('c', viewport(10.0, 0.0), (512, 256)),
+            ('c', viewport(10.0, 0.0), (512, 256)),
+            ('a', viewport(40.0, -97.0), (384, 256)),
+            ('b', viewport(40.0, -97.0), (384, 256))]
+
+# Renders of SEQUENCE that reuse the previous composite: the unchanged ones, the frame changes
+# and the horizontal shift (the vertical shift dirties most of the map, the shift along the
+# edge and the non-dyadic size are not exact, those renders are full)
+INCREMENTAL = {1, 2, 3, 5, 7, 10}
+
+def test_incremental_renders_match_render_overlay(frames, base_map, tmp_path):
+    renderer = incremental.IncrementalRenderer()
+    full = []
+    for step, (key, gps_range, size) in enumerate(SEQUENCE):
+        map_img = map_image(base_map, gps_range, size)
+        full_renders = renderer.stats()['full_renders']
+        rendered = renderer.render(frames[key], map_img, gps_range)
+        full.append(renderer.stats()['full_renders'] > full_renders)
+        expected = compositing.render_overlay(frames[key], map_img, gps_range)
+        assert np.array_equal(np.asarray(rendered), np.asarray(expected)), 'render {} differs'.format(step)
+
+        # Bands kept from earlier saves still form the PNG of the composite
+        path = str(tmp_path / 'overlay.png')
+        renderer.save(path)
+        assert np.array_equal(np.asarray(Image.open(path)), np.asarray(expected)), 'save {} differs'.format(step)
+
+    assert [step for step, was_full in enumerate(full) if not was_full] == sorted(INCREMENTAL)
+    assert renderer.stats()['unchanged'] == 2
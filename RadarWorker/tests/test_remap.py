@@ -0,0 +1,61 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import FIXTURE_PNG, FIXTURE_WLD, DATA
+import compositing, framestore, remap
+
+MAP = os.path.join(DATA, 'map-data', 'stitched.png')
+
+# Viewport -> (gps_range, mean bound, 99th percentile bound) of the absolute RGB difference against
+# compositing.render_overlay, on 0-255 values. Box averaged samples stand in for the Lanczos filter,
+# the difference grows on viewports zoomed in past the IEM resolution where Lanczos interpolates
+VIEWPORTS = {'downscaled': (((30.0, 40.0), (-100.0, -80.0)), 4.0, 40),
+             'edge': (((45.0, 55.0), (-130.0, -110.0)), 1.5, 24),
+             'no_data': (((20.0, 26.0), (-70.0, -60.0)), 0.2, 2),
+             'zoomed': (((38.0, 38.5), (-90.0, -89.0)), 3.5, 40),
+             'zoomed_far': (((38.0, 38.1), (-90.0, -89.8)), 6.0, 72)}
+
+# A dyadic size and one that is not
+SIZES = [(512, 256), (333, 257)]
+
+@pytest.fixture(scope='module')
+def frame(tmp_path_factory):
+    return framestore.FrameStore(str(tmp_path_factory.mktemp('frames'))).load(FIXTURE_PNG, FIXTURE_WLD)
+
+@pytest.fixture(scope='module')
+def base_map():
+    return Image.open(MAP).convert('RGBA')
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('name', sorted(VIEWPORTS))
+def test_remap_follows_resize_path(frame, base_map, name, size):
+    gps_range, mean_bound, p99_bound = VIEWPORTS[name]
+    map_img = base_map.resize(size)
+    expected = np.asarray(compositing.render_overlay(frame, map_img.copy(), gps_range)).astype(np.int16)
+    rendered = remap.RemapRenderer(cache=remap.RemapCache()).render(frame, map_img.copy(), gps_range)
+    difference = np.abs(np.asarray(rendered).astype(np.int16) - expected)[..., :3]
+
+    assert rendered.size == size
+    assert difference.mean() <= mean_bound
+    assert np.percentile(difference, 99) <= p99_bound
+
+def test_remap_outside_of_data_is_tinted(frame, base_map):
+    map_img = base_map.resize(SIZES[1])
+    expected = compositing.render_overlay(frame, map_img.copy(), ((0.0, 10.0), (0.0, 20.0)))
+    rendered = remap.RemapRenderer(cache=remap.RemapCache()).render(frame, map_img.copy(), ((0.0, 10.0), (0.0, 20.0)))
+    # The resize path resamples a constant tint, which is off by one here and there
+    difference = np.abs(np.asarray(rendered).astype(np.int16) - np.asarray(expected))
+    assert difference.max() <= 1
+
+def test_remap_tables_are_cached(frame, base_map):
+    cache = remap.RemapCache()
+    renderer = remap.RemapRenderer(cache=cache)
+    map_img = base_map.resize(SIZES[1])
+    gps_range = VIEWPORTS['zoomed'][0]
+    first = np.asarray(renderer.render(frame, map_img.copy(), gps_range))
+    second = np.asarray(renderer.render(frame, map_img.copy(), gps_range))
+
+    assert np.array_equal(first, second)
+    assert cache.stats()['tables'] == 1
+    assert cache.stats()['hits'] == 1
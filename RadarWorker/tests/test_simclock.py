@@ -0,0 +1,113 @@
+import datetime, os, threading, time
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import FIXTURE_PNG, FIXTURE_WLD, ROOT
+import datasources, framecache, framestore, simclock
+
+START = datetime.datetime(2020, 1, 3, 2, 0)
+STEP = datetime.timedelta(minutes=5)
+SLOTS = 16
+
+# IEM tree of small frames, every pixel of the frame of slot i holds palette index i + 1
+@pytest.fixture(scope='module')
+def tree(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('iem'))
+    palette = Image.open(FIXTURE_PNG).getpalette()
+    with open(FIXTURE_WLD, 'rb') as reader:
+        wld = reader.read()
+    for i in range(SLOTS):
+        png = os.path.join(root, datasources.relative_path('n0q', START + i * STEP, '.png'))
+        os.makedirs(os.path.dirname(png), exist_ok=True)
+        img = Image.fromarray(np.full((54, 122), i + 1, dtype=np.uint8), 'P')
+        img.putpalette(palette)
+        img.save(png)
+        with open(os.path.splitext(png)[0] + '.wld', 'wb') as writer:
+            writer.write(wld)
+    return root
+
+# Directory source whose loads of the gated slots block until released, and which records loads
+class GatedSource(datasources.DirectorySource):
+    def __init__(self, root, gated=()):
+        super().__init__(root)
+        self.gated = set(gated)
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.loads = []
+
+    def local_paths(self, product, time):
+        self.loads.append(time)
+        if time in self.gated:
+            self.started.set()
+            self.release.wait(10)
+        return super().local_paths(product, time)
+
+@pytest.fixture
+def worker_of(tmp_path, monkeypatch):
+    # RadarWorker reads the station files from paths relative to the project
+    monkeypatch.chdir(ROOT)
+    from RadarWorker import RadarWorker
+
+    def build(source):
+        return RadarWorker(START, frame_cache=framecache.FrameCache(str(tmp_path / 'nexrad'), 10**9),
+                           frame_store=framestore.FrameStore(str(tmp_path / 'frames')), source=source)
+    return build
+
+def slot_of(frame):
+    return int(frame.grid[0, 0]) - 1
+
+def wait_for(condition):
+    deadline = time.time() + 10
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+def test_frames_are_loaded_ahead_of_the_clock(tree, worker_of):
+    worker = worker_of(GatedSource(tree))
+    with simclock.SimClock(worker, lookahead=2, workers=2) as clock:
+        assert slot_of(clock.start()) == 0
+        assert clock.pending_times == [START + STEP, START + 2 * STEP]
+
+        for i in range(1, 6):
+            # Once the look-ahead window is loaded, the switch does not wait
+            wait_for(lambda: len(clock.ready_times) == 2)
+            assert worker.frame_store.decodes == i + 2
+            assert slot_of(clock.advance()) == i
+            assert worker.sim_time == clock.frame_time == START + i * STEP
+            assert clock.pending_times == [START + (i + 1) * STEP, START + (i + 2) * STEP]
+
+        # Ticks within a slot (times snap to the nearest 5 minutes) keep the frame
+        frame = clock.set_time(START + 5 * STEP + datetime.timedelta(minutes=2))
+        assert slot_of(frame) == 5 and clock.frame_time == START + 5 * STEP
+
+        stats = clock.stats()
+        assert (stats['ticks'], stats['switches'], stats['ready'], stats['waits']) == (7, 6, 5, 1)
+        assert stats['jumps'] == 0 and stats['cancelled'] == 0
+        assert stats['wait_rate'] == pytest.approx(1 / 6)
+
+def test_cancelled_loads_are_not_waited_for(tree, worker_of):
+    source = GatedSource(tree, gated=[START + STEP])
+    worker = worker_of(source)
+    clock = simclock.SimClock(worker, lookahead=3, workers=1)
+    try:
+        clock.start()
+        # The only loader thread is held on the first frame ahead, the next two are queued
+        assert source.started.wait(10)
+        assert clock.pending_times == [START + i * STEP for i in (1, 2, 3)]
+        assert clock.ready_times == []
+
+        # Jumping drops the whole window, the frame of the jump is loaded in this thread
+        jump = START + 12 * STEP
+        assert slot_of(clock.set_time(jump)) == 12
+        assert clock.pending_times == [jump + i * STEP for i in (1, 2, 3)]
+        stats = clock.stats()
+        assert (stats['switches'], stats['ready'], stats['waits'], stats['jumps'], stats['cancelled']) == (2, 0, 2, 1, 3)
+        assert stats['max_wait_seconds'] < 5
+    finally:
+        source.release.set()
+        clock.close()
+
+    # The held load stopped before decoding, the queued ones never ran
+    assert not os.path.exists(worker.frame_store.paths('n0q_202001030205')[1])
+    assert START + 2 * STEP not in source.loads and START + 3 * STEP not in source.loads
+    assert clock.stats()['waits'] == 2
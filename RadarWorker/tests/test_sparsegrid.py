@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from conftest import FIXTURE_PNG, FIXTURE_WLD
+import framestore, sparsegrid
+
+BLOCK = 16
+
+# Grid of fill with a few echoes, sized so the last row and column of blocks are partial
+def echo_grid(fill, shape=(150, 230)):
+    rng = np.random.default_rng(23)
+    grid = np.full(shape, fill, dtype=np.uint8)
+    for top, left, height, width in [(3, 5, 20, 30), (40, 100, 9, 9), (60, 15, 1, 1), (130, 200, 20, 30)]:
+        grid[top:top + height, left:left + width] = rng.integers(0, 256, size=(height, width))
+    # Echoes filling some blocks with the fill value and others with one pixel
+    grid[96:112, 32:48] = fill
+    grid[100, 180] = fill + 1
+    return grid
+
+@pytest.mark.parametrize('fill', [0, 5])
+def test_crops_match_the_dense_grid(fill):
+    dense = echo_grid(fill)
+    grid = sparsegrid.SparseGrid.from_dense(dense, BLOCK, fill)
+    assert grid.shape == dense.shape
+    assert grid.stored_blocks < grid.total_blocks == 10 * 15
+    assert np.array_equal(grid.to_dense(), dense)
+    assert np.array_equal(np.asarray(grid), dense)
+
+    rng = np.random.default_rng(fill)
+    crops = [(slice(a, b), slice(c, d)) for a, b, c, d in
+             zip(rng.integers(0, 150, 200), rng.integers(0, 160, 200), rng.integers(0, 230, 200), rng.integers(0, 240, 200))]
+    # Single blocks, blocks crossing boundaries, the empty blocks, the partial blocks, open and
+    # negative bounds, empty crops and steps
+    crops += [(slice(0, 16), slice(16, 32)), (slice(15, 17), slice(31, 33)), (slice(96, 112), slice(32, 48)),
+              (slice(90, 120), slice(20, 60)), (slice(144, 150), slice(224, 230)), (slice(None), slice(None)),
+              (slice(-20, None), slice(None, -7)), (slice(140, 400), slice(-300, 5)), (slice(50, 50), slice(0, 10)),
+              (slice(60, 40), slice(0, 10)), (slice(0, 150, 3), slice(5, 200, 7))]
+    for rows, columns in crops:
+        crop = grid[rows, columns]
+        assert crop.dtype == np.uint8
+        assert np.array_equal(crop, dense[rows, columns]), 'crop {} differs'.format((rows, columns))
+
+    # Crops mixing a slice and an index work on the dense grid
+    assert np.array_equal(grid[5, 10:40], dense[5, 10:40])
+    assert np.array_equal(grid[:, 101], dense[:, 101])
+
+@pytest.mark.parametrize('fill', [0, 5])
+def test_gathers_match_the_dense_grid(fill):
+    dense = echo_grid(fill)
+    grid = sparsegrid.SparseGrid.from_dense(dense, BLOCK, fill)
+    rng = np.random.default_rng(fill)
+    y, x = rng.integers(0, 150, 5000), rng.integers(0, 230, 5000)
+    assert np.array_equal(grid[y, x], dense[y, x])
+    # Negative indices and broadcasting, as np.ix_ lookups do
+    assert np.array_equal(grid[-y, -x], dense[-y, -x])
+    rows, columns = np.ix_(np.arange(90, 115), np.arange(25, 190, 3))
+    assert np.array_equal(grid[rows, columns], dense[rows, columns])
+    assert np.array_equal(grid[np.array([], dtype=np.int64), np.array([], dtype=np.int64)], [])
+
+    with pytest.raises(IndexError):
+        grid[np.array([0, 150]), np.array([0, 0])]
+    with pytest.raises(IndexError):
+        grid[np.array([0]), np.array([-231])]
+
+def test_empty_grid_stores_only_the_fill_block():
+    grid = sparsegrid.SparseGrid.from_dense(np.full((40, 33), 9, dtype=np.uint8), BLOCK, 9)
+    assert grid.stored_blocks == 0
+    assert grid.nbytes == grid.total_blocks * 4 + BLOCK * BLOCK
+    assert (grid[0:40, 0:33] == 9).all()
+    assert (grid[np.arange(40), np.arange(40) % 33] == 9).all()
+
+def test_compact_frame_matches_the_decoded_frame(tmp_path):
+    frame = framestore.FrameStore(str(tmp_path)).load(FIXTURE_PNG, FIXTURE_WLD)
+    compact = sparsegrid.compact(frame)
+    assert isinstance(compact.grid, sparsegrid.SparseGrid)
+    assert sparsegrid.compact(compact).grid is compact.grid
+    assert compact.grid.memory()['ratio_to_dense'] < 0.5
+    assert np.array_equal(compact.grid.to_dense(), frame.grid)
+
+    rng = np.random.default_rng(3)
+    points = np.column_stack((rng.uniform(20, 52, 20000), rng.uniform(-128, -62, 20000)))
+    np.testing.assert_array_equal(compact.get_reflectivity(points), frame.get_reflectivity(points))
+    box = (6000, 2200, 6512, 2456)
+    assert compact.to_image(box).tobytes() == frame.to_image(box).tobytes()
@@ -0,0 +1,49 @@
+import datetime
+import numpy as np
+import timeline
+
+START = datetime.datetime(2020, 1, 3, 2, 0)
+
+# Frame answering a constant dBZ everywhere
+class FlatFrame:
+    def __init__(self, dbz):
+        self.dbz = dbz
+
+    def get_reflectivity(self, points):
+        return np.full(len(points), self.dbz, dtype=np.float32)
+
+# RadarWorker stand-in holding frames for some times, and counting what is asked of it
+class FrameSource:
+    def __init__(self, available):
+        self.available = available
+        self.prefetched = []
+        self.fetched = []
+
+    @staticmethod
+    def snap_time(time):
+        return time.replace(minute=time.minute - time.minute % 5, second=0, microsecond=0)
+
+    def prefetch_times(self, times, workers=None):
+        self.prefetched.append(list(times))
+        return {time: ('png', 'wld') for time in times if time in self.available}
+
+    def get_frame(self, time):
+        self.fetched.append(time)
+        return self.available.get(time)
+
+def test_unavailable_frames_are_not_fetched_again():
+    times = [START + timeline.FRAME_STEP * i for i in range(4)]
+    source = FrameSource({times[0]: FlatFrame(10), times[2]: FlatFrame(30)})
+    frames = timeline.Timeline(source)
+
+    queried, dbz = frames.query([(38.0, -90.0)], times[0], times[-1])
+    assert queried == times
+    assert np.array_equal(dbz[[0, 2], 0], [10, 30])
+    assert np.isnan(dbz[[1, 3], 0]).all()
+    assert source.prefetched == [times]
+    assert source.fetched == [times[0], times[2]]
+
+    # Loaded frames are reused, the missing ones are prefetched again
+    frames.query([(38.0, -90.0)], times[0], times[-1])
+    assert source.prefetched[-1] == [times[1], times[3]]
+    assert source.fetched == [times[0], times[2]]
@@ -0,0 +1,95 @@
+import os
+from conftest import STATIONS, STATIONS_TEMPLATE
+from txtparsing import DataWorker
+
+def sorted_icaos(worker, path, labels, key):
+    rows = worker.get_vals(path, worker.labels)
+    index = worker.labels.index('icao')
+    return [row[index] for row in sorted(rows, key=key)]
+
+def output_icaos(worker, path):
+    return [row[0] for row in worker.get_vals(path, ['icao'])]
+
+# A string label then a numeric one, sorted in memory and through spilled runs
+def test_sort_file_mixed_keys_matches_sorted(tmp_path):
+    worker = DataWorker(STATIONS_TEMPLATE)
+    state, latitude = worker.labels.index('state'), worker.labels.index('latitude')
+    expected = sorted_icaos(worker, STATIONS, ['state', 'latitude'],
+                            lambda row: (row[state], float(row[latitude])))
+
+    output = str(tmp_path / 'sorted.txt')
+    worker.sort_file(STATIONS, output, ['state', 'latitude'])
+    assert output_icaos(worker, output) == expected
+
+    worker.sort_file(STATIONS, output, ['state', 'latitude'], memory_budget=4096)
+    assert output_icaos(worker, output) == expected
+
+# Numeric labels given as a list, the others compare as raw strings
+def test_sort_file_numeric_labels(tmp_path):
+    worker = DataWorker(STATIONS_TEMPLATE)
+    state, longitude = worker.labels.index('state'), worker.labels.index('longitude')
+    expected = sorted_icaos(worker, STATIONS, ['longitude', 'state'],
+                            lambda row: (float(row[longitude]), row[state]))
+    output = str(tmp_path / 'sorted.txt')
+    worker.sort_file(STATIONS, output, ['longitude', 'state'], str_flt_conv=['longitude'])
+    assert output_icaos(worker, output) == expected
+
+# Without conversion every label compares as a raw string
+def test_sort_file_without_conversion(tmp_path):
+    worker = DataWorker(STATIONS_TEMPLATE)
+    name = worker.labels.index('name')
+    expected = sorted_icaos(worker, STATIONS, ['name'], lambda row: row[name])
+    output = str(tmp_path / 'sorted.txt')
+    worker.sort_file(STATIONS, output, 'name', str_flt_conv=False)
+    assert output_icaos(worker, output) == expected
+    assert os.path.getsize(output) == os.path.getsize(STATIONS)
+
+# Numeric sorts write lines back as they were read, every column keeps its place
+def test_sort_file_keeps_line_layout(tmp_path):
+    worker = DataWorker(STATIONS_TEMPLATE)
+    output = str(tmp_path / 'sorted.txt')
+    worker.sort_file(STATIONS, output, 'latitude')
+
+    with open(STATIONS) as reader:
+        lines = reader.read().splitlines()
+    with open(output) as reader:
+        sorted_lines = reader.read().splitlines()
+    assert sorted(sorted_lines) == sorted(lines)
+    assert set(len(line) for line in sorted_lines) == set(len(line) for line in lines)
+    latitudes = [float(row[0]) for row in worker.get_vals(output, ['latitude'])]
+    assert latitudes == sorted(latitudes)
+
+# Terms longer than the requested length are kept whole
+def test_flt_to_str_pads_and_keeps_long_terms():
+    assert DataWorker.flt_to_str(1.5, 6) == '+1.5  '
+    assert DataWorker.flt_to_str(-123.456789, 4) == '-123.456789'
+
+def station_rows(worker):
+    return [dict(zip(worker.labels, (term.strip() for term in row)))
+            for row in worker.get_vals(STATIONS, worker.labels)]
+
+# Filters may read terms that are neither returned nor typed, they are compared as numbers
+def test_read_records_where_on_unlisted_terms():
+    worker = DataWorker(STATIONS_TEMPLATE)
+    expected = [row['icao'] for row in station_rows(worker)
+                if float(row['latitude']) > 30 and row['state'] == 'TX']
+    records = worker.read_records(STATIONS, names=['icao'], where="(latitude > 30) & (state == 'TX')")
+    assert records.dtype.names == ('icao',)
+    assert list(records['icao']) == expected and expected
+
+# All terms returned as strings, the filter still compares numbers
+def test_read_records_where_without_types():
+    worker = DataWorker(STATIONS_TEMPLATE)
+    expected = [row['icao'] for row in station_rows(worker) if float(row['elevation']) > 1000]
+    records = worker.read_records(STATIONS, where='elevation > 1000', chunk_size=50)
+    assert list(records['icao']) == expected and expected
+    assert records['elevation'].dtype.kind == 'U'
+
+# Range filters in the read_filter format
+def test_read_records_range_filter():
+    worker = DataWorker(STATIONS_TEMPLATE)
+    expected = [row['icao'] for row in station_rows(worker) if 30 < float(row['latitude']) < 40]
+    records = worker.read_records(STATIONS, names=['icao', 'state'], where=['latitude', 30, 40])
+    assert list(records['icao']) == expected and expected
+    typed = worker.read_records(STATIONS, names=['icao'], types={'latitude': float}, where=['latitude', 30, 40])
+    assert list(typed['icao']) == expected
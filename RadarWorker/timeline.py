@@ -0,0 +1,131 @@
+import datetime, logging, threading, sparsegrid
+import numpy as np
+from collections import OrderedDict
+
+TAG = 'Timeline - '
+
+# IEM publishes one composite every 5 minutes
+FRAME_STEP = datetime.timedelta(minutes=5)
+
+# Point time-series queries across a stack of IEM frames
+#       - Frames come from a RadarWorker (frame cache + frame store), sim_time is never changed
+#       - Loaded frames are kept between queries, up to max_frames
+#       - With compact, frames are kept as block-sparse grids (see sparsegrid), so long histories
+#         take a few MB per frame instead of pinning the pages of every mapped grid
+#       - Values between two 5 minute frames can be interpolated linearly
+class Timeline:
+    def __init__(self, radar_worker, max_frames=48, compact=False):
+        self.__worker = radar_worker
+        self.__max_frames = max_frames
+        self.__compact = compact
+        self.__frames = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @property
+    def loaded_times(self):
+        with self.__lock:
+            return list(self.__frames)
+
+    # Rounds a time down to the 5 minute frame at or before it
+    @staticmethod
+    def floor_time(time):
+        return time.replace(minute=time.minute - time.minute % 5, second=0, microsecond=0)
+
+    # Times in [start, end] spaced by step
+    @staticmethod
+    def times(start, end, step=FRAME_STEP):
+        times = []
+        time = start
+        while time <= end:
+            times.append(time)
+            time += step
+        return times
+
+    # Returns the DecodedFrame of a 5 minute slot, None if it is unavailable
+    def frame(self, time):
+        with self.__lock:
+            if time in self.__frames:
+                self.__frames.move_to_end(time)
+                return self.__frames[time]
+
+        frame = self.__worker.get_frame(time)
+        if frame is None:
+            return None
+        if self.__compact:
+            frame = sparsegrid.compact(frame)
+        with self.__lock:
+            self.__frames[time] = frame
+            while len(self.__frames) > self.__max_frames:
+                self.__frames.popitem(last=False)
+        return frame
+
+    # Loads every frame needed for the given slots, downloading the missing ones concurrently
+    # Slots prefetching could not get are None, they are not fetched a second time
+    def _load(self, slots):
+        with self.__lock:
+            missing = [slot for slot in slots if slot not in self.__frames]
+        unavailable = set()
+        if missing:
+            logging.info(TAG+'loading {} frames'.format(len(missing)))
+            available = self.__worker.prefetch_times(missing)
+            unavailable = set(missing) - set(available)
+        return {slot: None if slot in unavailable else self.frame(slot) for slot in slots}
+
+    # dBZ at every point for one frame slot, NaN everywhere if the frame is unavailable
+    @staticmethod
+    def _sample(frame, points):
+        if frame is None:
+            return np.full(len(points), np.nan, dtype=np.float32)
+        return frame.get_reflectivity(points)
+
+    # Returns (times, dbz) where dbz is a (len(times), N) matrix for an Nx2 array of (lat, lon)
+    # Without interpolation each time uses the frame that sim_time would snap to
+    def query(self, points, start, end, step=FRAME_STEP, interpolate=False):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        times = self.times(start, end, step)
+
+        if not interpolate:
+            slots = [self.__worker.snap_time(time) for time in times]
+            frames = self._load(sorted(set(slots)))
+            samples = {slot: self._sample(frames[slot], points) for slot in frames}
+            dbz = np.empty((len(times), len(points)), dtype=np.float32)
+            for i, slot in enumerate(slots):
+                dbz[i] = samples[slot]
+            return times, dbz
+
+        # Bracket every time with the frames before and after it
+        lower = [self.floor_time(time) for time in times]
+        weights = np.array([(time - slot) / FRAME_STEP for time, slot in zip(times, lower)],
+                           dtype=np.float32)
+        slots = set(lower)
+        slots.update(slot + FRAME_STEP for slot, weight in zip(lower, weights) if weight > 0)
+        frames = self._load(sorted(slots))
+        samples = {slot: self._sample(frames[slot], points) for slot in frames}
+
+        dbz = np.empty((len(times), len(points)), dtype=np.float32)
+        for i, (slot, weight) in enumerate(zip(lower, weights)):
+            if weight == 0:
+                dbz[i] = samples[slot]
+            else:
+                dbz[i] = (1 - weight) * samples[slot] + weight * samples[slot + FRAME_STEP]
+        return times, dbz
+
+    # dBZ of each (lat, lon) of an Nx2 array at its own time, one time per point
+    # Each point uses the frame that sim_time would snap to for its time
+    def sample_at(self, points, times):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(times) != len(points):
+            raise Exception('Got {} times for {} points'.format(len(times), len(points)))
+        slots = np.array([self.__worker.snap_time(time) for time in times], dtype=object)
+        frames = self._load(sorted(set(slots)))
+
+        dbz = np.empty(len(points), dtype=np.float32)
+        for slot, frame in frames.items():
+            mask = slots == slot
+            dbz[mask] = self._sample(frame, points[mask])
+        return dbz
+
+    # Convenience wrapper, the last duration of data ending at end
+    def query_window(self, points, end, duration=datetime.timedelta(hours=2), step=FRAME_STEP,
+                     interpolate=False):
+        return self.query(points, end - duration, end, step, interpolate)
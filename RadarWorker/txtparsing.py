@@ -1,4 +1,6 @@
-import os, logging
+import os, logging, itertools, heapq, tempfile
+import numpy as np
+from numpy.lib import recfunctions
 
 TAG = 'txtparsing - '
 
@@ -64,9 +66,8 @@ class DataWorker:
         else:
             term = str(flt)
         
-        while len(term) != length:
-            term += ' '
-        return term
+        # Terms longer than length are kept whole
+        return term.ljust(length)
 
     # Saves a list of lines to a text file
     @staticmethod
@@ -96,7 +97,7 @@ class DataWorker:
         if filter2 is not None:
             f2_in = self.labels.index(filter2[0])
         with open(output_file, 'w') as writer:
-            for line in reader.readlines():
+            for line in reader:
                 term_list = self.parse_line(line)
                 try:
                     term = float(term_list[f1_in][1:])
@@ -136,47 +137,89 @@ class DataWorker:
                 line += ' '
         return line
 
-    # Quicksort a file based on one of the terms, least to greatest
+    # Sorts a file based on one of the terms, least to greatest
+    # Kept for existing callers, see sort_file
     def quicksort_lg(self, input_file, output_file, label, str_flt_conv=True):
-        logging.info(TAG+'starting quicksort of ' + input_file)
-        # Convert sorted element from a string to float
-        def convert_elements(datalist, index):
-            for elem in datalist:
-                elem[index] = self.str_to_flt(elem[index])
-            return datalist
-
-        # Partitioning, all values before trail are less than pivot value at lst[end]
-        def partition(lst, strt, end, int_indx):
-            trail = leader = strt
-            while leader < end:
-                if lst[leader][int_indx] <= lst[end][int_indx]:
-                    lst[trail], lst[leader] = lst[leader], lst[trail]
-                    trail += 1
-                leader += 1
-            lst[trail], lst[end] = lst[end], lst[trail]
-            return trail
-        
-        # Actual recursive quicksort
-        def quicksort(lst, strt, end, int_index):
-            if strt >= end:
-                return
-            pivot = partition(lst, strt, end, int_index)
-            quicksort(lst, strt, pivot-1, int_index)
-            quicksort(lst, pivot+1, end, int_index)
-
-        # List of lists, each for substation
-        datalist = self.get_vals(input_file, self.labels)
-        index = self.labels.index(label)
-        if str_flt_conv:
-            datalist = convert_elements(datalist, index)
-
-        # Performing the sort
-        quicksort(datalist, 0, len(datalist)-1, index)
+        self.sort_file(input_file, output_file, [label], str_flt_conv)
 
-        with open(output_file, 'w') as writer:
-            for term in datalist:
-                writer.write(self.lst_to_line(term, 10) + '\n')
-        logging.info(TAG+'quicksort complete')
+    # Sorts a file least to greatest on one or more terms, ties keep their input order
+    #       - labels is a label or a list of labels, earlier labels take precedence
+    #       - str_flt_conv names the numeric labels: True for every sorted label, False for none,
+    #         or a list of labels. Numeric terms are compared as numbers, terms that are not
+    #         numbers sort after all numbers by their text. Other labels are compared as raw strings
+    #       - Lines are written out as they were read, so every column keeps its template width
+    #       - Inputs larger than memory_budget bytes are sorted in runs spilled to temporary
+    #         files, which are then merged
+    def sort_file(self, input_file, output_file, labels, str_flt_conv=True, memory_budget=64 * 1024**2):
+        if isinstance(labels, str):
+            labels = [labels]
+        indices = [self.labels.index(label) for label in labels]
+        if isinstance(str_flt_conv, bool):
+            numeric = [str_flt_conv] * len(labels)
+        else:
+            numeric = [label in str_flt_conv for label in labels]
+        logging.info(TAG+'starting sort of {} on {}'.format(input_file, labels))
+
+        # Sort key of a parsed line
+        # Every term of a label gets a key of the same shape, so any two lines compare
+        def line_key(vals):
+            key = []
+            for index, convert in zip(indices, numeric):
+                if convert:
+                    try:
+                        key.append((False, float(vals[index]), ''))
+                    except ValueError:
+                        key.append((True, 0.0, vals[index]))
+                else:
+                    key.append(vals[index])
+            return tuple(key)
+
+        def sorted_lines(rows):
+            rows.sort(key=lambda row: row[0])
+            return (row[1] for row in rows)
+
+        runs = []
+        rows = []
+        used = 0
+        try:
+            with open(input_file, 'r') as reader:
+                for line in reader:
+                    if not line.endswith('\n'):
+                        line += '\n'
+                    rows.append((line_key(self.parse_line(line.rstrip('\n'))), line))
+                    used += 2 * len(line) + 200
+                    if used >= memory_budget:
+                        runs.append(self._spill_run(sorted_lines(rows)))
+                        rows, used = [], 0
+
+            if not runs:
+                with open(output_file, 'w') as writer:
+                    writer.writelines(sorted_lines(rows))
+            else:
+                if rows:
+                    runs.append(self._spill_run(sorted_lines(rows)))
+                rows = []
+                logging.info(TAG+'merging {} sorted runs'.format(len(runs)))
+                readers = [open(run, 'r') for run in runs]
+                try:
+                    merge_key = lambda line: line_key(self.parse_line(line.rstrip('\n')))
+                    with open(output_file, 'w') as writer:
+                        writer.writelines(heapq.merge(*readers, key=merge_key))
+                finally:
+                    for reader in readers:
+                        reader.close()
+        finally:
+            for run in runs:
+                os.remove(run)
+        logging.info(TAG+'sort complete')
+
+    # Writes a sorted run to a temporary file and returns its path
+    @staticmethod
+    def _spill_run(lines):
+        handle, path = tempfile.mkstemp(prefix='sort-run-', suffix='.txt')
+        with os.fdopen(handle, 'w') as writer:
+            writer.writelines(lines)
+        return path
 
     # Returns a list, each index with a list of requested vals from the requested line
     def get_vals(self, input_file, names):
@@ -204,4 +247,121 @@ class DataWorker:
         parsed_list = self.parse_line(line)
         for index in indecies:
             vals.append(parsed_list[index])
-        return vals
\ No newline at end of file
+        return vals
+
+    # Returns a list of (label, offset, width) for every term of a line
+    def layout(self):
+        fields = []
+        cursor = 0
+        index = 0
+        for term in self.template:
+            if term == '':
+                cursor += 1
+            else:
+                fields.append((self.labels[index], cursor, int(term)))
+                cursor += int(term)
+                index += 1
+        return fields
+
+    # Length of a full line, without the newline
+    def record_width(self):
+        name, offset, width = self.layout()[-1]
+        return offset + width
+
+    # Numpy structured dtype mapping the raw bytes of a line, one 'S' field per term
+    def record_dtype(self, names=None):
+        fields = [field for field in self.layout() if names is None or field[0] in names]
+        return np.dtype({'names': [field[0] for field in fields],
+                         'formats': ['S{}'.format(field[2]) for field in fields],
+                         'offsets': [field[1] for field in fields],
+                         'itemsize': self.record_width()})
+
+    # Converts a raw 'S' column, types are str (default), float or int
+    # Empty float terms become NaN and empty int terms become 0
+    @staticmethod
+    def convert_column(column, kind=str):
+        column = np.char.strip(column)
+        if kind is str:
+            return np.char.decode(column, 'ascii', 'replace')
+        empty = column == b''
+        if kind is float:
+            values = np.where(empty, b'nan', column).astype(np.float64)
+        elif kind is int:
+            values = np.where(empty, b'0', column).astype(np.int64)
+        else:
+            values = np.array([kind(value) for value in np.char.decode(column, 'ascii', 'replace')])
+        return values
+
+    # Builds a predicate from a callable, an expression string over the labels, or a
+    # range filter in the read_filter format [name, low bound, high bound]
+    @staticmethod
+    def make_predicate(where):
+        if where is None or callable(where):
+            return where
+        if isinstance(where, str):
+            code = compile(where, '<where>', 'eval')
+            return lambda chunk: eval(code, {'__builtins__': {}, 'np': np},
+                                      {name: chunk[name] for name in chunk.dtype.names})
+        name, low, high = where
+        return lambda chunk: (chunk[name] > low) & (chunk[name] < high)
+
+    # Labels read by a where filter of make_predicate, callables are not inspected
+    def predicate_labels(self, where):
+        if where is None or callable(where):
+            return []
+        if isinstance(where, str):
+            return [name for name in compile(where, '<where>', 'eval').co_names if name in self.labels]
+        return [where[0]]
+
+    # Converts a raw 'S' column to float when every non empty term is a number, to str otherwise
+    @staticmethod
+    def guess_column(column):
+        try:
+            return DataWorker.convert_column(column, float)
+        except ValueError:
+            return DataWorker.convert_column(column, str)
+
+    # Streams a fixed width file as numpy structured arrays of at most chunk_size records
+    #       - names selects the terms to return, all terms by default
+    #       - types maps names to str, float or int, terms default to stripped strings
+    #       - where keeps only matching records, see make_predicate. The terms it reads need not
+    #         be returned, they are converted for it with their types, or without one as numbers
+    #         when every term of the chunk is a number. Callables get the returned and typed terms
+    # Only one chunk is held in memory at a time
+    def read_chunks(self, input_file, names=None, types=None, where=None, chunk_size=65536):
+        names = list(names) if names is not None else list(self.labels)
+        types = dict(types or {})
+        predicate = self.make_predicate(where)
+        guessed = [label for label in self.predicate_labels(where) if label not in types]
+        width = self.record_width()
+        raw_dtype = self.record_dtype()
+
+        with open(input_file, 'rb') as reader:
+            while True:
+                lines = list(itertools.islice(reader, chunk_size))
+                if not lines:
+                    break
+                raw = b''.join(line.rstrip(b'\r\n').ljust(width)[:width] for line in lines)
+                records = np.frombuffer(raw, dtype=raw_dtype)
+
+                columns = {}
+                for label in self.labels:
+                    if label in names or label in types:
+                        columns[label] = self.convert_column(records[label], types.get(label, str))
+                chunk = np.rec.fromarrays([columns[label] for label in columns], names=list(columns))
+
+                if predicate is not None:
+                    inputs = dict(columns)
+                    for label in guessed:
+                        inputs[label] = self.guess_column(records[label])
+                    inputs = np.rec.fromarrays([inputs[label] for label in inputs], names=list(inputs))
+                    chunk = chunk[np.asarray(predicate(inputs), dtype=bool)]
+                if len(chunk):
+                    yield recfunctions.repack_fields(chunk[names])
+
+    # Reads every matching record of a fixed width file into one structured array
+    def read_records(self, input_file, names=None, types=None, where=None, chunk_size=65536):
+        chunks = list(self.read_chunks(input_file, names, types, where, chunk_size))
+        if not chunks:
+            return np.empty(0, dtype=[(name, 'U1') for name in (names or self.labels)])
+        return np.concatenate(chunks)
@@ -1,30 +1,121 @@
-import requests, logging, os, config
+import logging, math, os, config, downloader
+from geotransform import GeoTransform
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from workers import tilecache
+from metrics import METRICS
 
 TAG = 'MapWorker - '
 
 LOC_FOLS = config.LOC_FOLS
 
+# GBIF tile style, tiles are requested at 4x resolution
+TILE_STYLE = 'osm-bright'
+TILE_URL = 'https://tile.gbif.org/4326/omt/{z}/{x}/{y}@4x.png?style={style}'
+
+# Downloads one map tile, raises if GBIF does not furnish it
+def fetch_tile(style, z, x, y):
+    url = TILE_URL.format(z=z, x=x, y=y, style=style)
+    with METRICS.timer('download'):
+        request = downloader.shared_session().get(url, timeout=config.HTTP_TIMEOUT)
+    if request.status_code != 200:
+        METRICS.count('http_errors')
+        logging.error(TAG+'*****FAILED TO DOWNLOAD MAP TILE*****')
+        raise Exception('Failed to download map tile {}/{}/{}: HTTP {}'.format(z, x, y, request.status_code))
+    METRICS.count('download_bytes', len(request.content))
+    return request.content
+
+# Tiles downloaded by any MapWorker in this process
+TILE_CACHE = tilecache.TileCache(LOC_FOLS['tiles'], fetch_tile, config.TILE_CACHE_IMAGES)
+
+# Number of tiles (x, y) covering the world at a zoom level, EPSG:4326 tiles are twice as wide as tall
+def tile_counts(z):
+    return 2**(z + 1), 2**z
+
+# Closed form (x, y) of the tile holding a coordinate, works on scalars and numpy arrays
+def tile_index(lat, lon, z):
+    x_tiles, y_tiles = tile_counts(z)
+    x = np.clip(np.floor((np.asarray(lon) + 180) / (360 / x_tiles)), 0, x_tiles - 1).astype(np.int64)
+    y = np.clip(np.floor((90 - np.asarray(lat)) / (180 / y_tiles)), 0, y_tiles - 1).astype(np.int64)
+    return x, y
+
+# GPS range ((lat_min, lat_max), (lon_min, lon_max)) of a tile, or of a block of tiles
+def tile_range(x, y, z, columns=1, rows=1):
+    x_tiles, y_tiles = tile_counts(z)
+    lon_increment = 360 / x_tiles
+    lat_increment = 180 / y_tiles
+    return ((90 - (y + rows) * lat_increment, 90 - y * lat_increment),
+            (x * lon_increment - 180, (x + columns) * lon_increment - 180))
+
+# Builds one image from the tiles covering a bounding box ((lat_min, lat_max), (lon_min, lon_max))
+#       - The covering tile set is computed in closed form, tiles past 180 degrees wrap around
+#       - Missing tiles are fetched concurrently through the tile cache
+#       - Tiles are copied straight into one preallocated canvas, nothing is written to disk
+# Returns (image, gps_range) where gps_range is the range of the whole tile block
+def build_mosaic(bbox, z, workers=None, mode='RGB'):
+    (lat_min, lat_max), (lon_min, lon_max) = bbox
+    x_tiles, y_tiles = tile_counts(z)
+    lon_increment = 360 / x_tiles
+    lat_increment = 180 / y_tiles
+
+    x0 = int(math.floor((lon_min + 180) / lon_increment))
+    x1 = max(int(math.ceil((lon_max + 180) / lon_increment)), x0 + 1)
+    y0 = max(int(math.floor((90 - lat_max) / lat_increment)), 0)
+    y1 = min(max(int(math.ceil((90 - lat_min) / lat_increment)), y0 + 1), y_tiles)
+    columns, rows = x1 - x0, y1 - y0
+    logging.info(TAG+'building a {}x{} mosaic at zoom {}'.format(columns, rows, z))
+
+    tiles = [(x, y) for y in range(y0, y1) for x in range(x0, x1)]
+    load = lambda tile: TILE_CACHE.get_image(TILE_STYLE, z, tile[0] % x_tiles, tile[1])
+    with ThreadPoolExecutor(max_workers=workers or config.PREFETCH_WORKERS) as executor:
+        images = list(executor.map(load, tiles))
+
+    tile_width, tile_height = images[0].size
+    bands = len(mode)
+    canvas = np.empty((rows * tile_height, columns * tile_width, bands), dtype=np.uint8)
+    for (x, y), image in zip(tiles, images):
+        top = (y - y0) * tile_height
+        left = (x - x0) * tile_width
+        canvas[top:top + tile_height, left:left + tile_width] = np.asarray(image)[..., :bands]
+
+    return Image.fromarray(canvas, mode), tile_range(x0, y0, z, columns, rows)
+
 # Manages ONE TILE ONLY, either rectangular or square
 # Minimum zoom level is 4
+# With a viewport (lat_span, lon_span) in degrees, the worker instead covers that box around the
+# gps coordinate with as many tiles as needed
 class MapWorker():
-    def __init__(self, gps_coordinate, zoom_level=0, rectangular_tiles=True):
-        self.cl_wd()
+    def __init__(self, gps_coordinate, zoom_level=0, rectangular_tiles=True, viewport=None):
         # These attributes should never change
         self.__zoom_level = zoom_level
         self.__rectangular_tiles = rectangular_tiles
+        self.__viewport = viewport
         
         # These attributes will be dynamically updated
         self.__gps_coordinate = gps_coordinate
         self.__gps_range = ()
-        self.__tilepath = ''
+        self.__tilepath = None
+        self.__image = None
         self.update_tile()
 
+    # Path of the map image, mosaics are only written to disk when a path is asked for
     @property
     def tilepath(self):
+        if self.__tilepath is None:
+            self.__image.save(LOC_FOLS['map']+'stitched.png')
+            self.__tilepath = LOC_FOLS['map']+'stitched.png'
         return self.__tilepath
 
+    # The map image in memory, shared, copy it before drawing on it
+    @property
+    def image(self):
+        return self.__image
+
+    @property
+    def zoom_level(self):
+        return self.__zoom_level
+
     @property
     def gps_coordinate(self):
         return self.__gps_coordinate
@@ -38,119 +129,82 @@ class MapWorker():
         self.__gps_coordinate = gps_coordinate
         self.update_tile()
 
+    # GeoTransform of the map image, shared with the IEM side so both use the same coordinate math
+    @property
+    def transform(self):
+        return GeoTransform.from_bounds(self.__gps_range, self.__image.size)
+
+    # Map pixels (x, y) of an Nx2 array of (lat, lon), e.g. to draw aircraft on the map
+    def gps_to_pixels(self, gps_coors):
+        return self.transform.gps_to_pixels(gps_coors)
+
     def get_bounding_points(self):
         return ((self.__gps_range[0][0], self.__gps_range[1][0]), 
                 (self.__gps_range[0][1], self.__gps_range[1][1]))
 
     def update_tile(self):
-        if self.__rectangular_tiles:
-            self.__tilepath = self.get_rect_tile()
+        if self.__viewport is not None:
+            self.__image = self.get_viewport()
+            self.__tilepath = None
+        elif self.__rectangular_tiles:
+            self.__image = self.get_rect_tile()
+            self.__tilepath = None
         else:
             self.__tilepath = self.get_tile()
+            self.__image = TILE_CACHE.get_image(TILE_STYLE, self.__zoom_level, *self._find_tile())
 
     # Method that gets the tile to which a gps coordinate resides in
     # Dowloads and saves the tiles if it is not present in the working directory for the worker
     def get_tile(self):
-        power = self.__zoom_level + 1
-        x_tiles = 2**power
-        y_tiles = 2**self.__zoom_level
-        possible_x = (0, x_tiles - 1)
-        possible_y = (0, y_tiles - 1)
-
-        lon_increment = 360 / x_tiles
-        lat_increment = 180 / y_tiles
-
-        def generate_range_x(x):
-            return (x * lon_increment - 180, x * lon_increment + lon_increment - 180)
-
-        def generate_range_y(y):
-            return (y * lat_increment - 90, y * lat_increment + lat_increment - 90)
-
-        def binary_search(left, right, value, range_function):
-            middle = int((right + left) / 2)
-
-            mid_range = range_function(middle)
-            if value <= mid_range[1] and value >= mid_range[0]:
-                return middle
-            elif value > mid_range[1]:
-                return binary_search(middle + 1, right, value, range_function)
-            else:
-                return binary_search(left , middle - 1, value, range_function)
-    
-        logging.info(TAG+'beginning binary search for proper tile')
-        found_x = binary_search(possible_x[0], possible_x[1], self.__gps_coordinate[1], generate_range_x)
-        found_y = binary_search(possible_y[0], possible_y[1], self.__gps_coordinate[0], generate_range_y)
-        found_y = possible_y[1] - found_y
-
-        self.__gps_range = ((90 - (found_y * lat_increment) - lat_increment, 90 - (found_y * lat_increment)), 
-                     (found_x * lon_increment - 180, found_x * lon_increment + lon_increment - 180))
-        
+        found_x, found_y = self._find_tile()
         return self.pull_tile(found_x, found_y, self.__zoom_level)
 
+    # Finds the (x, y) of the tile holding the gps coordinate and sets the gps range to it
+    def _find_tile(self):
+        found_x, found_y = tile_index(self.__gps_coordinate[0], self.__gps_coordinate[1], self.__zoom_level)
+        found_x, found_y = int(found_x), int(found_y)
+        self.__gps_range = tile_range(found_x, found_y, self.__zoom_level)
+        return found_x, found_y
+
     # Method to combine two map tiles, with the gps coordinate specified located in the left tile
+    # Returns the combined image, it is kept in memory
     def get_rect_tile(self):
-        left_path = self.get_tile()
-        logging.info(TAG+'the path of the left gps tile is {}'.format(left_path))
-
-        ind = left_path.index('+') - 1
-        while self.check_int(left_path[ind-1]):
-            ind -= 1
-        x = int(left_path[ind : (left_path.index('+'))])
-        logging.info(TAG+'the x value of the left gps tile is {}'.format(x))
-
-        ind = left_path.index('+') + 1
-        while self.check_int(left_path[ind+1]):
-            ind += 1
-        y = int(left_path[left_path.index('+')+1:ind+1])
-        logging.info(TAG+'the y value of the right gps tile is {}'.format(y))
-
-        right_path = self.pull_tile(x + 1, y, self.__zoom_level)
-        imgs = [Image.open(left_path), Image.open(right_path)]
-        widths, heights = zip(*(i.size for i in imgs))
-
-        tot_width = sum(widths)
-        max_height = max(heights)
-        combined_image = Image.new('RGB', (tot_width, max_height))
-
-        x_position = 0
-        for img in imgs:
-          combined_image.paste(img, (x_position,0))
-          x_position += img.size[0]
-        combined_image.save(LOC_FOLS['map']+'stitched.png')
-
-        long_max = self.__gps_range[1][1]
-        long_min = self.__gps_range[1][0]
-        range = (long_max - long_min)
-        self.__gps_range = (self.__gps_range[0], (long_min, long_max+range))
-        logging.info(TAG+'changing the range to {}'.format(self.__gps_range))
+        x, y = self._find_tile()
+        logging.info(TAG+'the left gps tile is x:{} y:{}'.format(x, y))
 
-        return LOC_FOLS['map']+'stitched.png'
+        (lat_min, lat_max), (lon_min, lon_max) = self.__gps_range
+        bbox = ((lat_min, lat_max), (lon_min, lon_max + (lon_max - lon_min)))
+        image, self.__gps_range = build_mosaic(self.shrink(bbox), self.__zoom_level)
+        logging.info(TAG+'changing the range to {}'.format(self.__gps_range))
+        return image
+
+    # Mosaic of the tiles covering the viewport centered on the gps coordinate
+    def get_viewport(self):
+        lat, lon = self.__gps_coordinate
+        lat_span, lon_span = self.__viewport
+        bbox = ((max(lat - lat_span / 2, -90), min(lat + lat_span / 2, 90)),
+                (lon - lon_span / 2, lon + lon_span / 2))
+        image, self.__gps_range = build_mosaic(bbox, self.__zoom_level)
+        return image
+
+    # Pulls a bounding box slightly inside itself, so edges on tile borders do not add tiles
+    @staticmethod
+    def shrink(bbox, margin=1e-9):
+        (lat_min, lat_max), (lon_min, lon_max) = bbox
+        return ((lat_min + margin, lat_max - margin), (lon_min + margin, lon_max - margin))
 
-    # Handles the dowload and save of a requested tile
+    # Handles the dowload and save of a requested tile, returns its path in the tile cache
     @staticmethod
     def pull_tile(x, y, z):
-        # Checks to see if the requested map tile has already been downloaded
-        for file in os.listdir(LOC_FOLS['map']):
-            if file == '{}+{}.png'.format(x, y):
-                logging.info(TAG+'file found locally, no download needed')
-                return LOC_FOLS['map']+'{}+{}.png'.format(x, y)
-
-        logging.info(TAG+'beginning the download of requested map tile')
-        url = 'https://tile.gbif.org/{}/{}/{}/{}/{}{}{}'.format('4326', 'omt', z, x, 
-                                                                y, '@4x.png', '?style=osm-bright')
-        request = requests.get(url)
-        with open(LOC_FOLS['map']+'{}+{}.png'.format(x, y), 'wb') as file:
-                file.write(request.content)
-                if request.status_code is not 200:
-                    logging.error('*****FAILED TO DOWNLOAD MAP TILE*****')
-        return LOC_FOLS['map']+'{}+{}.png'.format(x, y)
+        return TILE_CACHE.get_path(TILE_STYLE, z, x, y)
 
     # Clears the downloaded files from local directory for NEXRAD data
     @staticmethod
     def cl_wd():
         logging.info(TAG+'clearing downloaded files in the mapping directory')
         for file in os.listdir(LOC_FOLS['map']):
-                os.unlink(LOC_FOLS['map']+file)
+                if os.path.isfile(LOC_FOLS['map']+file):
+                    os.unlink(LOC_FOLS['map']+file)
 
     # Checks to see if a string is an int
     @staticmethod
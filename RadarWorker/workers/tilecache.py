@@ -0,0 +1,120 @@
+import logging, os, threading, fileio
+from collections import OrderedDict
+from PIL import Image
+from metrics import METRICS
+
+TAG = 'TileCache - '
+
+# Two tier cache for map tiles keyed by (style, z, x, y)
+#       - Disk tier: tiles are stored as {directory}/{style}/{z}/{x}/{y}.png and survive restarts
+#       - Memory tier: a bounded LRU of decoded PIL images
+#       - Lookups are O(1), the disk tier is indexed once instead of listing the directory per call
+#       - Missing tiles are downloaded with the fetch callable given to the cache
+class TileCache:
+    def __init__(self, directory, fetch, max_images=64):
+        self.__directory = directory
+        self.__fetch = fetch
+        self.__max_images = max_images
+        self.__images = OrderedDict()
+        self.__on_disk = None
+        self.__lock = threading.Lock()
+        self.__memory_hits = 0
+        self.__disk_hits = 0
+        self.__misses = 0
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    def path(self, style, z, x, y):
+        return os.path.join(self.__directory, style, str(z), str(x), '{}.png'.format(y))
+
+    # Returns the path of a tile on disk, downloading it if needed
+    def get_path(self, style, z, x, y):
+        key = (style, z, x, y)
+        path = self.path(*key)
+        with self.__lock:
+            self._load_index()
+            if key in self.__on_disk:
+                self.__disk_hits += 1
+                METRICS.count('tile_cache_disk_hits')
+                return path
+            self.__misses += 1
+            METRICS.count('tile_cache_misses')
+
+        logging.info(TAG+'downloading tile {}'.format(key))
+        self._write(path, self.__fetch(style, z, x, y))
+        with self.__lock:
+            self.__on_disk.add(key)
+        return path
+
+    # Returns the decoded tile as an RGBA PIL image, from memory if possible
+    # Images are shared between callers, copy them before drawing on them
+    def get_image(self, style, z, x, y):
+        key = (style, z, x, y)
+        with self.__lock:
+            if key in self.__images:
+                self.__images.move_to_end(key)
+                self.__memory_hits += 1
+                METRICS.count('tile_cache_memory_hits')
+                return self.__images[key]
+
+        path = self.get_path(style, z, x, y)
+        image = Image.open(path)
+        image.load()
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+
+        with self.__lock:
+            self.__images[key] = image
+            while len(self.__images) > self.__max_images:
+                self.__images.popitem(last=False)
+        return image
+
+    # Adds a tile that was obtained elsewhere to the disk tier
+    def put(self, style, z, x, y, data):
+        key = (style, z, x, y)
+        self._write(self.path(*key), data)
+        with self.__lock:
+            self._load_index()
+            self.__on_disk.add(key)
+            self.__images.pop(key, None)
+
+    def __contains__(self, key):
+        with self.__lock:
+            self._load_index()
+            return key in self.__on_disk
+
+    # Lookup counters and hit rates, misses are lookups that needed a download
+    def stats(self):
+        lookups = self.__memory_hits + self.__disk_hits + self.__misses
+        return {'memory_hits': self.__memory_hits, 'disk_hits': self.__disk_hits, 'misses': self.__misses,
+                'memory_hit_rate': self.__memory_hits / lookups if lookups else 0.0,
+                'hit_rate': (self.__memory_hits + self.__disk_hits) / lookups if lookups else 0.0,
+                'images_in_memory': len(self.__images)}
+
+    # Drops the decoded images, the disk tier is left alone
+    def clear_memory(self):
+        with self.__lock:
+            self.__images.clear()
+
+    # Indexes the tiles already on disk, done once per cache
+    def _load_index(self):
+        if self.__on_disk is not None:
+            return
+        self.__on_disk = set()
+        for root, dirs, files in os.walk(self.__directory):
+            parts = os.path.relpath(root, self.__directory).split(os.sep)
+            if len(parts) != 3:
+                continue
+            style, z, x = parts
+            for file in files:
+                y, ext = os.path.splitext(file)
+                if ext == '.png' and z.isdigit() and x.isdigit() and y.isdigit():
+                    self.__on_disk.add((style, int(z), int(x), int(y)))
+        logging.info(TAG+'indexed {} tiles on disk'.format(len(self.__on_disk)))
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fileio.atomic_write(path, data)